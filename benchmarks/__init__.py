@@ -0,0 +1,4 @@
+"""
+Offline benchmarks of the matchmaker and the matchmaking server,
+one module per benchmark. Use bin/matchmaker_benchmark.py to run them
+"""
@@ -0,0 +1,136 @@
+"""
+Lobbies, timing and output shared by the benchmarks
+"""
+import gc
+import math
+import random
+import secrets
+import time
+import uuid
+from typing import Callable, Optional
+from unittest import mock
+
+from swipe.matchmaking.graph import Vertex
+from swipe.matchmaking.schemas import MMSettings, MMRoundData
+from swipe.settings import settings
+from swipe.swipe_server.users.enums import Gender
+
+
+def random_user_id(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def random_mm_settings(rng: random.Random) -> MMSettings:
+    # most of the lobby is waiting with the default age_diff,
+    # the rest has widened it after a few empty rounds
+    age_diffs = range(settings.MATCHMAKING_DEFAULT_AGE_DIFF,
+                      settings.MATCHMAKING_MAX_AGE_DIFF + 1,
+                      settings.MATCHMAKING_AGE_DIFF_STEP)
+    return MMSettings(
+        age=rng.randint(settings.USER_FETCH_MINIMUM_AGE, 45),
+        age_diff=rng.choices(
+            age_diffs, weights=[8] + [1] * (len(age_diffs) - 1))[0],
+        gender=rng.choice([Gender.MALE, Gender.FEMALE, Gender.MALE,
+                           Gender.FEMALE, Gender.ATTACK_HELICOPTER]),
+        gender_filter=rng.choice([None, None, Gender.MALE, Gender.FEMALE]),
+        session_id=secrets.token_urlsafe(16))
+
+
+def lobby_mm_settings(rng: random.Random) -> MMSettings:
+    # most of the lobby is in their twenties
+    mm_settings = random_mm_settings(rng)
+    mm_settings.age = int(rng.triangular(
+        settings.USER_FETCH_MINIMUM_AGE, 50, 22))
+    return mm_settings
+
+
+def random_vertices(number_of_vertices: int,
+                    rng: random.Random) -> list[Vertex]:
+    return [Vertex(random_user_id(rng), random_mm_settings(rng), set())
+            for _ in range(number_of_vertices)]
+
+
+def random_round_data(number_of_users: int,
+                      rng: random.Random) -> MMRoundData:
+    round_data = MMRoundData()
+    for _ in range(number_of_users):
+        round_data.connect(random_user_id(rng), random_mm_settings(rng),
+                           set(), set())
+    return round_data
+
+
+def timed(func: Callable, repeat: int = 1) -> float:
+    """
+    Returns average wall time of a single call in milliseconds,
+    garbage collection is disabled during the measurement like in timeit
+    """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - start) * 1000 / repeat
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def stub_candidate_fetch():
+    """
+    Patches the /fetch_candidates call of the matchmaker,
+    every refill gets no candidates
+    """
+    response = mock.MagicMock()
+    response.json.return_value = {'connections': {}}
+    return mock.patch('swipe.matchmaking.matchmaker.requests.post',
+                      return_value=response)
+
+
+def compare_to_baseline(rows: list[dict], baseline: list[dict],
+                        key: str = 'users') -> list[dict]:
+    """
+    Adds the relative change against the baseline row with the same key
+    to every numeric column
+    """
+    baseline_rows = {row[key]: row for row in baseline}
+    result = []
+    for row in rows:
+        baseline_row: Optional[dict] = baseline_rows.get(row[key])
+        compared = dict(row)
+        for column, value in row.items():
+            if column == key or not isinstance(value, (int, float)):
+                continue
+            # rows without a baseline keep the same columns
+            change = ''
+            if baseline_row and baseline_row.get(column):
+                change = f'{(value / baseline_row[column] - 1) * 100:+.1f}%'
+            compared[f'{column}_change'] = change
+        result.append(compared)
+    return result
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    if not sorted_values:
+        return math.nan
+    return sorted_values[min(len(sorted_values) - 1,
+                             int(len(sorted_values) * fraction))]
+
+
+def print_table(rows: list[dict]):
+    if not rows:
+        return
+
+    columns = list(rows[0].keys())
+    widths = [max(len(column), *(len(_format(row[column])) for row in rows))
+              for column in columns]
+    print(' | '.join(
+        column.rjust(width) for column, width in zip(columns, widths)))
+    print('-+-'.join('-' * width for width in widths))
+    for row in rows:
+        print(' | '.join(_format(row[column]).rjust(width)
+                         for column, width in zip(columns, widths)))
+
+
+def _format(value) -> str:
+    return f'{value:.3f}' if isinstance(value, float) else str(value)
@@ -0,0 +1,54 @@
+import random
+from typing import Iterable
+
+from benchmarks.common import random_vertices, timed
+from swipe.matchmaking.matchmaker import CompatibilityIndex
+from swipe.matchmaking.vectorized import VertexArrays
+
+DEFAULT_GRAPH_SIZES = (1000, 10000, 50000)
+
+
+def benchmark_compatibility(
+        graph_sizes: Iterable[int] = DEFAULT_GRAPH_SIZES,
+        probes: int = 20, seed: int = 0) -> list[dict]:
+    """
+    Time it takes to find every connection of a new vertex
+    using the scalar all-pairs scan, the bucketed index
+    and the vectorized kernel
+    """
+    rng = random.Random(seed)
+    results = []
+    for graph_size in graph_sizes:
+        vertices = random_vertices(graph_size, rng)
+        graph = {vertex.user_id: vertex for vertex in vertices}
+        index = CompatibilityIndex()
+        arrays = VertexArrays()
+        for vertex in vertices:
+            index.add(vertex)
+            arrays.add(vertex.user_id, vertex.mm_settings)
+        new_vertices = random_vertices(probes, rng)
+
+        def scalar():
+            for new_vertex in new_vertices:
+                for vertex in vertices:
+                    new_vertex.can_connect_to(vertex)
+                    vertex.can_connect_to(new_vertex)
+
+        def buckets():
+            for new_vertex in new_vertices:
+                for user_id in index.candidates(new_vertex):
+                    new_vertex.can_connect_to(graph[user_id])
+                    graph[user_id].can_connect_to(new_vertex)
+
+        def vectorized():
+            for new_vertex in new_vertices:
+                for _ in arrays.connections(new_vertex, graph):
+                    pass
+
+        results.append({
+            'graph_size': graph_size,
+            'scalar_ms': timed(scalar) / probes,
+            'buckets_ms': timed(buckets) / probes,
+            'vectorized_ms': timed(vectorized) / probes,
+        })
+    return results
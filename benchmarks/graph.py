@@ -0,0 +1,44 @@
+import random
+import tracemalloc
+
+from benchmarks.common import random_round_data, stub_candidate_fetch, timed
+from swipe.matchmaking.matchmaker import Matchmaker
+from swipe.matchmaking.schemas import MMRoundData
+
+
+def benchmark_graph(number_of_users: int = 20000, rounds: int = 5,
+                    seed: int = 0) -> list[dict]:
+    """
+    Memory taken by the connection graph of a synthetic lobby
+    and the time it takes to build it and run a few rounds on it.
+    Matched users return to the lobby after each round
+    """
+    round_data = random_round_data(number_of_users, random.Random(seed))
+
+    tracemalloc.start()
+    with stub_candidate_fetch():
+        matchmaker = Matchmaker()
+        matchmaker.prepare_round(round_data.copy(deep=True))
+    graph_memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del matchmaker
+
+    results = []
+    with stub_candidate_fetch():
+        matchmaker = Matchmaker()
+        incoming_data = round_data.copy(deep=True)
+        for round_number in range(rounds):
+            matches = []
+            round_time = timed(lambda: matches.extend(
+                matchmaker.run_matchmaking_round(incoming_data)))
+            results.append({
+                'users': number_of_users,
+                'round': round_number,
+                'graph_mb': graph_memory / 2 ** 20,
+                'round_ms': round_time,
+                'matches': len(matches),
+            })
+            incoming_data = MMRoundData()
+            for user_a, user_b in matches:
+                incoming_data.reconnect_after_call(user_a, user_b)
+    return results
@@ -0,0 +1,109 @@
+import asyncio
+import math
+import random
+import secrets
+import time
+
+import aioredis
+
+from benchmarks.common import lobby_mm_settings, percentile, random_user_id
+from swipe.matchmaking.schemas import MMSettings
+from swipe.settings import settings
+from swipe.swipe_server.users.schemas import OnlineFilterBody
+from swipe.swipe_server.users.services.fetch_service import FetchUserService
+from swipe.swipe_server.users.services.online_cache import \
+    RedisMatchmakingOnlineUserService, OnlineMatchmakingUserCacheParams
+from swipe.swipe_server.users.services.redis_services import \
+    RedisChatCacheService, RedisBlacklistService, UserFetchCacheKey
+
+
+def benchmark_join(reconnects: int = 1000, lobby_size: int = 10000,
+                   redis_url: str = 'redis://localhost:6379/15',
+                   chat_partners: int = 20, seed: int = 0) -> list[dict]:
+    """
+    Time it takes the matchmaking server to connect users to the lobby
+    when all of them reconnect at once, with their chat partners,
+    blacklists and candidates read one by one and in pipelines.
+    Every reconnecting user has the fetch caches of the previous session.
+    Needs a redis server, the database at redis_url is flushed
+    """
+    async def populate(redis: aioredis.Redis):
+        await redis.flushdb()
+        rng = random.Random(seed)
+        lobby = {random_user_id(rng): lobby_mm_settings(rng)
+                 for _ in range(lobby_size)}
+        async with redis.pipeline(transaction=False) as pipe:
+            for user_id, mm_settings in lobby.items():
+                cache_params = OnlineMatchmakingUserCacheParams(
+                    age=mm_settings.age, gender=mm_settings.gender)
+                for key in cache_params.online_keys():
+                    pipe.sadd(key, user_id)
+                pipe.sadd(RedisMatchmakingOnlineUserService
+                          .MATCHMAKING_ALL_USERS_KEY, user_id)
+            lobby_ids = list(lobby)
+            reconnecting = rng.sample(lobby_ids, min(reconnects, lobby_size))
+            for user_id in reconnecting:
+                pipe.sadd(f'{RedisChatCacheService.CHAT_CACHE_KEY}:{user_id}',
+                          *rng.sample(lobby_ids, chat_partners))
+                previous_session = UserFetchCacheKey(
+                    user_id=user_id, session_id=secrets.token_urlsafe(16))
+                pipe.sadd(previous_session.cache_key(),
+                          *rng.sample(lobby_ids, chat_partners))
+                pipe.set(previous_session.cache_age_diff_key(),
+                         settings.USER_FETCH_AGE_DIFF_STEP)
+                pipe.sadd(previous_session.sessions_key(),
+                          previous_session.session_id)
+            await pipe.execute()
+        return [(user_id, lobby[user_id]) for user_id in reconnecting]
+
+    async def storm(join_path: str) -> dict:
+        redis = aioredis.from_url(redis_url, decode_responses=True)
+        fetch_service = FetchUserService(
+            RedisMatchmakingOnlineUserService(redis), redis)
+        redis_chats = RedisChatCacheService(redis)
+        redis_blacklist = RedisBlacklistService(redis)
+        users = await populate(redis)
+
+        async def join(user_id: str, mm_settings: MMSettings) -> float:
+            filter_params = OnlineFilterBody(
+                session_id=secrets.token_urlsafe(16),
+                gender=mm_settings.gender_filter,
+                limit=settings.MATCHMAKING_FETCH_LIMIT)
+            start = time.perf_counter()
+            if join_path == 'sequential':
+                disallowed_users = \
+                    (await redis_chats.get_chat_partners(user_id)) \
+                    .union(await redis_blacklist.get_blacklist(user_id))
+                # the age pools are read one range at a time
+                await fetch_service.collect(
+                    user_id, mm_settings.age, filter_params,
+                    disallowed_users=disallowed_users,
+                    prefetch_age_difference=0)
+            else:
+                await fetch_service.collect_on_connect(
+                    user_id, mm_settings.age, filter_params,
+                    settings.MATCHMAKING_CONNECT_PREFETCH_AGE_DIFF)
+            return (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        join_times = sorted(await asyncio.gather(*[
+            join(user_id, mm_settings) for user_id, mm_settings in users]))
+        storm_secs = time.perf_counter() - start
+        await redis.flushdb()
+        await redis.close()
+        return {
+            'join': join_path,
+            'reconnects': len(users),
+            'storm_secs': storm_secs,
+            'join_p50_ms': percentile(join_times, 0.5),
+            'join_p95_ms': percentile(join_times, 0.95),
+            'join_p99_ms': percentile(join_times, 0.99),
+            'join_max_ms': join_times[-1] if join_times else math.nan,
+        }
+
+    loop = asyncio.new_event_loop()
+    try:
+        return [loop.run_until_complete(storm(join_path))
+                for join_path in ('sequential', 'pipelined')]
+    finally:
+        loop.close()
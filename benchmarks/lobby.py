@@ -0,0 +1,158 @@
+import heapq
+import math
+import random
+import resource
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Tuple
+
+from benchmarks.common import lobby_mm_settings, percentile, \
+    random_user_id, stub_candidate_fetch, timed
+from swipe.matchmaking.matchmaker import Matchmaker
+from swipe.matchmaking.schemas import MMRoundData
+from swipe.settings import settings
+
+DEFAULT_LOBBY_SIZES = (1000, 2500, 5000)
+
+
+class LobbySimulator:
+    """
+    Round data of a lobby that stays around the same size.
+    Idle users leave and new ones arrive, matched pairs either decline
+    each other or go to a call and come back from it a few rounds later,
+    some of them leave right after the call
+    """
+
+    def __init__(self, lobby_size: int, rng: random.Random,
+                 churn: float = 0.05, decline_rate: float = 0.3,
+                 call_rounds: Tuple[int, int] = (2, 12),
+                 leave_after_call_rate: float = 0.2):
+        self._lobby_size = lobby_size
+        self._rng = rng
+        self._churn = churn
+        self._decline_rate = decline_rate
+        self._call_rounds = call_rounds
+        self._leave_after_call_rate = leave_after_call_rate
+        self._round = 0
+        # users waiting for a match, dict keeps the order deterministic
+        self._idle: dict[str, None] = {}
+        # users in a call
+        self._in_call: set[str] = set()
+        # round the call ends and the pair
+        self._calls: list[Tuple[int, str, str]] = []
+
+    def next_round(self, matches: Iterable[Tuple[str, str]] = ()) \
+            -> MMRoundData:
+        """
+        Round data that follows the matches of the previous round
+        """
+        round_data = MMRoundData()
+        self._round += 1
+        for user_a, user_b in matches:
+            if self._rng.random() < self._decline_rate:
+                round_data.reconnect_decline(user_a, user_b)
+                continue
+            for user_id in (user_a, user_b):
+                del self._idle[user_id]
+                self._in_call.add(user_id)
+            heapq.heappush(self._calls, (
+                self._round + self._rng.randint(*self._call_rounds),
+                user_a, user_b))
+
+        while self._calls and self._calls[0][0] <= self._round:
+            _, user_a, user_b = heapq.heappop(self._calls)
+            leaving = [user_id for user_id in (user_a, user_b)
+                       if self._rng.random() < self._leave_after_call_rate]
+            for user_id in (user_a, user_b):
+                self._in_call.remove(user_id)
+                if user_id in leaving:
+                    round_data.disconnected_users.add(user_id)
+                else:
+                    self._idle[user_id] = None
+            if not leaving:
+                round_data.reconnect_after_call(user_a, user_b)
+            elif len(leaving) == 1:
+                round_data.reconnect(user_b if user_a in leaving else user_a)
+
+        leaving = self._rng.sample(
+            list(self._idle), int(len(self._idle) * self._churn))
+        for user_id in leaving:
+            del self._idle[user_id]
+            round_data.disconnected_users.add(user_id)
+
+        for _ in range(self._lobby_size - len(self._idle)
+                       - len(self._in_call)):
+            user_id = random_user_id(self._rng)
+            round_data.connect(user_id, lobby_mm_settings(self._rng),
+                               set(), set())
+            self._idle[user_id] = None
+        return round_data
+
+
+def benchmark_lobby(lobby_sizes: Iterable[int] = DEFAULT_LOBBY_SIZES,
+                    rounds: int = 10, seed: int = 0,
+                    matching_strategy: str =
+                    settings.MATCHMAKING_MATCHING_STRATEGY,
+                    class_graph: bool = settings.MATCHMAKING_CLASS_GRAPH,
+                    edge_budget: int = settings.MATCHMAKING_EDGE_BUDGET) \
+        -> list[dict]:
+    """
+    Round latency, memory and match rate of the matchmaker
+    on a simulated lobby of every size.
+    The first round builds the graph of the whole lobby,
+    it's reported separately from the percentiles.
+    Every size runs in a fresh process, so that the peak memory
+    is not inherited from the bigger lobbies.
+    Sets of user ids are iterated in hash order, runs are repeatable
+    only with the same PYTHONHASHSEED
+    """
+    results = []
+    for lobby_size in lobby_sizes:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results.append(executor.submit(
+                _benchmark_lobby_size, lobby_size, rounds, seed,
+                matching_strategy, class_graph, edge_budget).result())
+    return results
+
+
+def _benchmark_lobby_size(lobby_size: int, rounds: int, seed: int,
+                          matching_strategy: str, class_graph: bool,
+                          edge_budget: int) -> dict:
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    lobby = LobbySimulator(lobby_size, random.Random(seed))
+    round_times: list[float] = []
+    match_rates: list[float] = []
+    first_round_ms = math.nan
+    matches = []
+    with stub_candidate_fetch():
+        matchmaker = Matchmaker(matching_strategy=matching_strategy,
+                                class_graph=class_graph,
+                                edge_budget=edge_budget)
+        for round_number in range(rounds + 1):
+            incoming_data = lobby.next_round(matches)
+            matches = []
+            round_time = timed(lambda: matches.extend(
+                matchmaker.run_matchmaking_round(incoming_data)))
+            if round_number == 0:
+                first_round_ms = round_time
+                continue
+
+            round_times.append(round_time)
+            heap_size = \
+                matchmaker.metrics.last_rounds['full'].values['heap_size']
+            if heap_size:
+                match_rates.append(2 * len(matches) / heap_size)
+
+    round_times.sort()
+    # ru_maxrss is in kilobytes on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'users': lobby_size,
+        'first_round_ms': first_round_ms,
+        'p50_ms': percentile(round_times, 0.5),
+        'p90_ms': percentile(round_times, 0.9),
+        'p99_ms': percentile(round_times, 0.99),
+        'rss_mb': (peak_rss - base_rss) / 2 ** 10,
+        'edges': matchmaker.graph.edge_count,
+        'match_rate': sum(match_rates) / len(match_rates)
+        if match_rates else math.nan,
+    }
@@ -0,0 +1,144 @@
+import asyncio
+import os
+import random
+import time
+from typing import Iterable, Optional, Tuple
+
+from benchmarks.common import percentile
+from benchmarks.lobby import LobbySimulator
+from swipe.matchmaking.embedded import EmbeddedLobby, EmbeddedMatchmaker
+from swipe.matchmaking.matchmaker import MatchmakerConfig
+from swipe.matchmaking.schemas import MMRoundData
+
+DEFAULT_MODES = ('video', 'audio', 'text')
+
+
+class EmbeddedLobbySimulator:
+    """
+    Simulated lobby answering the requests of an embedded matchmaker,
+    it keeps the time from the round data handed out to the matches
+    sent back
+    """
+
+    def __init__(self, lobby_size: int, rng: random.Random):
+        self._lobby = LobbySimulator(lobby_size, rng)
+        self._matches: list[Tuple[str, str]] = []
+        self._round_start: Optional[float] = None
+        self.rounds = 0
+        self.matches = 0
+        self.round_times: list[float] = []
+
+    def embedded_lobby(self, matchmaker_config: MatchmakerConfig) \
+            -> EmbeddedLobby:
+        async def round_data(_) -> MMRoundData:
+            self.rounds += 1
+            self._round_start = time.perf_counter()
+            matches, self._matches = self._matches, []
+            return self._lobby.next_round(matches)
+
+        async def send_matches(matches: list[Tuple[str, str]]):
+            if self._round_start is not None:
+                self.round_times.append(
+                    (time.perf_counter() - self._round_start) * 1000)
+                self._round_start = None
+            self.matches += len(matches)
+            self._matches.extend(tuple(match) for match in matches)
+
+        async def candidates(_) -> dict[str, list[str]]:
+            return {}
+
+        async def lobby_state(_) -> Tuple[set[str], set[str]]:
+            return set(), set()
+
+        async def reconnect_users(_):
+            pass
+
+        async def on_restart():
+            pass
+
+        return EmbeddedLobby(
+            {
+                'round_data': round_data,
+                'matches': send_matches,
+                'candidates': candidates,
+                'lobby_state': lobby_state,
+                'reconnect_users': reconnect_users,
+            },
+            on_restart=on_restart, matchmaker_config=matchmaker_config)
+
+
+def benchmark_modes(lobby_size: int = 2000,
+                    modes: Iterable[str] = DEFAULT_MODES,
+                    duration_secs: float = 30, round_length_secs: float = 1,
+                    seed: int = 0) -> list[dict]:
+    """
+    Memory and CPU time taken by the matchmakers of the lobbies
+    of every mode deployed separately and by those of a multi-mode
+    matchmaking server, both run a matchmaker process per lobby.
+    Every lobby is simulated and talks to its matchmaker over the pipes
+    of the embedded matchmaker. Processes are measured through /proc,
+    so it runs only on linux. Matchmaking servers are not included,
+    a separate deployment has a server process per mode on top of that
+    """
+    modes = list(modes)
+    results = []
+    for setup in ('separate', 'multi-mode'):
+        loop = asyncio.new_event_loop()
+        lobbies = {
+            mode: EmbeddedLobbySimulator(
+                lobby_size, random.Random(seed + mode_number))
+            for mode_number, mode in enumerate(modes)
+        }
+        embedded_lobbies = {
+            mode: lobby.embedded_lobby(
+                MatchmakerConfig(round_length_secs=round_length_secs))
+            for mode, lobby in lobbies.items()
+        }
+        if setup == 'separate':
+            matchmakers = [
+                EmbeddedMatchmaker({mode: embedded_lobby})
+                for mode, embedded_lobby in embedded_lobbies.items()
+            ]
+        else:
+            matchmakers = [EmbeddedMatchmaker(embedded_lobbies)]
+
+        for matchmaker in matchmakers:
+            matchmaker.start(loop)
+        try:
+            loop.run_until_complete(asyncio.sleep(duration_secs))
+            process_stats = [_process_stats(pid) for matchmaker in matchmakers
+                             for pid in matchmaker.pids]
+        finally:
+            for matchmaker in matchmakers:
+                matchmaker.stop()
+            loop.close()
+
+        round_times = sorted(round_time for lobby in lobbies.values()
+                             for round_time in lobby.round_times)
+        results.append({
+            'setup': setup,
+            'processes': len(process_stats),
+            'peak_rss_mb': sum(rss_mb for rss_mb, _ in process_stats),
+            'cpu_secs': sum(cpu_secs for _, cpu_secs in process_stats),
+            'rounds': sum(lobby.rounds for lobby in lobbies.values()),
+            'matches': sum(lobby.matches for lobby in lobbies.values()),
+            'round_p50_ms': percentile(round_times, 0.5),
+            'round_p90_ms': percentile(round_times, 0.9),
+        })
+    return results
+
+
+def _process_stats(pid: int) -> Tuple[float, float]:
+    """
+    Peak resident memory in megabytes and CPU time of the process
+    """
+    with open(f'/proc/{pid}/status') as status_file:
+        peak_rss_kb = next(
+            int(line.split()[1]) for line in status_file
+            if line.startswith('VmHWM:'))
+    with open(f'/proc/{pid}/stat') as stat_file:
+        # the name of the process goes before, it's in parentheses
+        fields = stat_file.read().rsplit(')', 1)[1].split()
+    # utime and stime, fields 14 and 15 of the whole line
+    cpu_ticks = int(fields[11]) + int(fields[12])
+    return peak_rss_kb / 2 ** 10, cpu_ticks / os.sysconf('SC_CLK_TCK')
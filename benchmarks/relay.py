@@ -0,0 +1,65 @@
+import json
+import random
+import secrets
+import uuid
+
+from benchmarks.common import random_user_id, timed
+from swipe.matchmaking.schemas import MMBasePayload, relay_target
+from swipe.ws_connection import PayloadEncoder
+
+
+def signaling_payloads(rng: random.Random) -> list[str]:
+    """
+    Offer and ice candidate frames the way browsers send them
+    """
+    sender_id, recipient_id = random_user_id(rng), random_user_id(rng)
+    sdp_lines = ['v=0', f'o=- {rng.getrandbits(63)} 2 IN IP4 127.0.0.1']
+    for media in ('audio', 'video'):
+        sdp_lines.append(f'm={media} 9 UDP/TLS/RTP/SAVPF 96 97 98 99 100')
+        sdp_lines += [f'a=rtpmap:{96 + codec} codec{codec}/90000'
+                      for codec in range(30)]
+        sdp_lines += [
+            f'a=ssrc:{rng.getrandbits(32)} cname:{secrets.token_hex(8)}'
+            for _ in range(4)]
+    offer = {
+        'sender_id': sender_id, 'recipient_id': recipient_id,
+        'request_id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+        'timestamp': '2022-01-01T00:00:00',
+        'payload': {'type': 'sdp', 'sdp': {
+            'type': 'offer', 'sdp': '\r\n'.join(sdp_lines)}},
+    }
+    ice = {
+        'sender_id': sender_id, 'recipient_id': recipient_id,
+        'payload': {'type': 'ice', 'ice': {
+            'candidate': f'candidate:{rng.getrandbits(32)} 1 udp 2122260223 '
+                         f'192.168.0.{rng.randint(1, 254)} '
+                         f'{rng.randint(1024, 65535)} typ host generation 0',
+            'sdpMid': '0', 'sdpMLineIndex': 0}},
+    }
+    return [json.dumps(offer), json.dumps(ice)]
+
+
+def benchmark_relay(repeat: int = 2000, seed: int = 0) -> list[dict]:
+    """
+    Time the matchmaking server spends on a signaling payload
+    it forwards, fully validated and re-encoded vs relayed as it came
+    """
+    def validated(text: str) -> str:
+        base_payload = MMBasePayload.validate(json.loads(text))
+        return json.dumps(
+            base_payload.dict(by_alias=True, exclude_unset=True),
+            cls=PayloadEncoder)
+
+    def relayed(text: str) -> str:
+        relay_target(json.loads(text))
+        return text
+
+    results = []
+    for text in signaling_payloads(random.Random(seed)):
+        row = {'payload': json.loads(text)['payload']['type'],
+               'bytes': len(text)}
+        for path, forward in (('validated', validated), ('relayed', relayed)):
+            row[f'{path}_us'] = timed(lambda: forward(text), repeat) * 1000
+        row['speedup'] = row['validated_us'] / row['relayed_us']
+        results.append(row)
+    return results
@@ -0,0 +1,103 @@
+import time
+from collections import defaultdict, deque
+from typing import Iterable, Optional
+from unittest import mock
+
+from swipe.matchmaking.matchmaker import Matchmaker
+from swipe.matchmaking.recording import read_recording, ROUND, MATCHES, \
+    CANDIDATES
+from swipe.matchmaking.schemas import MMRoundData
+from swipe.settings import settings
+
+
+class RecordedCandidates:
+    """
+    Stands in for /fetch_candidates, every user gets the candidates
+    recorded for him in the same order they were fetched
+    """
+
+    def __init__(self, records: Iterable[dict]):
+        self._connections: dict[str, deque[list[str]]] = defaultdict(deque)
+        for record in records:
+            if record['kind'] == CANDIDATES:
+                for user_id, user_ids in record['data'].items():
+                    self._connections[user_id].append(user_ids)
+
+    def post(self, url: str, json: list[dict], **kwargs) -> mock.MagicMock:
+        connections = {}
+        for query in json:
+            user_id = query['user_id']
+            user_connections = self._connections.get(user_id)
+            connections[user_id] = \
+                user_connections.popleft() if user_connections else []
+        response = mock.MagicMock()
+        response.json.return_value = {'connections': connections}
+        return response
+
+
+def replay_recording(path: str, event_driven: bool = False,
+                     round_length_secs: float =
+                     settings.MATCHMAKING_ROUND_LENGTH_SECS,
+                     matching_strategy: str =
+                     settings.MATCHMAKING_MATCHING_STRATEGY,
+                     vectorized: bool =
+                     settings.MATCHMAKING_VECTORIZED_COMPATIBILITY,
+                     class_graph: bool = settings.MATCHMAKING_CLASS_GRAPH,
+                     edge_budget: int = settings.MATCHMAKING_EDGE_BUDGET) \
+        -> list[dict]:
+    """
+    Feeds the recorded rounds to a fresh matchmaker and compares
+    its matches to the recorded ones.
+    In the event-driven mode a round is a full one once round_length_secs
+    have passed since the previous full round by the recorded time.
+    Like the lobby benchmark, it's repeatable with the same PYTHONHASHSEED
+    """
+    records = list(read_recording(path))
+    candidates = RecordedCandidates(records)
+
+    results = []
+    with mock.patch('swipe.matchmaking.matchmaker.requests.post',
+                    candidates.post):
+        matchmaker = Matchmaker(vectorized=vectorized,
+                                matching_strategy=matching_strategy,
+                                class_graph=class_graph,
+                                edge_budget=edge_budget)
+        last_full_round = None
+        result: Optional[dict] = None
+        for record in records:
+            if record['kind'] == MATCHES and result is not None:
+                result['recorded_matches'] += len(record['data'])
+                continue
+            if record['kind'] != ROUND:
+                continue
+
+            round_data = MMRoundData.parse_obj(record['data'])
+            full_round = not event_driven or last_full_round is None \
+                or record['time'] - last_full_round >= round_length_secs
+            if full_round:
+                last_full_round = record['time']
+                matches = matchmaker.run_matchmaking_round(round_data)
+            else:
+                matches = matchmaker.run_incremental_round(round_data)
+
+            start = time.perf_counter()
+            matches = list(matches)
+            round_ms = (time.perf_counter() - start) * 1000
+            round_metrics = matchmaker.metrics.current_round
+            slowest_phase = max(round_metrics.phases.items(),
+                                key=lambda phase: phase[1],
+                                default=('', 0.0))
+            result = {
+                'round': len(results),
+                'time': record['time'],
+                'kind': round_metrics.kind,
+                'new_users': len(round_data.new_users),
+                'graph_size': len(matchmaker.graph),
+                'round_ms': round_ms,
+                'slowest_phase': slowest_phase[0],
+                'slowest_phase_ms': slowest_phase[1] * 1000,
+                'recorded_matches': 0,
+                'matches': len(matches),
+            }
+            results.append(result)
+    return results
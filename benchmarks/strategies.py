@@ -0,0 +1,41 @@
+import random
+import time
+from typing import Iterable
+
+from benchmarks.common import random_round_data, stub_candidate_fetch
+from swipe.matchmaking.matchmaker import Matchmaker
+from swipe.matchmaking.schemas import MMRoundData
+from swipe.matchmaking.strategies import MATCHING_STRATEGIES
+
+
+def benchmark_strategies(number_of_users: int = 5000, rounds: int = 5,
+                         seed: int = 0,
+                         strategies: Iterable[str] = MATCHING_STRATEGIES) \
+        -> list[dict]:
+    """
+    Matches per round and CPU time per round of every matching strategy
+    on the same synthetic lobby.
+    Matched users return to the lobby after each round
+    """
+    round_data = random_round_data(number_of_users, random.Random(seed))
+    results = []
+    for strategy in strategies:
+        with stub_candidate_fetch():
+            matchmaker = Matchmaker(matching_strategy=strategy)
+            incoming_data = round_data.copy(deep=True)
+            for round_number in range(rounds):
+                # the graph is built outside of the measured part
+                matchmaker.prepare_round(incoming_data)
+                incoming_data = MMRoundData()
+                start = time.process_time()
+                matches = list(matchmaker.run_matchmaking_round(incoming_data))
+                results.append({
+                    'strategy': strategy,
+                    'users': number_of_users,
+                    'round': round_number,
+                    'cpu_ms': (time.process_time() - start) * 1000,
+                    'matches': len(matches),
+                })
+                for user_a, user_b in matches:
+                    incoming_data.reconnect_after_call(user_a, user_b)
+    return results
@@ -0,0 +1,117 @@
+import heapq
+import math
+import random
+import time
+from typing import Optional, Tuple
+
+from benchmarks.common import percentile, random_mm_settings, \
+    random_user_id, stub_candidate_fetch
+from swipe.matchmaking.matchmaker import Matchmaker
+from swipe.matchmaking.scheduling import RoundScheduler, count_arrivals
+from swipe.matchmaking.schemas import MMRoundData
+from swipe.settings import settings
+
+
+def benchmark_time_to_match(users_per_sec: float = 5.0,
+                            duration_secs: int = 300, seed: int = 0,
+                            call_secs: Tuple[int, int] = (30, 120),
+                            target_p95_secs: float = 0) \
+        -> list[dict]:
+    """
+    Time-to-match in fixed rounds, in the event-driven mode and,
+    with target_p95_secs, in rounds picked by `RoundScheduler`
+    on a simulated lobby where users keep arriving and return
+    to the lobby after their calls. Time is simulated, counted from the
+    moment a user becomes available and ignores the processing time
+    """
+    tick_secs = settings.MATCHMAKING_EVENT_POLL_INTERVAL_SECS
+    modes = ['rounds', 'events']
+    if target_p95_secs:
+        modes.append('adaptive')
+    results = []
+    for mode in modes:
+        arrival_rng, call_rng = random.Random(seed), random.Random(seed)
+        next_arrival = arrival_rng.expovariate(users_per_sec)
+        # user_id -> time he became available
+        waiting_since: dict[str, float] = {}
+        # return time and the pair
+        calls: list[Tuple[float, str, str]] = []
+        times_to_match: list[float] = []
+        cpu_secs = 0.0
+        rounds = 0
+        last_round = -math.inf
+        round_length_secs = settings.MATCHMAKING_ROUND_LENGTH_SECS
+        scheduler: Optional[RoundScheduler] = None
+        if mode == 'adaptive':
+            scheduler = RoundScheduler(
+                target_p95_secs,
+                min_round_length_secs=settings
+                .MATCHMAKING_MIN_ROUND_LENGTH_SECS,
+                max_round_length_secs=settings
+                .MATCHMAKING_MAX_ROUND_LENGTH_SECS)
+            round_length_secs = scheduler.round_length_secs
+        incoming_data = MMRoundData()
+        with stub_candidate_fetch():
+            matchmaker = Matchmaker()
+            for tick in range(int(duration_secs / tick_secs)):
+                now = tick * tick_secs
+                while next_arrival <= now:
+                    user_id = random_user_id(arrival_rng)
+                    incoming_data.connect(
+                        user_id, random_mm_settings(arrival_rng),
+                        set(), set())
+                    waiting_since[user_id] = next_arrival
+                    next_arrival += arrival_rng.expovariate(users_per_sec)
+                while calls and calls[0][0] <= now:
+                    return_time, user_a, user_b = heapq.heappop(calls)
+                    incoming_data.reconnect_after_call(user_a, user_b)
+                    waiting_since[user_a] = waiting_since[user_b] = \
+                        return_time
+
+                full_round = now - last_round >= round_length_secs
+                if not full_round and mode != 'events':
+                    continue
+
+                arrivals = count_arrivals(incoming_data)
+                start = time.process_time()
+                if full_round:
+                    elapsed_secs = now - last_round
+                    last_round = now
+                    rounds += 1
+                    matches = list(
+                        matchmaker.run_matchmaking_round(incoming_data))
+                else:
+                    matches = list(
+                        matchmaker.run_incremental_round(incoming_data))
+                round_cpu_secs = time.process_time() - start
+                cpu_secs += round_cpu_secs
+
+                incoming_data = MMRoundData()
+                round_times_to_match = []
+                for user_a, user_b in matches:
+                    round_times_to_match.append(
+                        now - waiting_since.pop(user_a))
+                    round_times_to_match.append(
+                        now - waiting_since.pop(user_b))
+                    heapq.heappush(calls, (
+                        now + call_rng.uniform(*call_secs), user_a, user_b))
+                times_to_match.extend(round_times_to_match)
+
+                if scheduler:
+                    round_length_secs = scheduler.observe_round(
+                        elapsed_secs if math.isfinite(elapsed_secs) else 0,
+                        round_cpu_secs, arrivals,
+                        len(matchmaker.unmatched_vertices()),
+                        round_times_to_match)
+
+        times_to_match.sort()
+        results.append({
+            'mode': mode,
+            'matches': len(times_to_match) // 2,
+            'rounds': rounds,
+            'median_s': percentile(times_to_match, 0.5),
+            'p90_s': percentile(times_to_match, 0.9),
+            'p95_s': percentile(times_to_match, 0.95),
+            'cpu_ms_per_sec': cpu_secs * 1000 / duration_secs,
+        })
+    return results
@@ -17,5 +17,4 @@ if settings.SENTRY_MATCHMAKER_URL:
 from swipe.matchmaking import matchmaker
 
 if __name__ == '__main__':
-    matchmaker.start_matchmaker(
-        round_length_secs=settings.MATCHMAKING_ROUND_LENGTH_SECS)
+    matchmaker.start_matchmaker(matchmaker.MatchmakerConfig.from_settings())
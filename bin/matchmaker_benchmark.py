@@ -0,0 +1,165 @@
+import argparse
+import json
+import logging
+import os
+import sys
+
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from swipe import config
+
+config.configure_logging()
+# matchmaker logs every vertex pair it checks
+logging.getLogger('matchmaker').setLevel(logging.WARNING)
+
+from benchmarks.common import compare_to_baseline, print_table
+from benchmarks.compatibility import DEFAULT_GRAPH_SIZES, \
+    benchmark_compatibility
+from benchmarks.graph import benchmark_graph
+from benchmarks.lobby import DEFAULT_LOBBY_SIZES, benchmark_lobby
+from benchmarks.modes import benchmark_modes
+from benchmarks.relay import benchmark_relay
+from benchmarks.replay import replay_recording
+from benchmarks.strategies import benchmark_strategies
+from benchmarks.time_to_match import benchmark_time_to_match
+
+
+def _sizes(value: str) -> list[int]:
+    return [int(size) for size in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Matchmaker benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    compatibility = subparsers.add_parser(
+        'compatibility',
+        help='scalar vs bucketed vs vectorized compatibility checks')
+    compatibility.add_argument(
+        '--sizes', type=_sizes, default=DEFAULT_GRAPH_SIZES)
+    compatibility.add_argument('--probes', type=int, default=20)
+    compatibility.add_argument('--seed', type=int, default=0)
+
+    graph = subparsers.add_parser(
+        'graph', help='memory and round time on a synthetic lobby')
+    graph.add_argument('--users', type=int, default=20000)
+    graph.add_argument('--rounds', type=int, default=5)
+    graph.add_argument('--seed', type=int, default=0)
+
+    strategies = subparsers.add_parser(
+        'strategies', help='matches and CPU time per round of every strategy')
+    strategies.add_argument('--users', type=int, default=5000)
+    strategies.add_argument('--rounds', type=int, default=5)
+    strategies.add_argument('--seed', type=int, default=0)
+
+    time_to_match = subparsers.add_parser(
+        'time_to_match',
+        help='time-to-match in fixed rounds, in the event-driven mode '
+             'and in scheduled rounds')
+    time_to_match.add_argument('--users-per-sec', type=float, default=5.0)
+    time_to_match.add_argument('--duration', type=int, default=300)
+    time_to_match.add_argument('--seed', type=int, default=0)
+    time_to_match.add_argument(
+        '--target-p95', type=float, default=0,
+        help='p95 time-to-match the scheduled rounds aim for')
+
+    lobby = subparsers.add_parser(
+        'lobby',
+        help='round latency, memory and match rate on a simulated lobby')
+    lobby.add_argument(
+        '--sizes', type=_sizes, default=DEFAULT_LOBBY_SIZES)
+    lobby.add_argument('--rounds', type=int, default=10)
+    lobby.add_argument('--seed', type=int, default=0)
+    lobby.add_argument('--strategy', default='greedy')
+    lobby.add_argument('--class-graph', action='store_true')
+    lobby.add_argument('--edge-budget', type=int, default=0,
+                       help='bidirectional edges shared by the lobby')
+    lobby.add_argument('--save', help='write the results to a json file')
+    lobby.add_argument('--baseline',
+                       help='json file of a previous run to compare with')
+
+    modes = subparsers.add_parser(
+        'modes',
+        help='memory and CPU time of the matchmakers of separately '
+             'deployed modes and of a multi-mode server')
+    modes.add_argument('--users', type=int, default=2000,
+                       help='users in the lobby of every mode')
+    modes.add_argument('--duration', type=float, default=30)
+    modes.add_argument('--round-length', type=float, default=1)
+    modes.add_argument('--seed', type=int, default=0)
+
+    join = subparsers.add_parser(
+        'join', help='join latency of users reconnecting all at once, '
+                     'redis lookups one by one vs pipelined')
+    join.add_argument('--reconnects', type=int, default=1000)
+    join.add_argument('--users', type=int, default=10000,
+                      help='users online in the lobby')
+    join.add_argument('--redis-url', default='redis://localhost:6379/15',
+                      help='the database is flushed')
+    join.add_argument('--seed', type=int, default=0)
+
+    relay = subparsers.add_parser(
+        'relay', help='CPU time of a forwarded sdp/ice payload, '
+                      'validated vs relayed as it came')
+    relay.add_argument('--repeat', type=int, default=2000)
+    relay.add_argument('--seed', type=int, default=0)
+
+    replay = subparsers.add_parser(
+        'replay', help='rounds recorded by the matchmaking server '
+                       'replayed on a fresh matchmaker')
+    replay.add_argument('path')
+    replay.add_argument('--event-driven', action='store_true')
+    replay.add_argument('--strategy', default='greedy')
+    replay.add_argument('--vectorized', action='store_true')
+    replay.add_argument('--class-graph', action='store_true')
+    replay.add_argument('--edge-budget', type=int, default=0)
+    replay.add_argument('--slowest', type=int,
+                        help='show only this many of the slowest rounds')
+
+    args = parser.parse_args()
+    if args.benchmark == 'compatibility':
+        print_table(benchmark_compatibility(
+            args.sizes, probes=args.probes, seed=args.seed))
+    elif args.benchmark == 'graph':
+        print_table(benchmark_graph(
+            args.users, rounds=args.rounds, seed=args.seed))
+    elif args.benchmark == 'strategies':
+        print_table(benchmark_strategies(
+            args.users, rounds=args.rounds, seed=args.seed))
+    elif args.benchmark == 'time_to_match':
+        print_table(benchmark_time_to_match(
+            args.users_per_sec, duration_secs=args.duration, seed=args.seed,
+            target_p95_secs=args.target_p95))
+    elif args.benchmark == 'lobby':
+        results = benchmark_lobby(
+            args.sizes, rounds=args.rounds, seed=args.seed,
+            matching_strategy=args.strategy, class_graph=args.class_graph,
+            edge_budget=args.edge_budget)
+        if args.save:
+            with open(args.save, 'w') as results_file:
+                json.dump(results, results_file)
+        if args.baseline:
+            with open(args.baseline) as baseline_file:
+                results = compare_to_baseline(
+                    results, json.load(baseline_file))
+        print_table(results)
+    elif args.benchmark == 'modes':
+        print_table(benchmark_modes(
+            args.users, duration_secs=args.duration,
+            round_length_secs=args.round_length, seed=args.seed))
+    elif args.benchmark == 'join':
+        # the rest of the benchmarks run without redis and the user services
+        from benchmarks.join import benchmark_join
+        print_table(benchmark_join(
+            args.reconnects, lobby_size=args.users, redis_url=args.redis_url,
+            seed=args.seed))
+    elif args.benchmark == 'relay':
+        print_table(benchmark_relay(args.repeat, seed=args.seed))
+    elif args.benchmark == 'replay':
+        results = replay_recording(
+            args.path, event_driven=args.event_driven,
+            matching_strategy=args.strategy, vectorized=args.vectorized,
+            class_graph=args.class_graph, edge_budget=args.edge_budget)
+        if args.slowest:
+            results = sorted(results, key=lambda row: -row['round_ms'])[
+                      :args.slowest]
+        print_table(results)
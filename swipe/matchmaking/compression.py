@@ -0,0 +1,184 @@
+import logging
+from typing import Optional, Tuple
+
+import numpy as np
+
+from swipe.matchmaking.graph import CandidateHeap, ConnectionGraph, Vertex, \
+    pack_heap_entry, unpack_heap_entry
+from swipe.matchmaking.schemas import MMSettings
+from swipe.swipe_server.users.enums import Gender
+
+logger = logging.getLogger('matchmaker')
+
+# age, gender, gender_filter, age_diff
+ClassKey = Tuple[int, Gender, Optional[Gender], int]
+
+
+def class_key(mm_settings: MMSettings) -> ClassKey:
+    return mm_settings.age, mm_settings.gender, \
+           mm_settings.gender_filter, mm_settings.age_diff
+
+
+def connects(key_1: ClassKey, key_2: ClassKey) -> bool:
+    """
+    True if users of the first class can connect to users of the second,
+    it's `Vertex.can_connect_to` without the temporary blacklists
+    """
+    age_1, _, gender_filter_1, age_diff_1 = key_1
+    age_2, gender_2, _, _ = key_2
+    return abs(age_1 - age_2) <= age_diff_1 \
+           and (gender_filter_1 is None or gender_filter_1 == gender_2)
+
+
+class UserClass:
+    __slots__ = ('key', 'numbers', 'available', 'partners')
+
+    def __init__(self, key: ClassKey):
+        self.key = key
+        # numbers of all the vertices of the class
+        self.numbers: set[int] = set()
+        # vertices that are not in a call ordered by weight
+        self.available = CandidateHeap()
+        # classes connected to this one in both directions,
+        # the class itself is one of them if its users can be matched
+        # with each other
+        self.partners: list['UserClass'] = []
+
+
+class ClassGraph:
+    """
+    Vertices grouped into classes of users with the same age, gender,
+    gender filter and age_diff. Compatibility is a function of the classes,
+    so bidirectional connections are kept between the classes instead of
+    the vertex pairs and a vertex is matched with the heaviest available
+    member of its partner classes. Temporary blacklists are the exceptions,
+    they're checked only for the members about to be picked.
+    A vertex moves to another class once its age_diff is widened
+    """
+
+    def __init__(self, graph: ConnectionGraph):
+        self._graph = graph
+        self._classes: dict[ClassKey, UserClass] = {}
+        # vertex number -> class of the vertex
+        self._vertex_classes: dict[int, UserClass] = {}
+
+    def __len__(self):
+        return len(self._classes)
+
+    def add(self, vertex: Vertex):
+        key = class_key(vertex.mm_settings)
+        if (user_class := self._classes.get(key)) is None:
+            user_class = self._add_class(key)
+        user_class.numbers.add(vertex.number)
+        self._vertex_classes[vertex.number] = user_class
+        if not vertex.matched:
+            user_class.available.push(
+                vertex.number, vertex.mm_settings.current_weight)
+
+    def remove(self, vertex: Vertex):
+        if (user_class := self._vertex_classes.pop(vertex.number, None)) \
+                is None:
+            return
+
+        user_class.numbers.discard(vertex.number)
+        user_class.available.discard(vertex.number)
+        if not user_class.numbers:
+            self._remove_class(user_class)
+
+    def update(self, vertex: Vertex):
+        """
+        Moves the vertex to another class after its age_diff has changed
+        """
+        if self._vertex_classes[vertex.number].key \
+                == class_key(vertex.mm_settings):
+            self.push(vertex)
+            return
+        self.remove(vertex)
+        self.add(vertex)
+
+    def push(self, vertex: Vertex):
+        """
+        Makes the vertex available with its current weight
+        """
+        self._vertex_classes[vertex.number].available.push(
+            vertex.number, vertex.mm_settings.current_weight)
+
+    def discard(self, vertex: Vertex):
+        self._vertex_classes[vertex.number].available.discard(vertex.number)
+
+    def partner_numbers(self, vertex: Vertex) -> np.ndarray:
+        """
+        Numbers of the members of the partner classes, the ones
+        the vertex would have bidirectional edges with, in ascending order
+        like the edges of the graph
+        """
+        return np.sort(np.fromiter(
+            (number
+             for user_class in self._vertex_classes[vertex.number].partners
+             for number in user_class.numbers
+             if number != vertex.number),
+            dtype=np.int64))
+
+    def find_match(self, vertex: Vertex) -> Optional[Tuple[int, int]]:
+        """
+        Returns the number and the weight of the heaviest available member
+        of the partner classes that hasn't been blacklisted
+        """
+        best_entry = None
+        for user_class in self._vertex_classes[vertex.number].partners:
+            available = user_class.available
+            # members that can't be matched with this vertex in particular
+            skipped: list[Tuple[int, int]] = []
+            while (candidate := available.peek()) is not None:
+                number, weight = candidate
+                member = self._graph.vertex(number)
+                if member.matched:
+                    # matched outside of the matchmaker,
+                    # it's pushed back once he's returned
+                    available.pop()
+                    continue
+
+                current_weight = member.mm_settings.current_weight
+                if weight != current_weight:
+                    available.push(number, current_weight)
+                    continue
+
+                if number == vertex.number \
+                        or member.user_id in vertex.disallowed_users \
+                        or vertex.user_id in member.disallowed_users:
+                    skipped.append(available.pop())
+                    continue
+
+                entry = pack_heap_entry(weight, number)
+                if best_entry is None or entry < best_entry:
+                    best_entry = entry
+                break
+
+            for number, weight in skipped:
+                available.push(number, weight)
+
+        if best_entry is None:
+            return None
+        weight, number = unpack_heap_entry(best_entry)
+        return number, weight
+
+    def _add_class(self, key: ClassKey) -> UserClass:
+        logger.info(f"Adding user class {key}")
+        user_class = UserClass(key)
+        self._classes[key] = user_class
+        if connects(key, key):
+            user_class.partners.append(user_class)
+        for other_class in self._classes.values():
+            if other_class is not user_class \
+                    and connects(key, other_class.key) \
+                    and connects(other_class.key, key):
+                user_class.partners.append(other_class)
+                other_class.partners.append(user_class)
+        return user_class
+
+    def _remove_class(self, user_class: UserClass):
+        logger.info(f"Removing empty user class {user_class.key}")
+        del self._classes[user_class.key]
+        for other_class in user_class.partners:
+            if other_class is not user_class:
+                other_class.partners.remove(user_class)
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from multiprocessing.connection import Connection
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+from swipe import config
+from swipe.matchmaking.matchmaker import MatchmakerConfig, \
+    MatchmakingServerClient, start_matchmaker
+from swipe.matchmaking.schemas import Match, MMRoundData
+
+logger = logging.getLogger('matchmaker')
+
+# payload of the request -> result sent back to the matchmaker
+RequestHandler = Callable[[Any], Awaitable[Any]]
+
+
+class PipeServerClient(MatchmakingServerClient):
+    """
+    Calls of the embedded matchmaker to the matchmaking server it runs in.
+    Requests and python objects they return go through pipes,
+    the refill thread has a pipe of its own
+    """
+
+    def __init__(self, connection: Connection,
+                 candidates_connection: Connection):
+        self._connection = connection
+        self._candidates_connection = candidates_connection
+
+    def fetch_round_data(self) -> MMRoundData:
+        return self._request(self._connection, 'round_data')
+
+    def send_matches(self, matches: list[Match]):
+        self._request(self._connection, 'matches', matches)
+
+    def fetch_candidates(self, queries: list[dict]) -> dict[str, list[str]]:
+        return self._request(self._candidates_connection, 'candidates',
+                             queries)
+
+    def fetch_lobby_state(self) -> Tuple[set[str], set[str]]:
+        return self._request(self._connection, 'lobby_state')
+
+    def reconnect_users(self, user_ids: list[str]):
+        self._request(self._connection, 'reconnect_users', user_ids)
+
+    def close(self):
+        self._connection.close()
+        self._candidates_connection.close()
+
+    @staticmethod
+    def _request(connection: Connection, command: str, payload: Any = None):
+        try:
+            connection.send((command, payload))
+            error, result = connection.recv()
+        except (EOFError, BrokenPipeError):
+            # the matchmaker loop survives any exception,
+            # there is nothing left to do without the server
+            logger.error("Matchmaking server is gone, exiting")
+            os._exit(1)
+        if error:
+            raise RuntimeError(f"{command} failed: {error}")
+        return result
+
+
+def run_embedded_matchmaker(connection: Connection,
+                            candidates_connection: Connection,
+                            matchmaker_config: MatchmakerConfig):
+    """
+    Runs the matchmaker of a lobby, every lobby has a process of its own
+    so that matching in one of them doesn't hold up the others
+    """
+    # spawned processes start with the default logging config
+    config.configure_logging()
+    try:
+        start_matchmaker(matchmaker_config, server=PipeServerClient(
+            connection, candidates_connection))
+    except:
+        # the process is started again by the server
+        logger.exception("Matchmaker failed to start, exiting")
+        os._exit(1)
+
+
+class EmbeddedLobby:
+    """
+    Handlers of the requests the matchmaker of a lobby makes,
+    the callback run after the matchmaker has been restarted
+    and the config of the matchmaker
+    """
+
+    def __init__(self, handlers: dict[str, RequestHandler],
+                 on_restart: Callable[[], Awaitable[None]],
+                 matchmaker_config: MatchmakerConfig):
+        self.handlers = handlers
+        self.on_restart = on_restart
+        self.matchmaker_config = matchmaker_config
+
+
+class EmbeddedMatchmaker:
+    """
+    Matchmakers running in child processes of the matchmaking server,
+    so that round data and matches are passed as python objects
+    instead of json over HTTP while matching stays off the event loop.
+    Every lobby of a multi-mode server gets a process of its own,
+    the server shares its event loop, redis connections and lookups
+    between them. Requests of a matchmaker are answered by the handlers
+    of its lobby, the process is started again if it dies
+    """
+
+    RESTART_DELAY_SECS = 1
+
+    def __init__(self, lobbies: dict[str, EmbeddedLobby]):
+        self._lobbies = lobbies
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # mode -> process running the matchmaker of its lobby
+        self._processes: dict[str, multiprocessing.Process] = {}
+        # connection -> mode of the lobby it belongs to
+        self._connections: dict[Connection, str] = {}
+        # mode -> pending start of a lobby whose process has died
+        self._restarts: dict[str, asyncio.TimerHandle] = {}
+
+    @property
+    def pids(self) -> list[int]:
+        return [process.pid for process in self._processes.values()]
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        for mode in self._lobbies:
+            self._start_lobby(mode)
+
+    def stop(self):
+        for restart in self._restarts.values():
+            restart.cancel()
+        self._restarts = {}
+        for mode in list(self._processes):
+            self._stop_lobby(mode)
+
+    def _start_lobby(self, mode: str):
+        # a forked child would inherit the event loop and redis connections
+        context = multiprocessing.get_context('spawn')
+        pipes = [context.Pipe(), context.Pipe()]
+        process = context.Process(
+            target=run_embedded_matchmaker,
+            args=(*(child_end for _, child_end in pipes),
+                  self._lobbies[mode].matchmaker_config),
+            name=f'matchmaker-{mode}' if mode else 'matchmaker',
+            daemon=True)
+        process.start()
+        self._processes[mode] = process
+        logger.info(f"Started embedded matchmaker {process.pid} "
+                    f"of lobby {mode!r}")
+
+        for parent_end, child_end in pipes:
+            child_end.close()
+            self._connections[parent_end] = mode
+            self._loop.add_reader(
+                parent_end.fileno(), self._on_request, parent_end)
+
+    def _stop_lobby(self, mode: str):
+        self._close_connections(mode)
+        process = self._processes.pop(mode)
+        process.terminate()
+        process.join()
+
+    def _on_request(self, connection: Connection):
+        try:
+            command, payload = connection.recv()
+        except EOFError:
+            self._on_exit(self._connections[connection])
+            return
+        self._loop.create_task(self._handle(
+            connection, self._lobbies[self._connections[connection]],
+            command, payload))
+
+    async def _handle(self, connection: Connection, lobby: EmbeddedLobby,
+                      command: str, payload: Any):
+        error, result = None, None
+        try:
+            result = await lobby.handlers[command](payload)
+        except Exception as e:
+            logger.exception(f"Error handling {command} of the matchmaker")
+            error = repr(e)
+
+        if connection in self._connections:
+            connection.send((error, result))
+
+    def _on_exit(self, mode: str):
+        self._close_connections(mode)
+        process = self._processes.pop(mode)
+        process.join()
+        logger.error(f"Embedded matchmaker of lobby {mode!r} exited with "
+                     f"{process.exitcode}, restarting")
+        self._restarts[mode] = self._loop.call_later(
+            self.RESTART_DELAY_SECS, self._restart, mode)
+
+    def _restart(self, mode: str):
+        del self._restarts[mode]
+        self._start_lobby(mode)
+        self._loop.create_task(self._lobbies[mode].on_restart())
+
+    def _close_connections(self, mode: str):
+        for connection, connection_mode in list(self._connections.items()):
+            if connection_mode == mode:
+                self._loop.remove_reader(connection.fileno())
+                connection.close()
+                del self._connections[connection]
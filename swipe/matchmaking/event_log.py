@@ -0,0 +1,135 @@
+import logging
+from typing import Optional, Tuple
+
+import redis
+
+from swipe.matchmaking.schemas import MMRoundData
+from swipe.settings import settings
+
+logger = logging.getLogger('matchmaker')
+
+ROUND_DATA_FIELD = 'round_data'
+# only the changes made by the lobby go to the log
+ROUND_DATA_EXCLUDE = {'sent_matches', 'online_users'}
+
+
+def merge_round_data(round_data: MMRoundData, update: MMRoundData):
+    """
+    Adds the update to the round data the same way
+    the matchmaking server accumulates lobby events between rounds
+    """
+    round_data.new_users.update(update.new_users)
+    round_data.returning_users.update(update.returning_users)
+    round_data.disconnected_users.update(update.disconnected_users)
+    round_data.decline_pairs.extend(update.decline_pairs)
+
+
+class RoundDataStream:
+    """
+    Lobby events written by the matchmaking server to a redis stream.
+    Entries are read through a consumer group and acknowledged
+    once the matchmaker has processed them, unacknowledged ones
+    are read again after a restart.
+    Entries of a failed round are read again right away, after
+    max_attempts they are moved to the dead-letter stream and acknowledged
+    """
+
+    def __init__(self, redis_client: redis.Redis,
+                 stream: str = settings.MATCHMAKING_EVENT_STREAM,
+                 group: str = 'matchmaker', consumer: str = 'matchmaker',
+                 max_attempts: int = settings.MATCHMAKING_EVENT_MAX_ATTEMPTS):
+        self._redis = redis_client
+        self._stream = stream
+        self._dead_letter_stream = f'{stream}_dead_letter'
+        self._group = group
+        self._consumer = consumer
+        self._max_attempts = max_attempts
+        # pending entries of the previous run go first
+        self._last_id = '0'
+        # entries of the last read, id -> fields
+        self._entries: dict[str, dict] = {}
+        # entries of a failed round to be read again
+        self._failed_entries: dict[str, dict] = {}
+        self._attempts = 0
+
+        try:
+            self._redis.xgroup_create(stream, group, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+            logger.info(f"Consumer group {group} of {stream} already exists")
+
+    def read(self, block_secs: Optional[float] = None) \
+            -> Tuple[MMRoundData, list[str]]:
+        """
+        Returns everything that has been written since the last read
+        merged into one round data and the ids of the entries,
+        waits up to block_secs for the first entry if there are none.
+        Entries of a failed round are returned again on their own
+        """
+        if self._failed_entries:
+            return self._merge(self._failed_entries)
+
+        response = self._redis.xreadgroup(
+            self._group, self._consumer, {self._stream: self._last_id},
+            # zero would block forever
+            block=None if block_secs is None
+            else max(1, int(block_secs * 1000)))
+        entries = response[0][1] if response else []
+        if self._last_id != '>' and not entries:
+            logger.info("No pending entries left, reading new ones")
+            self._last_id = '>'
+            return self.read(block_secs)
+
+        return self._merge(dict(entries))
+
+    def ack(self, entry_ids: list[str]):
+        if entry_ids:
+            self._redis.xack(self._stream, self._group, *entry_ids)
+        self._failed_entries = {}
+        self._attempts = 0
+
+    def fail(self, entry_ids: list[str]):
+        """
+        Marks the entries of the last read as not processed
+        """
+        if not entry_ids:
+            return
+        self._failed_entries = {
+            entry_id: self._entries[entry_id] for entry_id in entry_ids}
+        self._attempts += 1
+        if self._attempts < self._max_attempts:
+            logger.warning(f"Round of {len(entry_ids)} entries failed "
+                           f"{self._attempts} times, reading them again")
+            return
+
+        logger.error(f"Round of entries {entry_ids} failed "
+                     f"{self._attempts} times, moving them "
+                     f"to {self._dead_letter_stream}")
+        pipe = self._redis.pipeline()
+        for entry_id, fields in self._failed_entries.items():
+            if fields:
+                pipe.xadd(self._dead_letter_stream,
+                          {**fields, 'entry_id': entry_id})
+        pipe.xack(self._stream, self._group, *entry_ids)
+        try:
+            pipe.execute()
+        except redis.RedisError:
+            # they are read and moved again with the next round
+            logger.exception("Could not move the entries")
+            return
+        self._failed_entries = {}
+        self._attempts = 0
+
+    def _merge(self, entries: dict[str, dict]) \
+            -> Tuple[MMRoundData, list[str]]:
+        self._entries = entries
+        round_data = MMRoundData()
+        for entry_id, fields in entries.items():
+            if not fields:
+                logger.error(f"Entry {entry_id} has been trimmed "
+                             f"before it was processed")
+                continue
+            merge_round_data(round_data, MMRoundData.parse_raw(
+                fields[ROUND_DATA_FIELD]))
+        return round_data, list(entries)
@@ -0,0 +1,496 @@
+import heapq
+import logging
+from typing import Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+
+from swipe.matchmaking.schemas import MMSettings
+from swipe.settings import settings
+
+logger = logging.getLogger('matchmaker')
+
+# vertex numbers are packed into the low bits of heap entries
+NUMBER_BITS = 32
+NUMBER_MASK = (1 << NUMBER_BITS) - 1
+
+# two bits per edge
+CONNECTED = 1
+BIDIRECTIONAL = 2
+EDGE_MASK = CONNECTED | BIDIRECTIONAL
+PAIRS_PER_BYTE = 4
+PAIR_SHIFTS = np.arange(0, 8, 2, dtype=np.uint8)
+
+
+def pack_heap_entry(weight: int, number: int) -> int:
+    """
+    Packs a weight and a vertex number into a single int,
+    entries with bigger weights are smaller so that heapq works as a maxheap
+    """
+    return (-weight << NUMBER_BITS) | number
+
+
+def unpack_heap_entry(entry: int) -> Tuple[int, int]:
+    """
+    Returns the weight and the vertex number of a heap entry
+    """
+    return -(entry >> NUMBER_BITS), entry & NUMBER_MASK
+
+
+class CandidateHeap:
+    """
+    Bidirectional connections of a vertex ordered by the partner weight.
+    Outdated entries are not removed right away, they are dropped
+    when they reach the top of the heap
+    """
+    __slots__ = ('_heap', '_weights')
+
+    # heap is rebuilt once it has this many outdated entries
+    COMPACTION_THRESHOLD = 64
+
+    def __init__(self):
+        # packed weight and vertex number
+        self._heap: list[int] = []
+        # vertex number -> weight of the only valid entry of that vertex
+        self._weights: dict[int, int] = {}
+
+    def __len__(self):
+        return len(self._weights)
+
+    def push(self, number: int, weight: int):
+        if self._weights.get(number) == weight:
+            return
+
+        self._weights[number] = weight
+        heapq.heappush(self._heap, pack_heap_entry(weight, number))
+        if len(self._heap) - len(self._weights) > self.COMPACTION_THRESHOLD:
+            self._compact()
+
+    def discard(self, number: int):
+        self._weights.pop(number, None)
+
+    def peek(self) -> Optional[Tuple[int, int]]:
+        """
+        Returns the number and the weight of the heaviest candidate
+        without removing it
+        """
+        while self._heap:
+            weight, number = unpack_heap_entry(self._heap[0])
+            if self._weights.get(number) == weight:
+                return number, weight
+            heapq.heappop(self._heap)
+        return None
+
+    def pop(self) -> Optional[Tuple[int, int]]:
+        """
+        Removes and returns the number and the weight
+        of the heaviest candidate
+        """
+        while self._heap:
+            weight, number = unpack_heap_entry(heapq.heappop(self._heap))
+            if self._weights.get(number) == weight:
+                del self._weights[number]
+                return number, weight
+        return None
+
+    def _compact(self):
+        self._heap = [
+            entry for entry in self._heap
+            if self._weights.get(entry & NUMBER_MASK) == -(entry >> NUMBER_BITS)
+        ]
+        heapq.heapify(self._heap)
+
+    def __repr__(self):
+        return f'{sorted(self._weights.items(), key=lambda item: -item[1])}'
+
+
+class Vertex:
+    __slots__ = ('user_id', 'number', 'mm_settings', 'matched', 'candidates',
+                 'disallowed_users', '_graph', '_processed_round',
+                 '_waiting_round')
+
+    def __init__(self, user_id: str, mm_settings: MMSettings,
+                 disallowed_users: set[str]):
+        # current settings
+        self.mm_settings = mm_settings
+        self.user_id = user_id
+        # assigned when the vertex is added to a graph
+        self.number: Optional[int] = None
+        self._graph: Optional['ConnectionGraph'] = None
+        # rounds of the graph the vertex was processed in
+        # and is skipping, flags of the older rounds don't count
+        self._processed_round = -1
+        self._waiting_round = -1
+        # got a match previous round in call or waiting for accept
+        # skipping this round
+        self.matched = False
+        # bidirectional edges ordered by the partner weight
+        self.candidates = CandidateHeap()
+
+        # temporary blacklist
+        self.disallowed_users = disallowed_users
+
+    @property
+    def processed(self) -> bool:
+        """
+        Used during current round in the generate_matches
+        """
+        return self._processed_round == self._graph.round
+
+    @processed.setter
+    def processed(self, processed: bool):
+        self._processed_round = self._graph.round if processed else -1
+
+    @property
+    def waiting(self) -> bool:
+        """
+        Skipping this round
+        """
+        return self._waiting_round == self._graph.round
+
+    @waiting.setter
+    def waiting(self, waiting: bool):
+        self._waiting_round = self._graph.round if waiting else -1
+
+    @property
+    def edges(self) -> dict[str, bool]:
+        """
+        user_id -> bidirectional T|F
+        """
+        return {self._graph.vertex(number).user_id: bidirectional
+                for number, bidirectional in self._graph.edges(self.number)}
+
+    def connect(self, user_id: str, bidirectional: bool = False):
+        number = self._graph[user_id].number
+        self._graph.connect(self.number, number, bidirectional)
+        if not bidirectional:
+            self.candidates.discard(number)
+
+    def bi_connects_to(self, user_id: str) -> Optional[bool]:
+        if (other := self._graph.get(user_id)) is None:
+            return None
+        return self._graph.bi_connects_to(self.number, other.number)
+
+    def disconnect(self, user_id: str):
+        if (other := self._graph.get(user_id)) is None:
+            return
+        self._graph.disconnect(self.number, other.number)
+        self.candidates.discard(other.number)
+
+    def disallow(self, user_id: str):
+        self.disallowed_users.add(user_id)
+
+    def can_connect_to(self, other: 'Vertex'):
+        """
+        True if the other vertex matches the filtering criteria
+        of the current vertex
+        :param other:
+        :return:
+        """
+        if other.user_id in self.disallowed_users:
+            logger.info(
+                f"{other.user_id} connection to {self.user_id} is not allowed")
+            return False
+
+        min_age = self.mm_settings.age - self.mm_settings.age_diff
+        max_age = self.mm_settings.age + self.mm_settings.age_diff
+        return min_age <= other.mm_settings.age <= max_age \
+               and (self.mm_settings.gender_filter is None or
+                    self.mm_settings.gender_filter == other.mm_settings.gender)
+
+    def __repr__(self):
+        if settings.MATCHMAKING_DEBUG_MODE:
+            return f'[{self.user_id}, {self.edges}, ' \
+                   f'disallowed:{self.disallowed_users} ' \
+                   f'matched: {self.matched}, waiting: {self.waiting}]\n'
+        else:
+            return f'Vertex: {self.user_id}, matched: {self.matched}'
+
+
+class ConnectionGraph:
+    """
+    Vertices of the matchmaking graph interned to dense numbers.
+    Edges of every vertex are kept by the numbers of its partners,
+    two bits per edge, connected and bidirectional, so that memory and
+    the work done per vertex grow with its degree and not with the lobby.
+    Numbers of removed vertices are reused by new ones.
+    Processed and waiting flags of the vertices belong to the current round,
+    they are all cleared at once by moving on to the next one
+    """
+
+    def __init__(self, capacity: int = 1024):
+        capacity = max(PAIRS_PER_BYTE, capacity)
+        # user_id -> vertex, in the order they were added
+        self._vertices: dict[str, Vertex] = {}
+        self._numbered: list[Optional[Vertex]] = [None] * capacity
+        self._free_numbers: list[int] = []
+        # number of vertex numbers that have ever been used
+        self._size = 0
+        # number of directed edges, a bidirectional edge counts twice
+        self._edge_count = 0
+        # generation of the per-round vertex flags
+        self.round = 0
+        self._init_edges(capacity)
+
+    def __len__(self):
+        return len(self._vertices)
+
+    def __contains__(self, user_id: str):
+        return user_id in self._vertices
+
+    def __iter__(self):
+        return iter(self._vertices)
+
+    def __getitem__(self, user_id: str) -> Vertex:
+        return self._vertices[user_id]
+
+    def get(self, user_id: str) -> Optional[Vertex]:
+        return self._vertices.get(user_id)
+
+    def items(self):
+        return self._vertices.items()
+
+    def values(self):
+        return self._vertices.values()
+
+    @property
+    def edge_count(self) -> int:
+        return self._edge_count
+
+    @property
+    def capacity(self) -> int:
+        return len(self._numbered)
+
+    @property
+    def free_numbers(self) -> list[int]:
+        return self._free_numbers
+
+    @property
+    def size(self) -> int:
+        """
+        Number of vertex numbers that have ever been used
+        """
+        return self._size
+
+    def vertex(self, number: int) -> Optional[Vertex]:
+        return self._numbered[number]
+
+    def next_round(self):
+        self.round += 1
+
+    def add(self, vertex: Vertex):
+        if self._free_numbers:
+            number = self._free_numbers.pop()
+        else:
+            if self._size == len(self._numbered):
+                self._grow()
+            number = self._size
+            self._size += 1
+
+        vertex.number = number
+        vertex._graph = self
+        self._numbered[number] = vertex
+        self._vertices[vertex.user_id] = vertex
+
+    def restore(self, vertices: list[Vertex], numbers: Iterable[int],
+                size: int, free_numbers: list[int]):
+        """
+        Fills an empty graph with vertices under the numbers
+        they had when the snapshot was taken
+        """
+        while len(self._numbered) < size:
+            self._grow()
+        for vertex, number in zip(vertices, numbers):
+            vertex.number = number
+            vertex._graph = self
+            self._numbered[number] = vertex
+            self._vertices[vertex.user_id] = vertex
+        self._size = size
+        self._free_numbers = list(free_numbers)
+
+    def remove(self, user_id: str):
+        if (vertex := self._vertices.pop(user_id, None)) is None:
+            return
+
+        number = vertex.number
+        # dropping edges in both directions,
+        # so that the number can be safely given to a new vertex
+        self._clear_edges(number)
+        self._numbered[number] = None
+        self._free_numbers.append(number)
+
+    def connect(self, number_1: int, number_2: int, bidirectional: bool):
+        edges = self._outgoing.setdefault(number_1, {})
+        if number_2 not in edges:
+            self._edge_count += 1
+            if number_1 in self._outgoing.get(number_2, ()):
+                self._one_way_incoming[number_1].discard(number_2)
+            else:
+                self._one_way_incoming.setdefault(
+                    number_2, set()).add(number_1)
+        edges[number_2] = \
+            CONNECTED | BIDIRECTIONAL if bidirectional else CONNECTED
+
+    def connect_pair(self, number_1: int, number_2: int):
+        """
+        Connects two vertices both ways
+        """
+        edges_1 = self._outgoing.setdefault(number_1, {})
+        edges_2 = self._outgoing.setdefault(number_2, {})
+        if number_2 in edges_1 or number_1 in edges_2:
+            self.connect(number_1, number_2, True)
+            self.connect(number_2, number_1, True)
+            return
+        # never a one-way edge, so it's not indexed even for a moment
+        edges_1[number_2] = edges_2[number_1] = CONNECTED | BIDIRECTIONAL
+        self._edge_count += 2
+
+    def disconnect(self, number_1: int, number_2: int):
+        if (edges := self._outgoing.get(number_1)) is None \
+                or edges.pop(number_2, None) is None:
+            return
+        self._edge_count -= 1
+        if number_1 in self._outgoing.get(number_2, ()):
+            self._one_way_incoming.setdefault(number_1, set()).add(number_2)
+        else:
+            self._one_way_incoming[number_2].discard(number_1)
+
+    def bi_connects_to(self, number_1: int, number_2: int) -> Optional[bool]:
+        if (edges := self._outgoing.get(number_1)) is None \
+                or (edge := edges.get(number_2)) is None:
+            return None
+        return edge == CONNECTED | BIDIRECTIONAL
+
+    def edges(self, number: int) -> Iterator[Tuple[int, bool]]:
+        """
+        Yields numbers of the vertices the vertex is connected to
+        and whether the connection is bidirectional
+        """
+        for partner_number, edge in \
+                sorted(self._outgoing.get(number, {}).items()):
+            yield partner_number, bool(edge & BIDIRECTIONAL)
+
+    def bidirectional_numbers(self, number: int) -> np.ndarray:
+        return np.array(sorted(
+            partner_number for partner_number, edge
+            in self._outgoing.get(number, {}).items()
+            if edge & BIDIRECTIONAL), dtype=np.int64)
+
+    def degree(self, number: int) -> int:
+        """
+        Number of the vertices the vertex is connected to
+        """
+        return len(self._outgoing.get(number, ()))
+
+    def bidirectional_partners(self, number: int) -> Iterator[Vertex]:
+        for partner_number in self.bidirectional_numbers(number):
+            yield self._numbered[partner_number]
+
+    def _init_edges(self, capacity: int):
+        # vertex number -> partner number -> edge
+        self._outgoing: dict[int, dict[int, int]] = {}
+        # vertex number -> numbers of the vertices connected to it
+        # it is not connected back to, the rest of them are found
+        # in its own edges. Most of the edges go both ways,
+        # so it's much smaller than an index of all the incoming ones
+        self._one_way_incoming: dict[int, set[int]] = {}
+
+    def _clear_edges(self, number: int):
+        outgoing = self._outgoing.pop(number, {})
+        removed = len(outgoing)
+        for partner_number in outgoing:
+            partner_edges = self._outgoing.get(partner_number, {})
+            if partner_edges.pop(number, None) is not None:
+                removed += 1
+            else:
+                self._one_way_incoming[partner_number].discard(number)
+        incoming = self._one_way_incoming.pop(number, set())
+        for partner_number in incoming:
+            del self._outgoing[partner_number][number]
+        self._edge_count -= removed + len(incoming)
+
+    def _grow(self):
+        capacity = len(self._numbered) * 2
+        logger.info(f"Growing connection graph to {capacity}")
+        self._numbered.extend([None] * (capacity - len(self._numbered)))
+        self._grow_edges(capacity)
+
+    def _grow_edges(self, capacity: int):
+        pass
+
+
+class DenseConnectionGraph(ConnectionGraph):
+    """
+    Connection graph with the edges in a square matrix, two bits
+    per vertex pair. Single edges are checked without hashing, but the
+    matrix takes capacity squared / 4 bytes and listing the edges
+    of a vertex scans its whole row, it only pays off in small lobbies
+    where most of the users are connected to each other
+    """
+
+    def connect(self, number_1: int, number_2: int, bidirectional: bool):
+        column, shift = divmod(number_2, PAIRS_PER_BYTE)
+        shift *= 2
+        row = self._rows[number_1]
+        edge = CONNECTED | BIDIRECTIONAL if bidirectional else CONNECTED
+        if not row[column] >> shift & EDGE_MASK:
+            self._edge_count += 1
+        row[column] = row[column] & ~(EDGE_MASK << shift) | edge << shift
+
+    def connect_pair(self, number_1: int, number_2: int):
+        self.connect(number_1, number_2, True)
+        self.connect(number_2, number_1, True)
+
+    def disconnect(self, number_1: int, number_2: int):
+        column, shift = divmod(number_2, PAIRS_PER_BYTE)
+        row = self._rows[number_1]
+        if row[column] >> shift * 2 & EDGE_MASK:
+            self._edge_count -= 1
+        row[column] &= ~(EDGE_MASK << (shift * 2)) & 0xFF
+
+    def bi_connects_to(self, number_1: int, number_2: int) -> Optional[bool]:
+        column, shift = divmod(number_2, PAIRS_PER_BYTE)
+        edge = self._rows[number_1][column] >> (shift * 2) & EDGE_MASK
+        return None if not edge else edge == CONNECTED | BIDIRECTIONAL
+
+    def edges(self, number: int) -> Iterator[Tuple[int, bool]]:
+        edges = self._unpack_row(number)
+        for partner_number in np.flatnonzero(edges):
+            yield int(partner_number), \
+                  bool(edges[partner_number] & BIDIRECTIONAL)
+
+    def bidirectional_numbers(self, number: int) -> np.ndarray:
+        return np.flatnonzero(self._unpack_row(number) & BIDIRECTIONAL)
+
+    def degree(self, number: int) -> int:
+        return int(np.count_nonzero(self._unpack_row(number)))
+
+    def _init_edges(self, capacity: int):
+        self._edges = np.zeros((capacity, capacity // PAIRS_PER_BYTE),
+                               dtype=np.uint8)
+        # python level access to matrix rows is much faster than numpy's
+        self._rows: list[memoryview] = []
+        self._update_rows()
+
+    def _clear_edges(self, number: int):
+        column, shift = divmod(number, PAIRS_PER_BYTE)
+        outgoing = np.count_nonzero(self._unpack_row(number))
+        incoming = np.count_nonzero(
+            self._edges[:self._size, column] >> shift * 2 & EDGE_MASK)
+        self._edge_count -= int(outgoing + incoming)
+        self._edges[number] = 0
+        self._edges[:self._size, column] &= \
+            np.uint8(~(EDGE_MASK << (shift * 2)) & 0xFF)
+
+    def _unpack_row(self, number: int) -> np.ndarray:
+        row = self._edges[number, :-(-self._size // PAIRS_PER_BYTE)]
+        return ((row[:, np.newaxis] >> PAIR_SHIFTS) & EDGE_MASK).ravel()
+
+    def _grow_edges(self, capacity: int):
+        edges = np.zeros((capacity, capacity // PAIRS_PER_BYTE),
+                         dtype=np.uint8)
+        edges[:self._edges.shape[0], :self._edges.shape[1]] = self._edges
+        self._edges = edges
+        self._update_rows()
+
+    def _update_rows(self):
+        self._rows = [row.data for row in self._edges]
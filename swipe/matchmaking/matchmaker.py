@@ -1,263 +1,601 @@
 import heapq
 import logging
+import math
 import secrets
 import time
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass
 from typing import Optional, Iterator, Tuple
 
+import numpy as np
+import redis
 import requests
 
-from swipe.matchmaking.schemas import Match, MMSettings, MMRoundData
+from swipe.matchmaking.compression import ClassGraph
+from swipe.matchmaking.event_log import RoundDataStream
+from swipe.matchmaking.graph import Vertex, ConnectionGraph, \
+    DenseConnectionGraph, pack_heap_entry, unpack_heap_entry
+from swipe.matchmaking.metrics import MatchmakerMetrics, write_metrics
+from swipe.matchmaking.scheduling import RoundScheduler, count_arrivals
+from swipe.matchmaking.schemas import Match, MMRoundData, VertexData
+from swipe.matchmaking.snapshot import decode_snapshot, encode_snapshot, \
+    read_snapshot, write_snapshot
+from swipe.matchmaking.strategies import MatchingStrategy, \
+    MATCHING_STRATEGIES
+from swipe.matchmaking.vectorized import VertexArrays
 from swipe.settings import settings
+from swipe.swipe_server.users.enums import Gender
 
 logger = logging.getLogger('matchmaker')
 
 ROUND_DATA_FETCH_TIMEOUT_SEC = 2
+MATCH_DELIVERY_TIMEOUT_SEC = 2
 
 
-class Vertex:
-    def __init__(self, user_id: str, mm_settings: MMSettings,
-                 disallowed_users: set[str]):
-        # current settings
-        self.mm_settings = mm_settings
-        self.user_id = user_id
-        # used during current round in the generate_matches
-        self.processed = False
-        # got a match previous round in call or waiting for accept
-        # skipping this round
-        self.matched = False
-        # skipping this round
-        self.waiting = False
-        # user_id -> bidirectional T|F
-        self.edges: dict[str, bool] = {}
+# gender, gender_filter, age_diff
+BucketKey = Tuple[Gender, Optional[Gender], int]
 
-        # temporary blacklist
-        self.disallowed_users = disallowed_users
 
-    def connect(self, user_id: str, bidirectional: bool = False):
-        self.edges[user_id] = bidirectional
+class CompatibilityIndex:
+    """
+    Vertices of the connection graph bucketed by age and
+    (gender, gender_filter, age_diff), so that a new vertex is only tested
+    against the buckets it might connect to instead of the whole graph
+    """
 
-    def bi_connects_to(self, user_id: str) -> Optional[bool]:
-        return self.edges.get(user_id)
-
-    def disconnect(self, user_id: str):
-        self.edges.pop(user_id, None)
-
-    def disallow(self, user_id: str):
-        self.disallowed_users.add(user_id)
-
-    def can_connect_to(self, other: 'Vertex'):
+    def __init__(self):
+        # age -> bucket key -> user ids
+        # dicts are used as ordered sets to keep the edge order deterministic
+        self._buckets: dict[int, dict[BucketKey, dict[str, None]]] = \
+            defaultdict(lambda: defaultdict(dict))
+        # user_id -> age and bucket key of an indexed vertex
+        self._locations: dict[str, Tuple[int, BucketKey]] = {}
+        # number of indexed vertices per age_diff
+        self._age_diffs: Counter[int] = Counter()
+
+    def add(self, vertex: Vertex):
+        mm_settings = vertex.mm_settings
+        key = (mm_settings.gender, mm_settings.gender_filter,
+               mm_settings.age_diff)
+        self._buckets[mm_settings.age][key][vertex.user_id] = None
+        self._locations[vertex.user_id] = (mm_settings.age, key)
+        self._age_diffs[mm_settings.age_diff] += 1
+
+    def remove(self, user_id: str):
+        if (location := self._locations.pop(user_id, None)) is None:
+            return
+
+        age, key = location
+        age_buckets = self._buckets[age]
+        del age_buckets[key][user_id]
+        if not age_buckets[key]:
+            del age_buckets[key]
+        if not age_buckets:
+            del self._buckets[age]
+
+        age_diff = key[2]
+        self._age_diffs[age_diff] -= 1
+        if not self._age_diffs[age_diff]:
+            del self._age_diffs[age_diff]
+
+    def update(self, vertex: Vertex):
         """
-        True if the other vertex matches the filtering criteria
-        of the current vertex
-        :param other:
-        :return:
+        Moves the vertex to a new bucket after its age_diff has changed
         """
-        if other.user_id in self.disallowed_users:
-            logger.info(
-                f"{other.user_id} connection to {self.user_id} is not allowed")
-            return False
-
-        min_age = self.mm_settings.age - self.mm_settings.age_diff
-        max_age = self.mm_settings.age + self.mm_settings.age_diff
-        return min_age <= other.mm_settings.age <= max_age \
-               and (self.mm_settings.gender_filter is None or
-                    self.mm_settings.gender_filter == other.mm_settings.gender)
-
-    def __repr__(self):
-        if settings.MATCHMAKING_DEBUG_MODE:
-            return f'[{self.user_id}, {self.edges}, ' \
-                   f'disallowed:{self.disallowed_users} ' \
-                   f'matched: {self.matched}, waiting: {self.waiting}]\n'
-        else:
-            return f'Vertex: {self.user_id}, matched: {self.matched}'
-
+        self.remove(vertex.user_id)
+        self.add(vertex)
 
-class HeapItem:
-    def __init__(self, user_id: str, weight: int):
-        self.user_id = user_id
-        self.weight = weight
+    def candidates(self, vertex: Vertex) -> list[str]:
+        """
+        Returns ids of indexed vertices that can connect to the vertex
+        in at least one direction according to their age and gender.
+        Disallowed users are still filtered by `Vertex.can_connect_to`
+        """
+        mm_settings = vertex.mm_settings
+        age_window = max(mm_settings.age_diff,
+                         max(self._age_diffs, default=0))
+        result = []
+        for age in range(mm_settings.age - age_window,
+                         mm_settings.age + age_window + 1):
+            if (age_buckets := self._buckets.get(age)) is None:
+                continue
 
-    def __lt__(self, other: 'HeapItem'):
-        # yes they are fucking inverted, because I need a maxheap
-        return self.weight > other.weight
+            age_distance = abs(age - mm_settings.age)
+            outgoing = age_distance <= mm_settings.age_diff
+            for (gender, gender_filter, age_diff), user_ids \
+                    in age_buckets.items():
+                if outgoing and (mm_settings.gender_filter is None or
+                                 mm_settings.gender_filter == gender):
+                    # vertex -> other
+                    result.extend(user_ids)
+                elif age_distance <= age_diff and \
+                        (gender_filter is None or
+                         gender_filter == mm_settings.gender):
+                    # other -> vertex
+                    result.extend(user_ids)
+        return result
+
+    def bidirectional_candidates(self, vertex: Vertex) -> Iterator[list[str]]:
+        """
+        Yields ids of indexed vertices that can connect to the vertex
+        in both directions according to their age and gender,
+        a list per age distance starting with the closest
+        """
+        mm_settings = vertex.mm_settings
+        for age_distance in range(mm_settings.age_diff + 1):
+            result = []
+            for age in {mm_settings.age - age_distance,
+                        mm_settings.age + age_distance}:
+                if (age_buckets := self._buckets.get(age)) is None:
+                    continue
+                for (gender, gender_filter, age_diff), user_ids \
+                        in age_buckets.items():
+                    if age_distance <= age_diff \
+                            and (mm_settings.gender_filter is None or
+                                 mm_settings.gender_filter == gender) \
+                            and (gender_filter is None or
+                                 gender_filter == mm_settings.gender):
+                        result.extend(user_ids)
+            if result:
+                yield result
+
+
+class MatchmakingServerClient:
+    """
+    Calls the matchmaker makes to the matchmaking server,
+    the connection is kept alive between rounds
+    """
 
-    def __eq__(self, other: 'HeapItem'):
-        return self.weight == other.weight
+    def __init__(self):
+        self._session = requests.Session()
+
+    def close(self):
+        self._session.close()
+
+    def fetch_round_data(self) -> MMRoundData:
+        response = self._session.get(
+            f'{settings.MATCHMAKING_SERVER_HOST}/new_round_data',
+            timeout=ROUND_DATA_FETCH_TIMEOUT_SEC)
+        return MMRoundData.parse_obj(response.json())
+
+    def send_matches(self, matches: list[Match]):
+        self._session.post(
+            f'{settings.MATCHMAKING_SERVER_HOST}/send_matches',
+            json={
+                'matches': matches
+            }, timeout=MATCH_DELIVERY_TIMEOUT_SEC)
+
+    def fetch_candidates(self, queries: list[dict]) -> dict[str, list[str]]:
+        # called from the refill thread, so it doesn't share the session
+        response = requests.post(
+            f'{settings.MATCHMAKING_SERVER_HOST}/fetch_candidates',
+            json=queries, timeout=settings.MATCHMAKING_REFILL_TIMEOUT_SECS)
+        return response.json()['connections']
+
+    def fetch_lobby_state(self) -> Tuple[set[str], set[str]]:
+        """
+        Online users and users with a sent match
+        """
+        response = self._session.get(
+            f'{settings.MATCHMAKING_SERVER_HOST}/lobby_state',
+            timeout=ROUND_DATA_FETCH_TIMEOUT_SEC)
+        lobby_state = response.json()
+        return set(lobby_state['online_users']), \
+            set(lobby_state['matched_users'])
 
-    def __repr__(self):
-        return f"'{self.user_id}' weight: {self.weight}"
+    def reconnect_users(self, user_ids: list[str]):
+        self._session.post(
+            f'{settings.MATCHMAKING_SERVER_HOST}/reconnect_users',
+            json={'user_ids': user_ids},
+            timeout=ROUND_DATA_FETCH_TIMEOUT_SEC)
 
 
 class Matchmaker:
-    def __init__(self):
+    def __init__(self, vectorized: bool =
+                 settings.MATCHMAKING_VECTORIZED_COMPATIBILITY,
+                 matching_strategy: str =
+                 settings.MATCHMAKING_MATCHING_STRATEGY,
+                 server: Optional[MatchmakingServerClient] = None,
+                 class_graph: bool = settings.MATCHMAKING_CLASS_GRAPH,
+                 edge_budget: int = settings.MATCHMAKING_EDGE_BUDGET,
+                 dense_graph: bool = settings.MATCHMAKING_DENSE_GRAPH):
         # users that got no candidates this round
         # for them I'm fetching new candidates from DB with increased age diff
         self._empty_candidates: set[str] = set()
-        # current connection graph
-        self._connection_graph: dict[str, Vertex] = {}
+        # users that got no match during the last round
+        self._unmatched_users: set[str] = set()
+        # candidates are fetched in the background while the round
+        # is being prepared, the number of users per fetch
+        # depends on how long the previous one took
+        self._refill_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='candidate-refill')
+        self._refill_batch_size = \
+            settings.MATCHMAKING_REFILL_INITIAL_BATCH_SIZE
+        # candidates are fetched from the matchmaking server
+        self._server = server or MatchmakingServerClient()
+        # bidirectional edges shared by the lobby, 0 for no limit
+        self._edge_budget = edge_budget
+        # current connection graph, the matrix is not worth it
+        # when a vertex is connected only to a few others
+        self._connection_graph = DenseConnectionGraph() \
+            if dense_graph and not (class_graph or edge_budget) \
+            else ConnectionGraph()
+        # buckets of the graph vertices used to find potential connections
+        self._compatibility_index = CompatibilityIndex()
+        # batch compatibility checks against the whole graph
+        self._vertex_arrays: Optional[VertexArrays] = \
+            VertexArrays() if vectorized else None
+        # users connected by their classes instead of the vertex edges
+        self._class_graph: Optional[ClassGraph] = \
+            ClassGraph(self._connection_graph) if class_graph else None
+        # picks the pairs among the users of the current round
+        self._matching_strategy: MatchingStrategy = \
+            MATCHING_STRATEGIES[matching_strategy]()
+        # phase timings of the rounds and time to match
+        self.metrics = MatchmakerMetrics()
+        # user_id -> when he became available for matching
+        self._waiting_since: dict[str, float] = {}
+
+    @property
+    def graph(self) -> ConnectionGraph:
+        return self._connection_graph
 
     def run_matchmaking_round(self, incoming_data: MMRoundData) \
             -> Iterator[Match]:
+        round_metrics = self.metrics.start_round('full')
         self.prepare_round(incoming_data)
+        self._unmatched_users = set()
         # put new users to the heap
         # building a heap out of all
         # some users might have disconnected
         logger.info("Building current round heap")
-        # excluding matched, because they haven't returned to lobby
-        # excluding waiting, because they are skipping this round
-        current_round_heap: list[HeapItem] = [
-            HeapItem(user_id, graph_vertex.mm_settings.current_weight)
-            for user_id, graph_vertex in self._connection_graph.items()
-            if not graph_vertex.matched and not graph_vertex.waiting
-        ]
-        heapq.heapify(current_round_heap)
+        with round_metrics.phase('heap'):
+            # excluding matched, because they haven't returned to lobby
+            # excluding waiting, because they are skipping this round
+            # packed weights and vertex numbers
+            current_round_heap: list[int] = [
+                pack_heap_entry(graph_vertex.mm_settings.current_weight,
+                                graph_vertex.number)
+                for graph_vertex in self._connection_graph.values()
+                if not graph_vertex.matched and not graph_vertex.waiting
+            ]
+            heapq.heapify(current_round_heap)
+        round_metrics.values['heap_size'] = len(current_round_heap)
 
         logger.info("Generating matches")
-        yield from self._generate_matches(current_round_heap)
+        matches = 0
+        with round_metrics.phase('generate_matches'):
+            for match in self._matching_strategy.generate_matches(
+                    self, current_round_heap):
+                matches += 1
+                yield match
+
+        # processed and waiting flags of this round are not needed anymore
+        with round_metrics.phase('reset'):
+            self._connection_graph.next_round()
+
+        round_metrics.values.update(
+            graph_size=len(self._connection_graph),
+            edge_count=self._connection_graph.edge_count,
+            matches=matches,
+            unmatched=len(self.unmatched_vertices()))
+        if self._class_graph is not None:
+            round_metrics.values['classes'] = len(self._class_graph)
+        self.metrics.finish_round()
+
+    def run_incremental_round(self, incoming_data: MMRoundData) \
+            -> Iterator[Match]:
+        """
+        Applies the incoming data and looks for matches only for the users
+        it has touched. Weights are not changed and nobody is marked
+        as unmatched, that's left for the next full round
+        """
+        round_metrics = self.metrics.start_round('incremental')
+        affected_users = {*incoming_data.new_users,
+                          *incoming_data.returning_users}
+        for user_a_id, user_b_id in incoming_data.decline_pairs:
+            affected_users.update((user_a_id, user_b_id))
+        self.apply_round_data(incoming_data)
+
+        current_heap: list[int] = []
+        for user_id in affected_users:
+            vertex = self._connection_graph.get(user_id)
+            if vertex and not vertex.matched and not vertex.waiting:
+                current_heap.append(pack_heap_entry(
+                    vertex.mm_settings.current_weight, vertex.number))
+        heapq.heapify(current_heap)
+        logger.info(f"Looking for matches for {len(current_heap)} users")
+
+        round_metrics.values['heap_size'] = len(current_heap)
+
+        matched_vertices: list[Vertex] = []
+        with round_metrics.phase('generate_matches'):
+            while current_heap:
+                _, number = unpack_heap_entry(heapq.heappop(current_heap))
+                current_vertex = self._connection_graph.vertex(number)
+                if current_vertex.processed:
+                    continue
+
+                if match_user_id := self.find_match(current_vertex.user_id):
+                    match_vertex = self._connection_graph[match_user_id]
+                    self.mark_matched(current_vertex, match_vertex)
+                    matched_vertices.extend((current_vertex, match_vertex))
+                    yield current_vertex.user_id, match_user_id
+
+        self._connection_graph.next_round()
 
-        # before the end of the round, reset all processed flags
-        logger.info("Resetting processed flags")
-        self._reset_processed_flags()
+        round_metrics.values.update(
+            graph_size=len(self._connection_graph),
+            edge_count=self._connection_graph.edge_count,
+            matches=len(matched_vertices) // 2)
+        self.metrics.finish_round()
 
     def prepare_round(self, incoming_data: MMRoundData):
+        # fetch new candidates from DB for users who didn't have any matches
+        # last round, while the new data is being applied
+        logger.info(f"Fetching candidates for empty candidates")
+        logger.debug(f"Empty candidates:\n{self._empty_candidates}")
+        with self.metrics.phase('empty_candidates'):
+            refill = self._start_candidate_refill()
+
+        self.apply_round_data(incoming_data)
+
+        logger.info(f"Processing empty candidates")
+        with self.metrics.phase('empty_candidates'):
+            self._process_empty_candidates(refill)
+            self._refresh_edges()
+
+    def apply_round_data(self, incoming_data: MMRoundData):
         # round starts
         # logger.info(f"Round started, current graph\n"
         #             f"{self._connection_graph}")
         logger.info("Clearing match flag on returning users")
         logger.debug(f"Returning users:\n{incoming_data.returning_users}")
         # clear match flag on returning users
-        self._process_returning_users(incoming_data)
+        with self.metrics.phase('returning'):
+            self._process_returning_users(incoming_data)
 
         # remove edges between returning declined users
         logger.info(f"Removing edges between declined users")
         logger.debug(f"Decline pairs:\n{incoming_data.decline_pairs}")
-        self._process_decline_pairs(incoming_data)
+        with self.metrics.phase('declines'):
+            self._process_decline_pairs(incoming_data)
 
         logger.info(f"Processing disconnected users")
         logger.debug(f"Disconnected users:\n{incoming_data.disconnected_users}")
-        self._process_disconnected_users(incoming_data)
+        with self.metrics.phase('disconnects'):
+            self._process_disconnected_users(incoming_data)
 
         # merge incoming user graph with the current graph
-        # at least O(n^2) fuuuuuck
+        # only compatible age/gender buckets are checked
         logger.info(f"Merging new graph with current graph")
         logger.debug(f"New users:\n{incoming_data.new_users}")
-        self._merge_graphs(incoming_data)
+        with self.metrics.phase('merge'):
+            self._merge_graphs(incoming_data)
 
-        # ------------------new data processing done--------------------
-        # fetch new candidates from DB for users who didn't have any matches
-        # last round
-        logger.info(f"Processing empty candidates")
-        logger.debug(f"Empty candidates:\n{self._empty_candidates}")
-        self._process_empty_candidates()
+    def clear(self):
+        """
+        Removes every user, the graph is empty afterwards
+        """
+        self._process_disconnected_users(MMRoundData(
+            disconnected_users=set(self._connection_graph)))
+        self._unmatched_users = set()
 
-    def _generate_matches(self, current_round_heap: list[HeapItem]) \
-            -> Iterator[Match]:
-        heap_size = len(current_round_heap)
-        while heap_size:
-            logger.debug(f"Current heap {current_round_heap}")
-            heap_size -= 1
-
-            # pick heap top
-            current_user = heapq.heappop(current_round_heap)
-            current_user_id = current_user.user_id
-
-            logger.info(f"Got heap head: {current_user}")
-            current_vertex = self._connection_graph[current_user_id]
-
-            # skipping processed vertices
-            if current_vertex.processed:
-                if current_vertex.matched:
-                    logger.info(
-                        f"{current_user_id} already got a match this round")
-                    continue
-                logger.info(f"{current_user_id} was already processed, "
-                            f"but no match was found")
-                continue
+    def close(self):
+        self._refill_executor.shutdown(wait=False)
+        self._server.close()
 
-            # traverse connection graph
-            logger.info(f"Looking for match for {current_user_id}")
-            match_user_id: str = self.find_match(current_user_id)
-
-            if match_user_id:
-                logger.info(
-                    f"Found match {match_user_id} for {current_user_id}")
-                match_vertex = self._connection_graph[match_user_id]
-
-                logger.info(f"Resetting weight on "
-                            f"{match_user_id} and {current_user_id}")
-                # set both weights to 0 for next round
-                current_vertex.mm_settings.reset_weight()
-                match_vertex.mm_settings.reset_weight()
-
-                logger.info(f"Marking {match_user_id} and {current_user_id} "
-                            f"as processed and matched")
-                current_vertex.matched = True
-                match_vertex.matched = True
-                # mark both as processed, so they are skipped next iteration
-                current_vertex.processed = True
-                match_vertex.processed = True
-
-                yield current_user_id, match_user_id
-            else:
-                logger.info(f"No matches found for {current_user}, "
-                            f"increasing weight, marking as processed")
-                # add to empty so that we fetch more candidates next round
-                self._empty_candidates.add(current_user_id)
-                current_vertex.processed = True
-                current_vertex.mm_settings.increase_weight()
-                current_vertex.mm_settings.increase_age_diff()
-
-    def find_match(self, user_id: str):
+    def mark_matched(self, *vertices: Vertex):
+        """
+        Takes both vertices of a match, or the one in this graph
+        when the partner is matched by another shard
+        """
+        user_ids = [vertex.user_id for vertex in vertices]
+        logger.info(f"Resetting weight on {user_ids}, "
+                    f"marking them as processed and matched")
+        now = time.monotonic()
+        for vertex in vertices:
+            # set weights to 0 for next round
+            vertex.mm_settings.reset_weight()
+            self._set_matched(vertex)
+            # mark as processed, so it's skipped next iteration
+            vertex.processed = True
+            # a vertex rematched by the strategy is counted once
+            if (waiting_since := self._waiting_since.pop(
+                    vertex.user_id, None)) is not None:
+                self.metrics.observe_time_to_match(now - waiting_since)
+
+    def mark_unmatched(self, vertex: Vertex):
+        logger.info(f"No matches found for {vertex.user_id}, "
+                    f"increasing weight, marking as processed")
+        # add to empty so that we fetch more candidates next round,
+        # the classes connect him to everyone in his widened window
+        # without fetching them
+        if self._class_graph is None:
+            self._empty_candidates.add(vertex.user_id)
+        self._unmatched_users.add(vertex.user_id)
+        vertex.processed = True
+        vertex.mm_settings.increase_weight()
+        self._update_candidate_weight(vertex)
+        vertex.mm_settings.increase_age_diff()
+        self._compatibility_index.update(vertex)
+        if self._class_graph is not None:
+            self._class_graph.update(vertex)
+        if self._vertex_arrays is not None:
+            self._vertex_arrays.update(vertex.user_id, vertex.mm_settings)
+
+    def seed(self, users: dict[str, VertexData], matched_users: set[str]):
+        """
+        Adds the users of a matchmaker that has been lost,
+        the ones in a call are left out until they return
+        """
+        self.apply_round_data(MMRoundData(new_users=users))
+        for user_id in matched_users:
+            if vertex := self._connection_graph.get(user_id):
+                # not a new match, nothing to count
+                self._set_matched(vertex)
+                self._waiting_since.pop(user_id, None)
+        logger.info(f"Seeded {len(users)} users, "
+                    f"{len(matched_users)} of them are in a call")
+
+    def find_match(self, user_id: str) -> Optional[str]:
         current_vertex = self._connection_graph[user_id]
-
-        # some of the edges might be gone by now
-        logger.info(f"Filtering dead connections of {user_id}")
-        potential_edges: list[Tuple[str, bool]] = list(filter(  # noqa
-            lambda item: item[0] in self._connection_graph,
-            current_vertex.edges.items()))
+        candidates = current_vertex.candidates
+        if logger.isEnabledFor(logging.DEBUG):
+            # printing the heap is linear in its size
+            logger.debug(f"Potential edges of {user_id}:\n{candidates}")
+
+        # candidates that can not be matched right now, but they
+        # will be available once they're back from their calls
+        postponed: list[Tuple[int, int]] = []
+        match_user_id = None
+        match_entry = 0
         # getting candidate with the most weight
-        # TODO might be a good idea to maintain a maxheap, instead of sorting
-        # on EACH iteration
-        potential_edges.sort(
-            key=lambda item: self._connection_graph[
-                item[0]].mm_settings.current_weight,
-            reverse=True)
-        current_vertex.edges = dict(potential_edges)
-
-        logger.debug(f"Potential edges of {user_id}:\n{potential_edges}")
-        for potential_match_id, _ in potential_edges:
-            logger.info(f"Checking {potential_match_id}, {user_id}")
-            # TODO just for debug, remove logging in prod
-            vertex_matched = \
-                self._connection_graph[potential_match_id].matched
-            vertex_blocked = \
-                potential_match_id in current_vertex.disallowed_users
-            can_connect = current_vertex.bi_connects_to(potential_match_id)
-            logger.info(
-                f"Vertex {potential_match_id}. Matched: {vertex_matched}, "
-                f"Blocked: {vertex_blocked}, can connect: {can_connect}")
-            # if the edge is bidirectional -> we got a match
-            if not vertex_matched and not vertex_blocked and can_connect:
-                return potential_match_id
-
-        return None
+        while (candidate := candidates.pop()) is not None:
+            number, weight = candidate
+            potential_match = self._connection_graph.vertex(number)
+            # some of the edges might be gone by now
+            if potential_match is None or not self._connection_graph \
+                    .bi_connects_to(current_vertex.number, number):
+                logger.info(f"Dropping dead connection {number} "
+                            f"of {user_id}")
+                continue
+
+            potential_match_id = potential_match.user_id
+            if potential_match_id in current_vertex.disallowed_users:
+                logger.info(f"Vertex {potential_match_id} is blocked "
+                            f"for {user_id}, dropping")
+                continue
+
+            current_weight = potential_match.mm_settings.current_weight
+            if weight != current_weight:
+                # weight was reset after a match, putting it back in order
+                candidates.push(number, current_weight)
+                continue
+
+            postponed.append(candidate)
+            logger.info(f"Checking {potential_match_id}, {user_id}. "
+                        f"Matched: {potential_match.matched}")
+            if not potential_match.matched:
+                match_user_id = potential_match_id
+                match_entry = pack_heap_entry(weight, number)
+                break
+
+        for number, weight in postponed:
+            candidates.push(number, weight)
+
+        if self._class_graph is not None and \
+                (class_match := self._class_graph.find_match(current_vertex)):
+            # most of the vertices are linked only through their classes
+            number, weight = class_match
+            if match_user_id is None \
+                    or pack_heap_entry(weight, number) < match_entry:
+                match_user_id = self._connection_graph.vertex(number).user_id
+        return match_user_id
+
+    def vertex_edge_budget(self) -> Optional[int]:
+        """
+        Number of bidirectional edges a vertex picks when it joins the graph
+        or runs out of candidates, None without the edge budget
+        """
+        if not self._edge_budget:
+            return None
+        return max(self._edge_budget // max(len(self._connection_graph), 1),
+                   settings.MATCHMAKING_EDGE_BUDGET_MIN_PER_USER)
+
+    def partner_numbers(self, vertex: Vertex) -> np.ndarray:
+        """
+        Numbers of the vertices the vertex is connected to
+        in both directions
+        """
+        if self._class_graph is not None:
+            return self._class_graph.partner_numbers(vertex)
+        return self._connection_graph.bidirectional_numbers(vertex.number)
+
+    def dump_snapshot(self) -> bytes:
+        """
+        Graph and the users waiting for candidates, taken between rounds
+        """
+        return encode_snapshot(self._connection_graph,
+                               self._empty_candidates, self._unmatched_users)
+
+    def restore_snapshot(self, snapshot: bytes, online_users: set[str],
+                         matched_users: set[str]) -> set[str]:
+        """
+        Replaces the current state with the snapshot and reconciles it
+        with the lobby of the matchmaking server: users that have left
+        are removed, users without a sent match are back from their calls.
+        Returns online users that are missing from the snapshot
+        """
+        graph = type(self._connection_graph)()
+        empty_candidates, unmatched_users = decode_snapshot(snapshot, graph)
+
+        self._connection_graph = graph
+        self._empty_candidates = empty_candidates
+        self._unmatched_users = unmatched_users
+        self._compatibility_index = CompatibilityIndex()
+        if self._vertex_arrays is not None:
+            self._vertex_arrays = VertexArrays()
+        if self._class_graph is not None:
+            self._class_graph = ClassGraph(graph)
+        for vertex in graph.values():
+            for partner in graph.bidirectional_partners(vertex.number):
+                vertex.candidates.push(
+                    partner.number, partner.mm_settings.current_weight)
+            self._compatibility_index.add(vertex)
+            if self._vertex_arrays is not None:
+                self._vertex_arrays.add(vertex.user_id, vertex.mm_settings)
+            if vertex.matched and vertex.user_id not in matched_users:
+                vertex.matched = False
+            if self._class_graph is not None:
+                self._class_graph.add(vertex)
+
+        self._process_disconnected_users(MMRoundData(
+            disconnected_users={user_id for user_id in graph
+                                if user_id not in online_users}))
+        logger.info(f"Restored {len(graph)} users from the snapshot")
+        return {user_id for user_id in online_users if user_id not in graph}
 
     def get_vertex(self, user_a):
         return self._connection_graph[user_a]
 
+    def unmatched_vertices(self) -> list[Vertex]:
+        """
+        Vertices that got no match during the last round
+        """
+        return [vertex for user_id in self._unmatched_users
+                if (vertex := self._connection_graph.get(user_id))
+                and not vertex.matched]
+
+    def _set_matched(self, vertex: Vertex):
+        vertex.matched = True
+        if self._class_graph is not None:
+            self._class_graph.discard(vertex)
+
     def _connect_vertices(self, vertex_1: Vertex, vertex_2: Vertex):
-        if vertex_1.can_connect_to(vertex_2):
-            if vertex_2.can_connect_to(vertex_1):
+        self._link_vertices(vertex_1, vertex_2,
+                            vertex_1.can_connect_to(vertex_2),
+                            vertex_2.can_connect_to(vertex_1))
+
+    def _link_vertices(self, vertex_1: Vertex, vertex_2: Vertex,
+                       forward: bool, backward: bool):
+        if forward:
+            if backward:
                 logger.info(f"{vertex_2.user_id} "
                             f"can connect both ways to {vertex_1.user_id}")
-                vertex_1.connect(vertex_2.user_id, True)
-                vertex_2.connect(vertex_1.user_id, True)
+                self._connection_graph.connect_pair(
+                    vertex_1.number, vertex_2.number)
+                vertex_1.candidates.push(
+                    vertex_2.number, vertex_2.mm_settings.current_weight)
+                vertex_2.candidates.push(
+                    vertex_1.number, vertex_1.mm_settings.current_weight)
             else:
                 logger.info(f"{vertex_1.user_id} "
                             f"can connect to {vertex_2.user_id}")
                 vertex_1.connect(vertex_2.user_id, False)
         else:
-            if vertex_2.can_connect_to(vertex_1):
+            if backward:
                 logger.info(f"{vertex_2.user_id} "
                             f"can connect to {vertex_1.user_id}")
                 vertex_2.connect(vertex_1.user_id, False)
@@ -265,11 +603,23 @@ class Matchmaker:
                 logger.info(f"{vertex_2.user_id} and {vertex_1.user_id}"
                             f"can not connect to each other")
 
+    def _update_candidate_weight(self, vertex: Vertex):
+        # a stale lower weight might hide the vertex in the heaps
+        # of its partners, so an increased weight is pushed right away.
+        # Resets are fixed when the partners pop the outdated entries
+        if self._class_graph is not None:
+            self._class_graph.push(vertex)
+        for partner in self._connection_graph.bidirectional_partners(
+                vertex.number):
+            partner.candidates.push(
+                vertex.number, vertex.mm_settings.current_weight)
+
     def _process_disconnected_users(self, incoming_data: MMRoundData):
         for user_id in incoming_data.disconnected_users:
             logger.info(f"{user_id} disconnected during previous round, "
                         f"removing him from the old and new graphs")
             incoming_data.new_users.pop(user_id, None)
+            self._waiting_since.pop(user_id, None)
             if user_id in self._empty_candidates:
                 self._empty_candidates.remove(user_id)
 
@@ -277,20 +627,24 @@ class Matchmaker:
                 # he might have connected during wait time and disconnected
                 continue
 
-            for connection_user_id \
-                    in self._connection_graph[user_id].edges.keys():
-                logger.info(
-                    f"Removing connection {connection_user_id} to {user_id}")
-                self._connection_graph[connection_user_id].disconnect(user_id)
-
+            # his entries in the candidates of the partners are dropped
+            # once they are popped, the removed edges tell they're dead
             logger.info(f"Removing {user_id} from the graph")
-            del self._connection_graph[user_id]
+            if self._class_graph is not None:
+                self._class_graph.remove(self._connection_graph[user_id])
+            self._compatibility_index.remove(user_id)
+            if self._vertex_arrays is not None:
+                self._vertex_arrays.remove(user_id)
+            self._connection_graph.remove(user_id)
 
     def _process_returning_users(self, incoming_data: MMRoundData):
         for user_id in incoming_data.returning_users:
             # enable edges
             logger.info(f"{user_id}: setting 'matched' to False")
             self._connection_graph[user_id].matched = False
+            if self._class_graph is not None:
+                self._class_graph.push(self._connection_graph[user_id])
+            self._waiting_since[user_id] = time.monotonic()
             if partner_id := incoming_data.returning_users.get(user_id):
                 logger.info(f"Adding {partner_id} to {user_id} disallowed list")
                 # if he's returning after a successful call
@@ -315,6 +669,11 @@ class Matchmaker:
 
             self._connection_graph[user_b_id].matched = False
             # self._connection_graph[user_b_id].waiting = True
+            if self._class_graph is not None:
+                self._class_graph.push(self._connection_graph[user_a_id])
+                self._class_graph.push(self._connection_graph[user_b_id])
+            self._waiting_since[user_a_id] = \
+                self._waiting_since[user_b_id] = time.monotonic()
 
     def _merge_graphs(self, incoming_data: MMRoundData):
         for incoming_user_id, incoming_vertex \
@@ -342,54 +701,191 @@ class Matchmaker:
                 user_id=incoming_vertex.user_id,
                 mm_settings=incoming_vertex.mm_settings,
                 disallowed_users=incoming_vertex.disallowed_users)
-            # add to graph
-            for user_id, graph_vertex in self._connection_graph.items():
-                logger.info(f"Connecting {incoming_user_id} to {user_id}")
-                self._connect_vertices(incoming_vertex, graph_vertex)
-
+            # the vertex gets its number before it's linked to the graph,
+            # it's not in the index or the arrays yet,
+            # so it won't be linked to itself
             logger.info(f"Adding {incoming_vertex.user_id} to graph")
-            self._connection_graph[incoming_user_id] = incoming_vertex
+            self._connection_graph.add(incoming_vertex)
+            self._waiting_since[incoming_user_id] = time.monotonic()
+            if self._class_graph is not None:
+                # only his class is connected to the others
+                self._class_graph.add(incoming_vertex)
+            elif (budget := self.vertex_edge_budget()) is not None:
+                self._link_to_budget(incoming_vertex, budget)
+            elif self._vertex_arrays is not None:
+                for user_id, forward, backward in \
+                        self._vertex_arrays.connections(
+                            incoming_vertex, self._connection_graph):
+                    self._link_vertices(
+                        incoming_vertex, self._connection_graph[user_id],
+                        forward, backward)
+            else:
+                for user_id in self._compatibility_index.candidates(
+                        incoming_vertex):
+                    logger.info(f"Connecting {incoming_user_id} to {user_id}")
+                    self._connect_vertices(
+                        incoming_vertex, self._connection_graph[user_id])
+
+            self._compatibility_index.add(incoming_vertex)
+            if self._vertex_arrays is not None:
+                self._vertex_arrays.add(
+                    incoming_user_id, incoming_vertex.mm_settings)
 
         logger.info(f"Graphs merged")
         logger.debug(f"Current graph\n{self._connection_graph.values()}")
 
-    def _process_empty_candidates(self, max_candidates=10):
-        while self._empty_candidates and max_candidates > 0:
-            max_candidates -= 1
+    def _link_to_budget(self, vertex: Vertex, budget: int):
+        """
+        Connects the vertex to the most valuable of the compatible vertices
+        that are not in a call: the closest by age and then the heaviest ones.
+        Users of the same age are taken in the order they have joined,
+        only twice as many of them as needed are compared by weight.
+        Vertices that already have twice the budget are skipped,
+        so that nobody gets connected to the whole lobby.
+        Edges of the vertex to the rest of them are evicted
+        """
+        graph = self._connection_graph
+        max_degree = 2 * budget
+        partners: list[Vertex] = []
+        for user_ids in self._compatibility_index.bidirectional_candidates(
+                vertex):
+            needed = budget - len(partners)
+            same_distance = []
+            for user_id in user_ids:
+                if user_id == vertex.user_id \
+                        or user_id in vertex.disallowed_users:
+                    continue
+                other = graph[user_id]
+                if other.matched \
+                        or vertex.user_id in other.disallowed_users \
+                        or graph.degree(other.number) >= max_degree \
+                        and not graph.bi_connects_to(vertex.number,
+                                                     other.number):
+                    continue
+                same_distance.append(other)
+                if len(same_distance) == 2 * needed:
+                    break
+
+            if len(same_distance) >= needed:
+                partners.extend(heapq.nsmallest(
+                    needed, same_distance,
+                    key=lambda other: (-other.mm_settings.current_weight,
+                                       other.number)))
+                break
+            partners.extend(same_distance)
+
+        partner_numbers = {partner.number for partner in partners}
+        for number in graph.bidirectional_numbers(vertex.number):
+            if number not in partner_numbers:
+                evicted = graph.vertex(number)
+                logger.info(f"Evicting edge of {vertex.user_id} "
+                            f"to {evicted.user_id}")
+                vertex.disconnect(evicted.user_id)
+                evicted.disconnect(vertex.user_id)
+
+        for partner in partners:
+            if not graph.bi_connects_to(vertex.number, partner.number):
+                self._link_vertices(vertex, partner, True, True)
+
+    def _refresh_edges(self):
+        # with the edge budget the candidates are taken from the graph
+        # instead of the database, vertices that have run dry
+        # pick the best of them again
+        if (budget := self.vertex_edge_budget()) is None:
+            return
+
+        refreshed = 0
+        while self._empty_candidates \
+                and refreshed < settings.MATCHMAKING_REFILL_MAX_BATCH_SIZE:
+            if vertex := self._connection_graph.get(
+                    self._empty_candidates.pop()):
+                self._link_to_budget(vertex, budget)
+                refreshed += 1
+        logger.info(f"Refreshed edges of {refreshed} users, "
+                    f"{len(self._empty_candidates)} are left for later")
+
+    def _start_candidate_refill(self) \
+            -> Optional[Future[dict[str, list[str]]]]:
+        if self._edge_budget:
+            # refreshed from the graph by _refresh_edges
+            return None
+
+        queries = []
+        while self._empty_candidates \
+                and len(queries) < self._refill_batch_size:
             user_id: str = self._empty_candidates.pop()
-            vertex = self._connection_graph.get(user_id, None)
+            if vertex := self._connection_graph.get(user_id):
+                queries.append({
+                    'user_id': user_id,
+                    'user_age': vertex.mm_settings.age,
+                    'gender_filter': vertex.mm_settings.gender_filter,
+                    'session_id': vertex.mm_settings.session_id
+                })
+        if not queries:
+            return None
+
+        logger.info(f"Fetching candidates for {len(queries)} users, "
+                    f"{len(self._empty_candidates)} are left for later")
+        return self._refill_executor.submit(self._fetch_candidates, queries)
+
+    def _fetch_candidates(self, queries: list[dict]) -> dict[str, list[str]]:
+        # runs in the refill thread
+        start = time.monotonic()
+        try:
+            connections = self._server.fetch_candidates(queries)
+        except:
+            logger.exception(f"Error getting candidates for "
+                             f"{len(queries)} users")
+            self._update_refill_batch_size(math.inf)
+            return {}
+
+        self._update_refill_batch_size(time.monotonic() - start)
+        return connections
+
+    def _update_refill_batch_size(self, fetch_time: float):
+        # the batch grows while the fetch takes less than a half
+        # of the timeout and shrinks once it gets close to it
+        timeout = settings.MATCHMAKING_REFILL_TIMEOUT_SECS
+        if fetch_time < timeout / 2:
+            self._refill_batch_size = min(
+                self._refill_batch_size * 2,
+                settings.MATCHMAKING_REFILL_MAX_BATCH_SIZE)
+        elif fetch_time > timeout * 0.8:
+            self._refill_batch_size = max(self._refill_batch_size // 2, 1)
+
+    def _process_empty_candidates(
+            self, refill: Optional[Future[dict[str, list[str]]]]):
+        if refill is None:
+            return
+
+        for user_id, connections in refill.result().items():
+            vertex = self._connection_graph.get(user_id)
             if not vertex:
                 # user could have been removed from the graph
-                # because he disconnected
-                # but this should not be possible, as I'm removing disconnected
-                # users from the empty candidates set before that
+                # because he disconnected while the candidates were fetched
                 logger.info(f"{user_id} is not in the graph anymore, skipping")
                 continue
-            try:
-                response = requests.get(
-                    f'{settings.MATCHMAKING_SERVER_HOST}/fetch_candidates',
-                    params={
-                        'user_id': user_id,
-                        'user_age': vertex.mm_settings.age,
-                        'gender_filter': vertex.mm_settings.gender_filter,
-                        'session_id': vertex.mm_settings.session_id
-                    }, timeout=1)
-
-                json_data = response.json()
-                connections = json_data['connections']
-                if not connections:
-                    logger.debug(f"Got no candidates for {user_id}, "
-                                 f"resetting session_id")
-                    # in case we reached max age limit and still get no
-                    # candidates, reset the session_id to start fetching
-                    # starting with the default age difference
-                    vertex.mm_settings.session_id = secrets.token_urlsafe(16)
-                    continue
-            except:
-                logger.exception(f"Error getting candidates for user {user_id}")
-                connections = []
+            if not connections:
+                logger.debug(f"Got no candidates for {user_id}, "
+                             f"resetting session_id")
+                # in case we reached max age limit and still get no
+                # candidates, reset the session_id to start fetching
+                # starting with the default age difference
+                vertex.mm_settings.session_id = secrets.token_urlsafe(16)
+                continue
 
             logger.info(f"Got new candidates for {user_id}: {connections}")
+            if self._vertex_arrays is not None:
+                for connection_user_id, forward, backward in \
+                        self._vertex_arrays.connections(
+                            vertex, self._connection_graph, connections):
+                    logger.info(f"Connecting {connection_user_id} "
+                                f"to {vertex.user_id}")
+                    self._link_vertices(
+                        self._connection_graph[connection_user_id], vertex,
+                        backward, forward)
+                continue
+
             for connection_user_id in connections:
                 # new fetched user already in graph
                 # otherwise he's not in matchmaking -> not adding
@@ -399,49 +895,197 @@ class Matchmaker:
                                 f"to {vertex.user_id}")
                     self._connect_vertices(reverse_vertex, vertex)
 
-    def _reset_processed_flags(self):
-        for user_id, vertex in self._connection_graph.items():
-            if vertex.processed:
-                # reset all processed flags
-                vertex.processed = False
-            elif vertex.waiting:
-                # available for next round
-                vertex.waiting = False
 
-
-def start_matchmaker(round_length_secs: int = 5):
+@dataclass
+class MatchmakerConfig:
+    """
+    Mode of the matchmaker started by `start_matchmaker`.
+    Full rounds run every round_length_secs, with target_p95_secs
+    the length of every round is picked by `RoundScheduler` to keep
+    the time it takes users to get a match under the target instead.
+    In the event-driven mode the new data is fetched every
+    poll_interval_secs and matched right away for the users it touches,
+    full rounds are still needed to age the weights of waiting users.
+    With the event log the data is read from a redis stream
+    instead of /new_round_data, in the event-driven mode
+    the matchmaker waits for the events instead of sleeping.
+    With snapshot_path the state is saved every
+    MATCHMAKING_SNAPSHOT_INTERVAL_SECS and restored on startup.
+    With metrics_path the round metrics are written there as json
+    after every cycle
+    """
+    round_length_secs: float = 5
+    shards: int = 1
+    event_driven: bool = False
+    poll_interval_secs: float = settings.MATCHMAKING_EVENT_POLL_INTERVAL_SECS
+    event_log: bool = False
+    event_stream: str = settings.MATCHMAKING_EVENT_STREAM
+    snapshot_path: Optional[str] = None
+    metrics_path: Optional[str] = None
+    target_p95_secs: float = 0
+
+    def __post_init__(self):
+        if self.shards > 1:
+            unsupported = [name for name, enabled in (
+                ('the event-driven mode', self.event_driven),
+                ('snapshots', self.snapshot_path),
+                ('scheduled rounds', self.target_p95_secs)) if enabled]
+            if unsupported:
+                raise ValueError(f"Sharded matchmaker has no "
+                                 f"{', '.join(unsupported)}")
+        if self.event_driven and self.target_p95_secs:
+            raise ValueError("Rounds of the event-driven matchmaker "
+                             "are not scheduled")
+
+    @classmethod
+    def from_settings(cls, **overrides) -> 'MatchmakerConfig':
+        return cls(**{
+            'round_length_secs': settings.MATCHMAKING_ROUND_LENGTH_SECS,
+            'shards': settings.MATCHMAKING_SHARDS,
+            'event_driven': bool(settings.MATCHMAKING_EVENT_DRIVEN),
+            'event_log': bool(settings.MATCHMAKING_EVENT_LOG_ENABLED),
+            'snapshot_path': settings.MATCHMAKING_SNAPSHOT_PATH,
+            'metrics_path': settings.MATCHMAKING_METRICS_PATH,
+            'target_p95_secs':
+                settings.MATCHMAKING_TARGET_P95_TIME_TO_MATCH_SECS,
+            **overrides
+        })
+
+
+def start_matchmaker(config: MatchmakerConfig,
+                     server: Optional[MatchmakingServerClient] = None):
+    """
+    Runs the matchmaker in the mode of the config.
+    The matchmaking server is called over HTTP unless another
+    server client is given
+    """
     logger.info("Starting matchmaker")
     bar = "-" * 100
-    matchmaker = Matchmaker()
+    server = server or MatchmakingServerClient()
+    round_length_secs = config.round_length_secs
+    event_driven = config.event_driven
+    poll_interval_secs = config.poll_interval_secs
+    if config.shards > 1:
+        # sharding module depends on this one
+        from swipe.matchmaking.sharding import ShardedMatchmaker
+        matchmaker = ShardedMatchmaker(config.shards)
+    else:
+        matchmaker = Matchmaker(server=server)
+
+    round_data_stream: Optional[RoundDataStream] = None
+    if config.event_log:
+        round_data_stream = RoundDataStream(redis.Redis.from_url(
+            settings.REDIS_URL, decode_responses=True), config.event_stream)
+
+    if not event_driven:
+        cycle_length_secs = round_length_secs
+    elif round_data_stream:
+        cycle_length_secs = 0
+    else:
+        cycle_length_secs = poll_interval_secs
+    scheduler: Optional[RoundScheduler] = None
+    if config.target_p95_secs:
+        scheduler = RoundScheduler(
+            config.target_p95_secs,
+            min_round_length_secs=settings.MATCHMAKING_MIN_ROUND_LENGTH_SECS,
+            max_round_length_secs=settings.MATCHMAKING_MAX_ROUND_LENGTH_SECS)
+        cycle_length_secs = scheduler.round_length_secs
+    if config.snapshot_path:
+        try:
+            _restore_matchmaker(matchmaker, server, config.snapshot_path)
+        except:
+            logger.exception("Could not restore the snapshot, starting cold")
+            matchmaker = Matchmaker(server=server)
+
+    last_round_start = 0.0
+    last_snapshot = time.time()
+    cycle_start: Optional[float] = None
     while True:
-        cycle_start = time.time()
+        last_cycle_start, cycle_start = cycle_start, time.time()
+        full_round = not event_driven \
+                     or cycle_start - last_round_start >= round_length_secs
 
-        logger.info(bar)
+        if full_round:
+            logger.info(bar)
+        entry_ids: list[str] = []
         try:
-            logger.info("Fetching new data from the matchmaker server")
-            response = requests.get(
-                f'{settings.MATCHMAKING_SERVER_HOST}/new_round_data',
-                timeout=ROUND_DATA_FETCH_TIMEOUT_SEC)
-            json_data = response.json()
-
-            incoming_data: MMRoundData = MMRoundData.parse_obj(json_data)
+            if round_data_stream:
+                block_secs = None if full_round else min(
+                    poll_interval_secs,
+                    last_round_start + round_length_secs - cycle_start)
+                incoming_data, entry_ids = \
+                    round_data_stream.read(block_secs=block_secs)
+            else:
+                logger.info("Fetching new data from the matchmaker server")
+                incoming_data = server.fetch_round_data()
             logger.debug(f"New round data\n"
                          f"{incoming_data.repr_matchmaking()}")
 
-            for user_a, user_b \
-                    in matchmaker.run_matchmaking_round(incoming_data):
-                logger.info(f"Sending match {user_a}, {user_b}")
-                requests.post(
-                    f'{settings.MATCHMAKING_SERVER_HOST}/send_match',
-                    json={
-                        'match': [user_a, user_b]
-                    })
+            if full_round:
+                last_round_start = cycle_start
+                matches = matchmaker.run_matchmaking_round(incoming_data)
+            else:
+                matches = matchmaker.run_incremental_round(incoming_data)
+
+            matches = list(matches)
+            if matches:
+                logger.info(f"Sending {len(matches)} matches: {matches}")
+                server.send_matches(matches)
+            if round_data_stream:
+                round_data_stream.ack(entry_ids)
+
+            if config.snapshot_path and cycle_start - last_snapshot \
+                    >= settings.MATCHMAKING_SNAPSHOT_INTERVAL_SECS:
+                last_snapshot = cycle_start
+                snapshot_start = time.time()
+                snapshot = matchmaker.dump_snapshot()
+                write_snapshot(config.snapshot_path, snapshot)
+                logger.info(f"Saved a snapshot of {len(snapshot)} bytes "
+                            f"in {time.time() - snapshot_start}s")
+
+            if config.metrics_path:
+                logger.info(f"Round phases: "
+                            f"{matchmaker.metrics.current_round.phases}")
+                write_metrics(config.metrics_path, matchmaker.metrics)
+
+            if scheduler:
+                round_metrics = matchmaker.metrics.current_round
+                elapsed_secs = cycle_start - last_cycle_start \
+                    if last_cycle_start else 0
+                cycle_length_secs = scheduler.observe_round(
+                    elapsed_secs, time.time() - cycle_start,
+                    arrivals=count_arrivals(incoming_data),
+                    unmatched_users=round_metrics.values['unmatched'],
+                    times_to_match=round_metrics.times_to_match)
         except:
             logger.exception("Error during a matchmaking round")
+            if entry_ids:
+                # read again with the next cycle a few times
+                # before they are moved to the dead-letter stream
+                round_data_stream.fail(entry_ids)
 
         time_taken = time.time() - cycle_start
-        sleep_time = max(0.0, round_length_secs - time_taken)
+        sleep_time = max(0.0, cycle_length_secs - time_taken)
         logger.info(
             f"Round took {time_taken}s, "
             f"time till the next cycle: {sleep_time}")
         time.sleep(sleep_time)
+
+
+def _restore_matchmaker(matchmaker: Matchmaker,
+                        server: MatchmakingServerClient, snapshot_path: str):
+    snapshot = read_snapshot(
+        snapshot_path, settings.MATCHMAKING_SNAPSHOT_MAX_AGE_SECS)
+    if snapshot is None:
+        return
+
+    online_users, matched_users = server.fetch_lobby_state()
+    missing_users = matchmaker.restore_snapshot(
+        snapshot, online_users, matched_users)
+
+    if missing_users:
+        # they have connected after the snapshot was taken,
+        # the server sends them again as new users
+        logger.info(f"Reconnecting {len(missing_users)} users "
+                    f"that are missing from the snapshot")
+        server.reconnect_users(list(missing_users))
@@ -1,10 +1,14 @@
 import asyncio
 import datetime
+import json
 import logging
+import os
 import secrets
+from typing import Iterable, Optional, Tuple, Union
+from uuid import UUID
 
 import requests
-from fastapi import FastAPI, Body, Query
+from fastapi import APIRouter, FastAPI, Body, Query
 from fastapi import WebSocket
 from pydantic import BaseModel
 from starlette.requests import Request
@@ -12,12 +16,18 @@ from starlette.responses import Response
 from starlette.websockets import WebSocketDisconnect
 from uvicorn import Config, Server
 
-from swipe.matchmaking.schemas import MMBasePayload, MMMatchPayload, \
+from swipe.matchmaking.embedded import EmbeddedMatchmaker, EmbeddedLobby
+from swipe.matchmaking.event_log import ROUND_DATA_FIELD, \
+    ROUND_DATA_EXCLUDE, merge_round_data
+from swipe.matchmaking.matchmaker import MatchmakerConfig
+from swipe.matchmaking.recording import RoundRecorder
+from swipe.matchmaking.schemas import Match, MMBasePayload, MMMatchPayload, \
     MMResponseAction, MMLobbyPayload, MMLobbyAction, MMSettings, MMRoundData, \
-    MMChatPayload, MMChatAction, MMAckType, MMOutPayload, MMAckPayload
+    MMChatPayload, MMChatAction, MMAckType, MMOutPayload, MMAckPayload, \
+    MMCandidatesQuery, relay_target
+from swipe.matchmaking.shared_lobby import SharedLobby
 from swipe.middlewares import CorrelationIdMiddleware
 from swipe.settings import settings
-from swipe.swipe_server.chats.services import ChatService
 from swipe.swipe_server.misc import dependencies
 from swipe.swipe_server.misc.errors import SwipeError
 from swipe.swipe_server.users.enums import Gender
@@ -26,11 +36,13 @@ from swipe.swipe_server.users.schemas import OnlineFilterBody
 from swipe.swipe_server.users.services.blacklist_service import BlacklistService
 from swipe.swipe_server.users.services.fetch_service import FetchUserService
 from swipe.swipe_server.users.services.online_cache import \
-    RedisMatchmakingOnlineUserService
+    OnlineMatchmakingUserCacheParams, RedisMatchmakingOnlineUserService
 from swipe.swipe_server.users.services.redis_services import \
-    RedisChatCacheService, RedisBlacklistService
+    RedisChatCacheService, RedisBlacklistService, \
+    RedisMatchmakingPreviewService
 from swipe.swipe_server.users.services.user_service import UserService
-from swipe.ws_connection import MMUserData, ConnectedUser, WSConnectionManager
+from swipe.ws_connection import MMUserData, ConnectedUser, \
+    WSConnectionManager, PayloadEncoder
 
 logger = logging.getLogger(__name__)
 
@@ -63,297 +75,558 @@ async def docs(json_data: MMBasePayload = Body(..., examples={
 
 loop = asyncio.get_event_loop()
 
-matchmaking_data = MMRoundData()
-connection_manager = WSConnectionManager()
-
+# shared by the lobbies of all the modes
 redis_client = dependencies.redis()
 redis_online = RedisMatchmakingOnlineUserService(redis_client)
 redis_chats = RedisChatCacheService(redis_client)
 redis_blacklist = RedisBlacklistService(redis_client)
+redis_preview = RedisMatchmakingPreviewService(redis_client)
 fetch_service = FetchUserService(
     RedisMatchmakingOnlineUserService(redis_client),
     redis_client)
 
 
-@app.websocket("/connect/{user_id}")
-async def matchmaker_endpoint(
-        user_id: str, websocket: WebSocket,
-        gender: Gender = Query(None)):
-    user: User
-    try:
-        user = await _init_user(user_id, gender, websocket)
-        logger.info(f"{user_id}, rounded age: {user.age}, "
-                    f"gender: {user.gender}"
-                    f"connected with filter: {gender}")
-    except:
-        logger.exception(f"Error connecting user {user_id}")
-        await websocket.close(1003)
-        return
-
-    while True:
+def for_mode(name: Optional[str], mode: str) -> Optional[str]:
+    """
+    Name of the file or the redis key of the lobby of the mode,
+    a single lobby keeps the name as it is
+    """
+    if not name or not mode:
+        return name
+    root, extension = os.path.splitext(name)
+    return f'{root}_{mode}{extension}'
+
+
+class Lobby:
+    """
+    Users matched with each other in one mode, video, audio or text.
+    Lobbies of a server have their own connections, round data and
+    matchmakers, redis connections, candidate lookups and the database
+    are shared between them.
+    With a shared lobby, online users and sent matches are kept in redis
+    for every instance of the server, payloads for users connected
+    to another instance are sent through it
+    """
+
+    def __init__(self, mode: str = ''):
+        self.mode = mode
+        self.matchmaking_data = MMRoundData()
+        self.connection_manager = WSConnectionManager()
+        # keeps the order of entries in the event log
+        self.round_data_lock = asyncio.Lock()
+        self.event_stream = for_mode(settings.MATCHMAKING_EVENT_STREAM, mode)
+        # everything handed out to the matchmaker and sent back,
+        # for offline replays
+        record_path = for_mode(settings.MATCHMAKING_RECORD_PATH, mode)
+        self.round_recorder = RoundRecorder(record_path) \
+            if record_path else None
+        self.shared_lobby = SharedLobby(
+            redis_client,
+            for_mode(settings.MATCHMAKING_SHARED_LOBBY_KEY, mode)) \
+            if settings.MATCHMAKING_SHARED_LOBBY else None
+
+    async def serve(self, user_id: str, websocket: WebSocket,
+                    gender: Optional[Gender]):
+        user: User
         try:
-            data: dict = await websocket.receive_json()
+            user = await self.init_user(user_id, gender, websocket)
+            logger.info(f"{user_id}, rounded age: {user.age}, "
+                        f"gender: {user.gender}"
+                        f"connected with filter: {gender}")
+        except:
+            logger.exception(f"Error connecting user {user_id}")
+            await websocket.close(1003)
+            return
+
+        while True:
+            try:
+                text = await websocket.receive_text()
+                data: dict = json.loads(text)
+            except WebSocketDisconnect as e:
+                logger.info(f"{user_id} disconnected with code {e.code}, "
+                            f"removing him from matchmaking")
+                await redis_online.remove_from_online_caches(user)
+                await self.process_disconnect(user_id)
+                await self.publish_round_data()
+                return
+
+            if settings.MATCHMAKING_RELAY_SIGNALING \
+                    and (target := relay_target(data)):
+                await self.relay(text, *target)
+                continue
+
             logger.info(f"Received data {data} from {user_id}")
-        except WebSocketDisconnect as e:
-            logger.info(f"{user_id} disconnected with code {e.code}, "
-                        f"removing him from matchmaking")
-            await redis_online.remove_from_online_caches(user)
-            await _process_disconnect(user_id)
+            try:
+                base_payload: MMBasePayload = MMBasePayload.validate(data)
+            except:
+                logger.exception(f"Invalid message: {data}")
+                continue
+
+            try:
+                await self.process_payload(
+                    base_payload,
+                    self.connection_manager.get_user_data(user_id))
+                await self.publish_round_data()
+            except:
+                logger.exception(f"Error processing payload {base_payload}")
+                await self.send_ack(
+                    base_payload.sender_id, base_payload.request_id,
+                    success=False)
+                continue
+            else:
+                await self.send_ack(
+                    base_payload.sender_id, base_payload.request_id)
+
+            if base_payload.recipient_id:
+                # does not raise, so we're safe
+                await self.send(
+                    base_payload.recipient_id,
+                    base_payload.dict(by_alias=True, exclude_unset=True))
+
+    async def publish_round_data(self):
+        """
+        Moves the changes made to the lobby to the matchmaker event log,
+        the round data is copied and cleared with no awaits in between.
+        If the log can't be written they are put back to go
+        with the next changes
+        """
+        if not settings.MATCHMAKING_EVENT_LOG_ENABLED:
             return
 
-        try:
-            base_payload: MMBasePayload = MMBasePayload.validate(data)
-        except:
-            logger.exception(f"Invalid message: {data}")
-            continue
+        matchmaking_data = self.matchmaking_data
+        async with self.round_data_lock:
+            if not any((matchmaking_data.new_users,
+                        matchmaking_data.returning_users,
+                        matchmaking_data.disconnected_users,
+                        matchmaking_data.decline_pairs)):
+                return
+
+            published_data = MMRoundData.construct(
+                new_users=matchmaking_data.new_users,
+                returning_users=matchmaking_data.returning_users,
+                disconnected_users=matchmaking_data.disconnected_users,
+                decline_pairs=matchmaking_data.decline_pairs)
+            round_data = published_data.json(exclude=ROUND_DATA_EXCLUDE)
+            matchmaking_data.clear()
+            try:
+                await redis_client.xadd(
+                    self.event_stream,
+                    {ROUND_DATA_FIELD: round_data},
+                    maxlen=settings.MATCHMAKING_EVENT_STREAM_MAX_LENGTH,
+                    approximate=True)
+            except:
+                # changes made in the meantime go after these
+                merge_round_data(published_data, matchmaking_data)
+                matchmaking_data.clear()
+                merge_round_data(matchmaking_data, published_data)
+                raise
+            if self.round_recorder:
+                self.round_recorder.record_round(round_data)
+
+    async def relay(self, text: str, sender_id: str, recipient_id: str,
+                    request_id: Optional[str]):
+        """
+        Forwards a signaling payload to the recipient as it came,
+        nothing in the lobby depends on it
+        """
+        logger.debug(f"Relaying payload of {sender_id} to {recipient_id}")
+        await self.send_ack(sender_id, request_id)
+        await self.send_text(recipient_id, text)
+
+    async def send_ack(self, sender_id: str,
+                       request_id: Optional[Union[UUID, str]],
+                       success: bool = True):
+        if not request_id:
+            return
 
         try:
-            await _process_payload(base_payload,
-                                   connection_manager.get_user_data(user_id))
+            logger.info(f"Sending ack={success} payload "
+                        f"to request_id={request_id}")
+            out_payload = MMOutPayload(payload=MMAckPayload(
+                type=MMAckType.ACK if not success else MMAckType.ACK_FAILED,
+                request_id=request_id,
+                timestamp=datetime.datetime.utcnow(),
+            ))
+            await self.connection_manager.send(
+                str(sender_id), out_payload.dict(by_alias=True),
+                raise_on_disconnect=True)
         except:
-            logger.exception(f"Error processing payload {base_payload}")
-            await _send_ack(base_payload, success=False)
-            continue
-        else:
-            await _send_ack(base_payload)
-
-        if base_payload.recipient_id:
-            # does not raise, so we're safe
-            await connection_manager.send(
-                base_payload.recipient_id,
-                base_payload.dict(by_alias=True, exclude_unset=True))
-
-
-async def _send_ack(payload: MMBasePayload, success: bool = True):
-    if not payload.request_id:
-        return
-
-    try:
-        logger.info(
-            f"Sending ack={success} payload to request_id={payload.request_id}")
-        out_payload = MMOutPayload(payload=MMAckPayload(
-            type=MMAckType.ACK if not success else MMAckType.ACK_FAILED,
-            request_id=payload.request_id,
-            timestamp=datetime.datetime.utcnow(),
-        ))
-        await connection_manager.send(
-            str(payload.sender_id), out_payload.dict(by_alias=True),
-            raise_on_disconnect=True)
-    except:
-        logger.exception(
-            f"Unable to send ack payload to {payload.sender_id},"
-            f"request={payload.request_id}")
-
-
-async def _init_user(user_id: str, gender: Gender,
-                     websocket: WebSocket) -> User:
-    with dependencies.db_context(expire_on_commit=False) as session:
-        # loading only date_of_birth and gender
-        user_service, chat_service = UserService(session), ChatService(session)
-        if (user := user_service.get_matchmaking_preview(user_id)) is None:
-            raise SwipeError(f"User {user_id} not found")
-
-    await redis_online.add_to_online_caches(user)
-
-    connected_user = ConnectedUser(
-        user_id=user_id, connection=websocket,
-        data=MMUserData(age=user.age, gender_filter=gender, gender=user.gender))
-    await connection_manager.connect(connected_user)
-    return user
-
-
-async def _process_disconnect(user_id: str):
-    matchmaking_data.disconnect(user_id)
-    await connection_manager.disconnect(user_id)
-
-    # we need to keep track of sent matches so that we could
-    # send decline/reconnect events if one of the users disconnects
-
-    # A disconnects on a match screen or on call
-    if match := matchmaking_data.get_match(user_id):
-        logger.info(f"{user_id} is matched with {match.user_id}")
-
-        match_status = matchmaking_data.get_match(match.user_id)
-        if match_status.accepted and match.accepted:
-            # they are on call, send B reconnect signal
-            logger.info(
-                f"{user_id} and {match.user_id} were on call, "
-                f"sending reconnect to {match.user_id}")
-            reconnect = MMLobbyPayload(action=MMLobbyAction.RECONNECT)
-            await connection_manager.send(
-                match.user_id,
-                MMBasePayload(
-                    sender_id=user_id,
-                    recipient_id=match.user_id,
-                    payload=reconnect).dict(by_alias=True))
-        else:
-            # B is also on the match screen
-            logger.info(f"{match.user_id} is on a match screen, "
-                        f"sending decline")
-            decline = MMMatchPayload(action=MMResponseAction.DECLINE)
-            await connection_manager.send(
-                match.user_id,
-                MMBasePayload(
-                    sender_id=user_id,
-                    recipient_id=match.user_id,
-                    payload=decline).dict(by_alias=True))
-
-            logger.info(f"Reconnecting {match.user_id} to matchmaking")
-            matchmaking_data.reconnect(match.user_id)
-
-        logger.info(f"Removing {user_id} from sent matches")
-        matchmaking_data.remove_match(user_id)
-
-        logger.info(
-            f"Removing {match.user_id}, match of {user_id}"
-            f"from sent matches")
-        matchmaking_data.remove_match(match.user_id)
-
-
-async def _process_payload(base_payload: MMBasePayload, user_data: MMUserData):
-    data_payload = base_payload.payload
-    sender_id = base_payload.sender_id
-    recipient_id = base_payload.recipient_id
-
-    if isinstance(data_payload, MMMatchPayload):
-        if data_payload.action == MMResponseAction.ACCEPT:
-            logger.info(f"{sender_id} accepted match")
-            matchmaking_data.accept_match(sender_id)
-        elif data_payload.action == MMResponseAction.DECLINE:
-            # one decline -> put both back to MM
-            logger.info(
-                f"Got decline from {sender_id}, "
-                f"placing him and {recipient_id} "
-                f"back to matchmaker, removing from sent matches")
-            matchmaking_data.reconnect_decline(sender_id, recipient_id)
-            matchmaking_data.remove_match(sender_id)
-            matchmaking_data.remove_match(recipient_id)
-
-            # a decline means we add them to each others blacklist
-            if settings.MATCHMAKING_BLACKLIST_ENABLED:
-                with dependencies.db_context() as session:
-                    blacklist_service = BlacklistService(session, redis_client)
-                    # even though we remove the graph edges,
-                    # these users still have to be removed
-                    # from each other's online lists
-                    await blacklist_service.update_blacklist(
-                        sender_id, recipient_id,
-                        send_blacklist_event=True)
-    elif isinstance(data_payload, MMLobbyPayload):
-        if data_payload.action == MMLobbyAction.CONNECT:
-            # user joined the lobby
-            mm_settings = MMSettings(
-                age=user_data.age,
-                gender=user_data.gender,
-                gender_filter=user_data.gender_filter,
-                session_id=secrets.token_urlsafe(16))
-            logger.info(f"Connecting {sender_id} to matchmaking, "
-                        f"settings: {mm_settings}")
-            logger.info(f"Current online users {matchmaking_data.online_users}")
-
-            # there boys and girls and helicopters are loaded in the chat server
-            chat_partners: set[str] = \
-                await redis_chats.get_chat_partners(sender_id)
-            logger.info(f"Chat partners for {sender_id}: {chat_partners}")
-
-            blacklist: set[str] = \
-                await redis_blacklist.get_blacklist(sender_id)
-            logger.info(f"Blacklist of {sender_id}: {blacklist}")
-
-            disallowed_users = chat_partners.union(blacklist)
-
-            connections = await fetch_service.collect(
-                sender_id,
-                user_age=mm_settings.age,
-                filter_params=OnlineFilterBody(
-                    session_id=mm_settings.session_id,
-                    gender=mm_settings.gender_filter,
-                    limit=settings.MATCHMAKING_FETCH_LIMIT
-                ),
-                disallowed_users=disallowed_users)
-            logger.info(f"Got possible connections for "
-                        f"{sender_id}: {connections}, "
-                        f"disallowed_users: {disallowed_users}")
-            matchmaking_data.connect(
-                sender_id, mm_settings, connections,
-                disallowed_users=disallowed_users)
-        elif data_payload.action == MMLobbyAction.RECONNECT:
-            # sender_id ended a call (pressed 'next')
-            # if recipient_id is None then this reconnect payload comes
-            # from the other guy
-            # A sends reconnect to server+B
-            # B receives reconnect and sends it back without recipient_id
-            # TODO this is dumb but it's easier to do it this way now
-            if recipient_id:
-                logger.info(f"Reconnecting pair "
-                            f"[{sender_id}, {recipient_id}] after call")
-                matchmaking_data.reconnect_after_call(sender_id, recipient_id)
-                logger.info(f"Resulting returning users"
-                            f"{matchmaking_data.returning_users}")
-    elif isinstance(data_payload, MMChatPayload):
-        if data_payload.action == MMChatAction.ACCEPT:
+            logger.exception(
+                f"Unable to send ack payload to {sender_id},"
+                f"request={request_id}")
+
+    async def init_user(self, user_id: str, gender: Gender,
+                        websocket: WebSocket) -> User:
+        # users reconnect between calls, the database is queried
+        # only when the preview is missing from redis
+        if (user := await redis_preview.get_preview(user_id)) is None:
+            with dependencies.db_context(expire_on_commit=False) as session:
+                # loading only date_of_birth and gender
+                user_service = UserService(session)
+                if (user := user_service.get_matchmaking_preview(user_id)) \
+                        is None:
+                    raise SwipeError(f"User {user_id} not found")
+            await redis_preview.cache_preview(user)
+
+        await redis_online.add_to_online_caches(user)
+
+        connected_user = ConnectedUser(
+            user_id=user_id, connection=websocket,
+            data=MMUserData(
+                age=user.age, gender_filter=gender, gender=user.gender))
+        await self.connection_manager.connect(connected_user)
+        if self.shared_lobby:
+            await self.shared_lobby.register(user_id, connected_user.data)
+        return user
+
+    async def process_disconnect(self, user_id: str):
+        self.matchmaking_data.disconnect(user_id)
+        await self.connection_manager.disconnect(user_id)
+        if self.shared_lobby:
+            await self.shared_lobby.disconnect(user_id)
+        await self.cancel_match(user_id)
+
+    async def process_lost_users(self, users: dict[str, MMUserData]):
+        """
+        Users of a stopped instance of the shared lobby, they are
+        disconnected the same way the instance would have done it
+        """
+        logger.info(f"Disconnecting {len(users)} users "
+                    f"of a stopped instance")
+        await redis_online.remove_users_from_online_caches({
+            user_id: OnlineMatchmakingUserCacheParams(
+                age=user_data.age, gender=user_data.gender)
+            for user_id, user_data in users.items()
+        })
+        self.matchmaking_data.disconnected_users.update(users)
+        for user_id in users:
+            await self.cancel_match(user_id)
+        await self.publish_round_data()
+
+    async def cancel_match(self, user_id: str):
+        matchmaking_data = self.matchmaking_data
+        # we need to keep track of sent matches so that we could
+        # send decline/reconnect events if one of the users disconnects
+
+        # A disconnects on a match screen or on call
+        if match := await self.get_match(user_id):
+            logger.info(f"{user_id} is matched with {match.user_id}")
+
+            # the match of B is gone if another instance of a shared
+            # lobby has cancelled it in the meantime
+            match_status = await self.get_match(match.user_id)
+            if match_status and match_status.accepted and match.accepted:
+                # they are on call, send B reconnect signal
+                logger.info(
+                    f"{user_id} and {match.user_id} were on call, "
+                    f"sending reconnect to {match.user_id}")
+                reconnect = MMLobbyPayload(action=MMLobbyAction.RECONNECT)
+                await self.send(
+                    match.user_id,
+                    MMBasePayload(
+                        sender_id=user_id,
+                        recipient_id=match.user_id,
+                        payload=reconnect).dict(by_alias=True))
+            else:
+                # B is also on the match screen
+                logger.info(f"{match.user_id} is on a match screen, "
+                            f"sending decline")
+                decline = MMMatchPayload(action=MMResponseAction.DECLINE)
+                await self.send(
+                    match.user_id,
+                    MMBasePayload(
+                        sender_id=user_id,
+                        recipient_id=match.user_id,
+                        payload=decline).dict(by_alias=True))
+
+                logger.info(f"Reconnecting {match.user_id} to matchmaking")
+                matchmaking_data.reconnect(match.user_id)
+
+            logger.info(f"Removing {user_id} from sent matches")
+            await self.remove_match(user_id)
+
             logger.info(
-                f"{sender_id} has accepted chat request from {recipient_id}, "
-                f"sending request to chat server")
-            url = f'{settings.CHAT_SERVER_HOST}/matchmaking/chat'
-            # yeah they are reversed
-            # we don't need to send an ack, so no request_id
-            output_payload = {
-                'sender_id': base_payload.recipient_id,
-                'recipient_id': base_payload.sender_id,
-                'payload': {
-                    'type': 'create_chat',
-                    'source': data_payload.source.value,
-                    'chat_id': str(data_payload.chat_id)
+                f"Removing {match.user_id}, match of {user_id}"
+                f"from sent matches")
+            await self.remove_match(match.user_id)
+
+    async def process_payload(self, base_payload: MMBasePayload,
+                              user_data: MMUserData):
+        matchmaking_data = self.matchmaking_data
+        data_payload = base_payload.payload
+        sender_id = base_payload.sender_id
+        recipient_id = base_payload.recipient_id
+
+        if isinstance(data_payload, MMMatchPayload):
+            if data_payload.action == MMResponseAction.ACCEPT:
+                logger.info(f"{sender_id} accepted match")
+                await self.accept_match(sender_id)
+            elif data_payload.action == MMResponseAction.DECLINE:
+                # one decline -> put both back to MM
+                logger.info(
+                    f"Got decline from {sender_id}, "
+                    f"placing him and {recipient_id} "
+                    f"back to matchmaker, removing from sent matches")
+                matchmaking_data.reconnect_decline(sender_id, recipient_id)
+                await self.remove_match(sender_id)
+                await self.remove_match(recipient_id)
+
+                # a decline means we add them to each others blacklist
+                if settings.MATCHMAKING_BLACKLIST_ENABLED:
+                    with dependencies.db_context() as session:
+                        blacklist_service = BlacklistService(
+                            session, redis_client)
+                        # even though we remove the graph edges,
+                        # these users still have to be removed
+                        # from each other's online lists
+                        await blacklist_service.update_blacklist(
+                            sender_id, recipient_id,
+                            send_blacklist_event=True)
+        elif isinstance(data_payload, MMLobbyPayload):
+            if data_payload.action == MMLobbyAction.CONNECT:
+                # user joined the lobby
+                await self.connect_to_lobby(sender_id, user_data)
+            elif data_payload.action == MMLobbyAction.RECONNECT:
+                # sender_id ended a call (pressed 'next')
+                # if recipient_id is None then this reconnect payload comes
+                # from the other guy
+                # A sends reconnect to server+B
+                # B receives reconnect and sends it back without recipient_id
+                # TODO this is dumb but it's easier to do it this way now
+                if recipient_id:
+                    logger.info(f"Reconnecting pair "
+                                f"[{sender_id}, {recipient_id}] after call")
+                    matchmaking_data.reconnect_after_call(
+                        sender_id, recipient_id)
+                    logger.info(f"Resulting returning users"
+                                f"{matchmaking_data.returning_users}")
+        elif isinstance(data_payload, MMChatPayload):
+            if data_payload.action == MMChatAction.ACCEPT:
+                logger.info(
+                    f"{sender_id} has accepted chat request "
+                    f"from {recipient_id}, sending request to chat server")
+                url = f'{settings.CHAT_SERVER_HOST}/matchmaking/chat'
+                # yeah they are reversed
+                # we don't need to send an ack, so no request_id
+                output_payload = {
+                    'sender_id': base_payload.recipient_id,
+                    'recipient_id': base_payload.sender_id,
+                    'payload': {
+                        'type': 'create_chat',
+                        'source': data_payload.source.value,
+                        'chat_id': str(data_payload.chat_id)
+                    }
                 }
-            }
-            # TODO use aiohttp?
-            requests.post(url, json=output_payload)
-
-
-@app.post('/send_match')
-async def send_match_data(request: Request):
-    match_data: dict = await request.json()
-    logger.info(f"Got match {match_data}, sending to clients")
-    user_a_id, user_b_id = match_data['match']
-    if connection_manager.is_connected(user_a_id):
-        if connection_manager.is_connected(user_b_id):
-            # both connected
-            logger.info(f"Both are connected, "
-                        f"sending matches to {user_a_id}, {user_b_id}")
-            matchmaking_data.add_match(user_a_id, user_b_id)
-
-            await connection_manager.send(user_b_id, {
-                'match': user_a_id, 'host': False
-            })
-            await connection_manager.send(user_a_id, {
-                'match': user_b_id, 'host': True
-            })
-
-    return Response()
-
-
-@app.get('/new_round_data', response_model=MMRoundData)
-async def fetch_new_round_data(request: Request):
-    response_data = matchmaking_data.dict(
-        exclude={'sent_matches', 'online_users'})
-    logger.info("New round started, clearing cache")
-    matchmaking_data.clear()
-    return response_data
-
-
-@app.get(
-    '/fetch_candidates',
-    name='Fetch candidates for matchmaking',
-    responses={
-        200: {'description': 'List of users according to filter'},
-        400: {'description': 'Bad Request'},
-    })
-async def fetch_user_ids_for_matchmaking(
-        user_id: str = Query(None),
-        user_age: int = Query(None),
-        gender_filter: Gender = Query(None),
-        session_id: str = Query(None)):
+                # TODO use aiohttp?
+                requests.post(url, json=output_payload)
+
+    async def connect_to_lobby(self, user_id: str, user_data: MMUserData):
+        mm_settings = MMSettings(
+            age=user_data.age,
+            gender=user_data.gender,
+            gender_filter=user_data.gender_filter,
+            session_id=secrets.token_urlsafe(16))
+        logger.info(f"Connecting {user_id} to matchmaking, "
+                    f"settings: {mm_settings}")
+        logger.info(f"Current online users "
+                    f"{self.matchmaking_data.online_users}")
+
+        # there boys and girls and helicopters are loaded in the chat server,
+        # chat partners and the blacklist are read with the online users
+        filter_params = OnlineFilterBody(
+            session_id=mm_settings.session_id,
+            gender=mm_settings.gender_filter,
+            limit=settings.MATCHMAKING_FETCH_LIMIT)
+        connections, disallowed_users = await fetch_service.collect_on_connect(
+            user_id, mm_settings.age, filter_params,
+            settings.MATCHMAKING_CONNECT_PREFETCH_AGE_DIFF)
+        logger.info(f"Got possible connections for "
+                    f"{user_id}: {connections}, "
+                    f"disallowed_users: {disallowed_users}")
+        self.matchmaking_data.connect(
+            user_id, mm_settings, connections,
+            disallowed_users=disallowed_users)
+        if self.shared_lobby:
+            await self.shared_lobby.add_online(user_id)
+
+    async def send_match(self, user_a_id: str, user_b_id: str):
+        if await self.is_connected(user_a_id):
+            if await self.is_connected(user_b_id):
+                # both connected
+                logger.info(f"Both are connected, "
+                            f"sending matches to {user_a_id}, {user_b_id}")
+                await self.add_match(user_a_id, user_b_id)
+
+                await asyncio.gather(
+                    self.send(user_b_id, {
+                        'match': user_a_id, 'host': False
+                    }),
+                    self.send(user_a_id, {
+                        'match': user_b_id, 'host': True
+                    }))
+
+    async def send_matches(self, matches: list[list[str]]):
+        if self.round_recorder:
+            self.round_recorder.record_matches(matches)
+        await asyncio.gather(*[
+            self.send_match(user_a_id, user_b_id)
+            for user_a_id, user_b_id in matches
+        ])
+
+    def take_round_data(self) -> MMRoundData:
+        """
+        Changes made to the lobby since the previous round,
+        the cache is cleared for the next one
+        """
+        matchmaking_data = self.matchmaking_data
+        round_data = MMRoundData.construct(
+            new_users=matchmaking_data.new_users,
+            returning_users=matchmaking_data.returning_users,
+            disconnected_users=matchmaking_data.disconnected_users,
+            decline_pairs=matchmaking_data.decline_pairs)
+        if self.round_recorder:
+            self.round_recorder.record_round(
+                round_data.json(exclude=ROUND_DATA_EXCLUDE))
+        logger.info("New round started, clearing cache")
+        matchmaking_data.clear()
+        return round_data
+
+    async def lobby_state(self) -> Tuple[set[str], set[str]]:
+        """
+        Online users and users with a sent match
+        """
+        if self.shared_lobby:
+            return await self.shared_lobby.lobby_state()
+        return set(self.matchmaking_data.online_users), \
+            set(self.matchmaking_data.sent_matches)
+
+    async def reconnect_users(self, user_ids: Iterable[str]):
+        """
+        Users with a sent match are skipped, they are in a call
+        and come back to the lobby once it is over
+        """
+        online_users, matched_users = await self.lobby_state()
+        user_ids = [
+            user_id for user_id in user_ids
+            if user_id in online_users and user_id not in matched_users
+            and user_id not in self.matchmaking_data.new_users
+        ]
+        batch_size = settings.MATCHMAKING_RECONNECT_BATCH_SIZE
+        for start in range(0, len(user_ids), batch_size):
+            await asyncio.gather(*[
+                self.reconnect_user(user_id)
+                for user_id in user_ids[start:start + batch_size]
+            ])
+        await self.publish_round_data()
+
+    async def reconnect_user(self, user_id: str):
+        user_data = self.connection_manager.get_user_data(user_id)
+        if user_data is None and self.shared_lobby:
+            user_data = await self.shared_lobby.user_data(user_id)
+        if user_data is not None:
+            await self.connect_to_lobby(user_id, user_data)
+
+    async def is_connected(self, user_id: str) -> bool:
+        if self.connection_manager.is_connected(user_id):
+            return True
+        return bool(self.shared_lobby
+                    and await self.shared_lobby.is_connected(user_id))
+
+    async def send(self, user_id: str, payload: dict):
+        if self.shared_lobby \
+                and not self.connection_manager.is_connected(user_id):
+            await self.shared_lobby.send_text(
+                user_id, json.dumps(payload, cls=PayloadEncoder))
+        else:
+            await self.connection_manager.send(user_id, payload)
+
+    async def send_text(self, user_id: str, text: str):
+        if self.shared_lobby \
+                and not self.connection_manager.is_connected(user_id):
+            await self.shared_lobby.send_text(user_id, text)
+        else:
+            await self.connection_manager.send_text(user_id, text)
+
+    async def get_match(self, user_id: str) -> Optional[Match]:
+        if self.shared_lobby:
+            return await self.shared_lobby.get_match(user_id)
+        return self.matchmaking_data.get_match(user_id)
+
+    async def add_match(self, user_a_id: str, user_b_id: str):
+        if self.shared_lobby:
+            await self.shared_lobby.add_match(user_a_id, user_b_id)
+        else:
+            self.matchmaking_data.add_match(user_a_id, user_b_id)
+
+    async def accept_match(self, user_id: str):
+        if self.shared_lobby:
+            await self.shared_lobby.accept_match(user_id)
+        else:
+            self.matchmaking_data.accept_match(user_id)
+
+    async def remove_match(self, user_id: str):
+        if self.shared_lobby:
+            await self.shared_lobby.remove_match(user_id)
+        else:
+            self.matchmaking_data.remove_match(user_id)
+
+    async def fetch_candidates(self, queries: list[MMCandidatesQuery]) \
+            -> dict[str, set[str]]:
+        all_connections = await asyncio.gather(*[
+            _collect_candidates(query) for query in queries
+        ])
+        connections = {
+            query.user_id: connections
+            for query, connections in zip(queries, all_connections)
+        }
+        if self.round_recorder:
+            self.round_recorder.record_candidates(connections)
+        return connections
+
+    def embedded_lobby(self) -> EmbeddedLobby:
+        """
+        Handlers of the requests of the embedded matchmaker
+        and its config
+        """
+
+        async def round_data(_) -> MMRoundData:
+            return self.take_round_data()
+
+        async def lobby_state(_) -> Tuple[set[str], set[str]]:
+            return await self.lobby_state()
+
+        async def candidates(queries: list[dict]) -> dict[str, set[str]]:
+            return await self.fetch_candidates(
+                [MMCandidatesQuery.parse_obj(query) for query in queries])
+
+        async def reconnect_online_users():
+            # a restarted embedded matchmaker starts with an empty graph
+            # unless it has a snapshot, users that are already in it
+            # and users in a call are skipped
+            await self.reconnect_users(
+                list(self.matchmaking_data.online_users))
+
+        return EmbeddedLobby(
+            {
+                'round_data': round_data,
+                'matches': self.send_matches,
+                'candidates': candidates,
+                'lobby_state': lobby_state,
+                'reconnect_users': self.reconnect_users,
+            },
+            on_restart=reconnect_online_users,
+            # the embedded matchmaker is not sharded
+            matchmaker_config=MatchmakerConfig.from_settings(
+                shards=1,
+                event_stream=self.event_stream,
+                snapshot_path=for_mode(settings.MATCHMAKING_SNAPSHOT_PATH,
+                                       self.mode),
+                metrics_path=for_mode(settings.MATCHMAKING_METRICS_PATH,
+                                      self.mode)))
+
+
+async def _collect_candidates(query: MMCandidatesQuery) -> set[str]:
+    user_id = query.user_id
     chat_partners = await redis_chats.get_chat_partners(user_id)
     logger.info(f"Chat partners of {user_id}: {chat_partners}")
 
@@ -363,23 +636,130 @@ async def fetch_user_ids_for_matchmaking(
     disallowed_users = chat_partners.union(blacklist)
     connections = await fetch_service.collect(
         user_id,
-        user_age=user_age,
+        user_age=query.user_age,
         filter_params=OnlineFilterBody(
-            session_id=session_id,
-            gender=gender_filter,
+            session_id=query.session_id,
+            gender=query.gender_filter,
             limit=settings.MATCHMAKING_FETCH_LIMIT
         ),
         disallowed_users=disallowed_users)
 
     logger.info(f"Got possible connections for {user_id}: {connections}, "
                 f"disallowed: {disallowed_users}")
-    return {
-        'connections': connections
-    }
+    return connections
+
+
+def lobby_router(lobby: Lobby) -> APIRouter:
+    router = APIRouter()
+
+    @router.websocket("/connect/{user_id}")
+    async def matchmaker_endpoint(
+            user_id: str, websocket: WebSocket,
+            gender: Gender = Query(None)):
+        await lobby.serve(user_id, websocket, gender)
+
+    @router.post('/send_match')
+    async def send_match_data(request: Request):
+        match_data: dict = await request.json()
+        logger.info(f"Got match {match_data}, sending to clients")
+        user_a_id, user_b_id = match_data['match']
+        if lobby.round_recorder:
+            lobby.round_recorder.record_matches([(user_a_id, user_b_id)])
+        await lobby.send_match(user_a_id, user_b_id)
+        return Response()
+
+    @router.post('/send_matches')
+    async def send_matches_data(request: Request):
+        match_data: dict = await request.json()
+        matches: list[list[str]] = match_data['matches']
+        logger.info(f"Got {len(matches)} matches, sending to clients")
+        await lobby.send_matches(matches)
+        return Response()
+
+    @router.get('/new_round_data', response_model=MMRoundData)
+    async def fetch_new_round_data(request: Request):
+        return lobby.take_round_data().dict(exclude=ROUND_DATA_EXCLUDE)
+
+    @router.get('/lobby_state')
+    async def fetch_lobby_state():
+        # used by a restarted matchmaker to reconcile its snapshot
+        online_users, matched_users = await lobby.lobby_state()
+        return {
+            'online_users': online_users,
+            'matched_users': matched_users
+        }
+
+    @router.post('/reconnect_users')
+    async def reconnect_users(user_ids: list[str] = Body(..., embed=True)):
+        """
+        Sends online users to the matchmaker again as new users,
+        used when they are missing from its snapshot
+        """
+        await lobby.reconnect_users(user_ids)
+        return Response()
+
+    @router.get(
+        '/fetch_candidates',
+        name='Fetch candidates for matchmaking',
+        responses={
+            200: {'description': 'List of users according to filter'},
+            400: {'description': 'Bad Request'},
+        })
+    async def fetch_user_ids_for_matchmaking(
+            user_id: str = Query(None),
+            user_age: int = Query(None),
+            gender_filter: Gender = Query(None),
+            session_id: str = Query(None)):
+        connections = await lobby.fetch_candidates([MMCandidatesQuery(
+            user_id=user_id, user_age=user_age,
+            gender_filter=gender_filter, session_id=session_id)])
+        return {
+            'connections': connections[user_id]
+        }
+
+    @router.post(
+        '/fetch_candidates',
+        name='Fetch candidates for many users at once',
+        responses={
+            200: {'description': 'Lists of users according to their filters'},
+            400: {'description': 'Bad Request'},
+        })
+    async def fetch_user_ids_for_matchmaking_bulk(
+            queries: list[MMCandidatesQuery] = Body(...)):
+        return {
+            'connections': await lobby.fetch_candidates(queries)
+        }
+
+    return router
+
+
+# mode -> lobby, a server without modes has a single lobby at the root
+lobbies: dict[str, Lobby] = {
+    mode: Lobby(mode) for mode in settings.MATCHMAKING_MODES or ['']
+}
+for lobby_mode, mode_lobby in lobbies.items():
+    app.include_router(lobby_router(mode_lobby),
+                       prefix=f'/{lobby_mode}' if lobby_mode else '')
 
 
 def start_server():
     app.add_middleware(CorrelationIdMiddleware)
+    if settings.MATCHMAKING_SHARED_LOBBY:
+        # every instance would run a matchmaker of its own
+        # and /new_round_data would hand out a part of the lobby
+        if settings.MATCHMAKING_EMBEDDED \
+                or not settings.MATCHMAKING_EVENT_LOG_ENABLED:
+            raise ValueError("Shared lobby needs the event log "
+                             "and a standalone matchmaker")
+        for lobby in lobbies.values():
+            loop.create_task(lobby.shared_lobby.run(
+                lobby.connection_manager, lobby.process_lost_users))
+    if settings.MATCHMAKING_EMBEDDED:
+        # every lobby gets a matchmaker process of its own
+        embedded_matchmaker = EmbeddedMatchmaker({
+            mode: lobby.embedded_lobby() for mode, lobby in lobbies.items()
+        })
+        embedded_matchmaker.start(loop)
     server_config = Config(app=app, host='0.0.0.0',
                            port=80, workers=1, loop='asyncio')
     server = Server(server_config)
@@ -0,0 +1,123 @@
+import bisect
+import json
+import math
+import os
+import time
+from contextlib import contextmanager
+
+# upper bounds of the time-to-match buckets
+TIME_TO_MATCH_BUCKETS_SECS = (1, 2, 5, 10, 20, 30, 60, 120, 300, math.inf)
+
+
+class RoundMetrics:
+    """
+    Time spent in every phase of a round and the sizes it has dealt with
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.started_at = time.time()
+        # phase -> seconds, a phase can be entered several times
+        self.phases: dict[str, float] = {}
+        # graph_size, edge_count, heap_size, matches, unmatched
+        self.values: dict[str, int] = {}
+        # seconds it took the users matched in this round to get a match
+        self.times_to_match: list[float] = []
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) \
+                                + time.perf_counter() - start
+
+    def to_dict(self) -> dict:
+        return {
+            'kind': self.kind,
+            'started_at': self.started_at,
+            'total_secs': sum(self.phases.values()),
+            'phases': self.phases,
+            **self.values
+        }
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self._buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._count = 0
+        self._sum = 0.0
+
+    def observe(self, value: float):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._count += 1
+        self._sum += value
+
+    def to_dict(self) -> dict:
+        return {
+            'buckets': {
+                str(bound): count
+                for bound, count in zip(self._buckets, self._counts)
+            },
+            'count': self._count,
+            'sum': self._sum
+        }
+
+
+class MatchmakerMetrics:
+    """
+    Metrics of the last round of every kind, the slowest time
+    of every phase since the start and the time it takes users to get
+    a match after they have entered the lobby
+    """
+
+    def __init__(self):
+        self.current_round = RoundMetrics('idle')
+        # kind -> metrics of the last finished round of that kind
+        self.last_rounds: dict[str, RoundMetrics] = {}
+        # kind -> phase -> seconds
+        self.max_phases: dict[str, dict[str, float]] = {}
+        self.rounds = 0
+        self.time_to_match = Histogram(TIME_TO_MATCH_BUCKETS_SECS)
+
+    def start_round(self, kind: str) -> RoundMetrics:
+        self.current_round = RoundMetrics(kind)
+        return self.current_round
+
+    def finish_round(self):
+        current_round = self.current_round
+        self.rounds += 1
+        self.last_rounds[current_round.kind] = current_round
+        max_phases = self.max_phases.setdefault(current_round.kind, {})
+        for name, secs in current_round.phases.items():
+            max_phases[name] = max(max_phases.get(name, 0.0), secs)
+
+    def phase(self, name: str):
+        return self.current_round.phase(name)
+
+    def observe_time_to_match(self, secs: float):
+        self.time_to_match.observe(secs)
+        self.current_round.times_to_match.append(secs)
+
+    def to_dict(self) -> dict:
+        return {
+            'rounds': self.rounds,
+            'last_rounds': {
+                kind: round_metrics.to_dict()
+                for kind, round_metrics in self.last_rounds.items()
+            },
+            'max_phases': self.max_phases,
+            'time_to_match': self.time_to_match.to_dict()
+        }
+
+
+def write_metrics(path: str, metrics: MatchmakerMetrics):
+    """
+    Replaces the metrics file, readers never see a partially written one
+    """
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as metrics_file:
+        json.dump(metrics.to_dict(), metrics_file)
+    os.replace(tmp_path, path)
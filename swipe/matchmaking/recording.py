@@ -0,0 +1,59 @@
+"""
+Recording of the data the matchmaking server exchanges with the matchmaker,
+it's replayed with `benchmark.replay_recording`.
+Every line of a recording is a json record with the time it was made,
+its kind and the data:
+- round: round data handed out to the matchmaker
+- matches: matches sent back by the matchmaker
+- candidates: user_id -> candidates returned by /fetch_candidates
+"""
+import json
+import logging
+import time
+from typing import Iterator, Iterable
+
+logger = logging.getLogger('matchmaker')
+
+ROUND = 'round'
+MATCHES = 'matches'
+CANDIDATES = 'candidates'
+
+
+class RoundRecorder:
+    """
+    Appends records to the recording, a line is written at once
+    so that a crash leaves at most the last record broken
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, 'a', buffering=1)
+
+    def record_round(self, round_data_json: str):
+        # round data is already serialized for the matchmaker
+        self._write(ROUND, round_data_json)
+
+    def record_matches(self, matches: Iterable[Iterable[str]]):
+        self._write(MATCHES, json.dumps(
+            [list(match) for match in matches], separators=(',', ':')))
+
+    def record_candidates(self, connections: dict[str, Iterable[str]]):
+        self._write(CANDIDATES, json.dumps(
+            {user_id: list(user_ids)
+             for user_id, user_ids in connections.items()},
+            separators=(',', ':')))
+
+    def close(self):
+        self._file.close()
+
+    def _write(self, kind: str, data_json: str):
+        self._file.write(f'{{"time":{time.time()},"kind":"{kind}",'
+                         f'"data":{data_json}}}\n')
+
+
+def read_recording(path: str) -> Iterator[dict]:
+    with open(path) as recording:
+        for line_number, line in enumerate(recording, 1):
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logger.error(f"Skipping broken record on line {line_number}")
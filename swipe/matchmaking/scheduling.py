@@ -0,0 +1,126 @@
+import logging
+import math
+from collections import deque
+from typing import Iterable, Optional
+
+from swipe.matchmaking.schemas import MMRoundData
+
+logger = logging.getLogger('matchmaker')
+
+
+def count_arrivals(round_data: MMRoundData) -> int:
+    """
+    Users that have become available for matching with the round data
+    """
+    return len(round_data.new_users) + len(round_data.returning_users) \
+           + 2 * len(round_data.decline_pairs)
+
+
+class RoundScheduler:
+    """
+    Picks the length of the next round, from the start of one round
+    to the start of the next, to keep the 95th percentile of the time
+    it takes users to get a match under the target.
+    A user arriving right after the round data has been fetched waits
+    for the whole round and the computation of the next one, so a round
+    is never longer than the target minus the compute time.
+    Users that need several rounds to get a match push the observed
+    percentile over the target, then the rounds get shorter down to
+    running them back-to-back, but not shorter than the time between
+    the arrivals, unless the users waiting take up the rest of the target.
+    When nobody is left waiting after a round, a new user has nobody
+    to be matched with until another one arrives, so the rounds get
+    as long as the time between the arrivals, up to the target
+    """
+
+    # weight of the last round in the moving averages
+    SMOOTHING = 0.3
+    # the most the round can be shortened by at once,
+    # its inverse is the most it can be lengthened by
+    MAX_CHANGE = 0.7
+    MIN_SCALE = 0.05
+    MIN_TIME_TO_MATCH_SECS = 0.01
+    # times the percentile is computed over, heavier users are matched
+    # first so the window has to hold more than the last round
+    RECENT_MATCHES = 1000
+
+    def __init__(self, target_p95_secs: float,
+                 min_round_length_secs: float = 0.0,
+                 max_round_length_secs: float = 30.0):
+        self._target_p95_secs = target_p95_secs
+        self._min_round_length_secs = min_round_length_secs
+        self._max_round_length_secs = max_round_length_secs
+        self._compute_secs: Optional[float] = None
+        # users per second
+        self._arrival_rate: Optional[float] = None
+        # share of the time left by the computation the round takes
+        self._scale = 1.0
+        self._times_to_match: deque[float] = deque(
+            maxlen=self.RECENT_MATCHES)
+        self.round_length_secs = self._clamp(target_p95_secs)
+
+    def observe_round(self, elapsed_secs: float, compute_secs: float,
+                      arrivals: int, unmatched_users: int,
+                      times_to_match: Iterable[float]) -> float:
+        """
+        Takes the time since the start of the previous round, the time
+        this one took, the number of users that have entered the lobby
+        or returned to it since the previous round, the number of users
+        left without a match and the times it took the matched ones.
+        Returns the length of the next round
+        """
+        self._compute_secs = self._average(self._compute_secs, compute_secs)
+        if elapsed_secs > 0:
+            self._arrival_rate = self._average(
+                self._arrival_rate, arrivals / elapsed_secs)
+
+        times_to_match = list(times_to_match)
+        # the percentile only changes with new matches
+        if times_to_match:
+            self._times_to_match.extend(times_to_match)
+            # the time it takes is roughly proportional
+            # to the length of the rounds
+            change = self._target_p95_secs \
+                / max(self.p95_time_to_match(), self.MIN_TIME_TO_MATCH_SECS)
+            change = min(max(change, self.MAX_CHANGE), 1 / self.MAX_CHANGE)
+            self._scale = min(max(self._scale * change, self.MIN_SCALE), 1.0)
+
+        time_left_secs = max(self._target_p95_secs - self._compute_secs, 0.0)
+        if self._arrival_rate:
+            arrival_interval_secs = 1 / self._arrival_rate
+            # Little's law, users stay in the lobby for about
+            # the number of waiting ones over the arrival rate
+            queue_secs = unmatched_users / self._arrival_rate
+        else:
+            arrival_interval_secs = queue_secs = math.inf
+        if unmatched_users:
+            # widened windows of the waiting users reach their maximum
+            # after a few rounds, a match needs a new user after that,
+            # unless they have been waiting for the whole target
+            wait_secs = min(arrival_interval_secs,
+                            time_left_secs - queue_secs)
+        else:
+            wait_secs = min(arrival_interval_secs, self._target_p95_secs)
+        round_length_secs = max(self._scale * time_left_secs, wait_secs)
+        self.round_length_secs = self._clamp(round_length_secs)
+        logger.info(f"Next round in {self.round_length_secs:.3f}s, "
+                    f"compute {self._compute_secs:.3f}s, "
+                    f"{self._arrival_rate or 0:.2f} arrivals/s, "
+                    f"{unmatched_users} unmatched, scale {self._scale:.2f}")
+        return self.round_length_secs
+
+    def p95_time_to_match(self) -> Optional[float]:
+        if not self._times_to_match:
+            return None
+        times_to_match = sorted(self._times_to_match)
+        return times_to_match[
+            min(int(len(times_to_match) * 0.95), len(times_to_match) - 1)]
+
+    def _average(self, average: Optional[float], value: float) -> float:
+        if average is None:
+            return value
+        return average + self.SMOOTHING * (value - average)
+
+    def _clamp(self, round_length_secs: float) -> float:
+        return min(max(round_length_secs, self._min_round_length_secs),
+                   self._max_round_length_secs)
@@ -105,6 +105,27 @@ class MMBasePayload(BaseModel):
         return result
 
 
+# WebRTC signaling, forwarded to the recipient as it came
+RELAYED_PAYLOAD_TYPES = frozenset({'sdp', 'ice'})
+
+
+def relay_target(data: Any) -> Optional[Tuple[str, str, Optional[str]]]:
+    """
+    Sender, recipient and request_id of a signaling payload that is
+    relayed without validation, None for the rest of the payloads
+    """
+    if not isinstance(data, dict):
+        return None
+    payload = data.get('payload')
+    if not isinstance(payload, dict) \
+            or payload.get('type') not in RELAYED_PAYLOAD_TYPES:
+        return None
+    sender_id, recipient_id = data.get('sender_id'), data.get('recipient_id')
+    if not isinstance(sender_id, str) or not isinstance(recipient_id, str):
+        return None
+    return sender_id, recipient_id, data.get('request_id')
+
+
 class MMSettings(BaseModel):
     age: int
     age_diff: int = settings.MATCHMAKING_DEFAULT_AGE_DIFF
@@ -128,6 +149,13 @@ class MMSettings(BaseModel):
         self.current_weight += 1
 
 
+class MMCandidatesQuery(BaseModel):
+    user_id: str
+    user_age: int
+    gender_filter: Optional[Gender] = None
+    session_id: str
+
+
 class VertexData(BaseModel):
     user_id: str
     mm_settings: MMSettings
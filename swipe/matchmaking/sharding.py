@@ -0,0 +1,288 @@
+import bisect
+import logging
+import math
+import multiprocessing
+from multiprocessing.connection import Connection
+from typing import Optional, Iterator, Tuple
+
+from swipe.matchmaking.matchmaker import Matchmaker
+from swipe.matchmaking.metrics import MatchmakerMetrics
+from swipe.matchmaking.schemas import Match, MMRoundData, VertexData
+from swipe.settings import settings
+
+logger = logging.getLogger('matchmaker')
+
+# lowest and highest age of a band, both inclusive
+AgeBand = Tuple[float, float]
+
+# raised by the pipe of a shard process that has died
+SHARD_ERRORS = (EOFError, BrokenPipeError, ConnectionResetError)
+
+
+def even_age_bounds(shards: int) -> list[int]:
+    """
+    Lowest ages of every band except the first one
+    """
+    min_age = settings.USER_FETCH_MINIMUM_AGE
+    band_width = (settings.MATCHMAKING_SHARD_MAX_AGE - min_age) / shards
+    return [min_age + round(band_width * shard)
+            for shard in range(1, shards)]
+
+
+def crosses_band(vertex_data: VertexData, age_band: AgeBand) -> bool:
+    """
+    True if the age window of the user reaches into other bands
+    """
+    mm_settings = vertex_data.mm_settings
+    return mm_settings.age - mm_settings.age_diff < age_band[0] \
+           or mm_settings.age + mm_settings.age_diff > age_band[1]
+
+
+def _run_shard(connection: Connection, age_band: AgeBand):
+    matchmaker = Matchmaker()
+    while True:
+        command, payload = connection.recv()
+        if command == 'round':
+            matches = list(matchmaker.run_matchmaking_round(payload))
+            # windows of the users have already been widened for the next
+            # round, those that reach other bands get a second chance
+            boundary_users = []
+            for vertex in matchmaker.unmatched_vertices():
+                vertex_data = VertexData(
+                    user_id=vertex.user_id,
+                    mm_settings=vertex.mm_settings,
+                    disallowed_users=vertex.disallowed_users)
+                if crosses_band(vertex_data, age_band):
+                    boundary_users.append(vertex_data)
+            round_metrics = matchmaker.metrics.current_round
+            connection.send((
+                matches, boundary_users, round_metrics.values['unmatched'],
+                round_metrics.times_to_match))
+        elif command == 'matched':
+            # users that got a match during the second pass,
+            # partners from other shards are marked by their own shards
+            round_metrics = matchmaker.metrics.current_round
+            observed = len(round_metrics.times_to_match)
+            for user_ids in payload:
+                matchmaker.mark_matched(
+                    *[matchmaker.get_vertex(user_id) for user_id in user_ids])
+            connection.send(round_metrics.times_to_match[observed:])
+        elif command == 'seed':
+            matchmaker.seed(*payload)
+        elif command == 'stop':
+            return
+
+
+class ShardedMatchmaker:
+    """
+    Splits the lobby by age bands between worker processes,
+    each of them running its own `Matchmaker`.
+    Users left without a match whose age window crosses
+    the band of their shard are matched against each other
+    in a second pass, every user belongs to exactly one shard
+    so nobody is matched twice.
+    A shard that has died is started again with the users
+    of its band, their weights and edges are built anew
+    """
+
+    def __init__(self, shards: int,
+                 age_bounds: Optional[list[int]] = None):
+        self._age_bounds = age_bounds or even_age_bounds(shards)
+        if len(self._age_bounds) != shards - 1:
+            raise ValueError(f"{shards} shards need {shards - 1} age bounds, "
+                             f"got {self._age_bounds}")
+
+        self.metrics = MatchmakerMetrics()
+        # user_id -> shard
+        self._user_shards: dict[str, int] = {}
+        # user_id -> data he has joined with, to seed a restarted shard
+        self._user_data: dict[str, VertexData] = {}
+        # users that got a match and haven't returned to the lobby yet
+        self._in_call: set[str] = set()
+        bounds = [-math.inf, *self._age_bounds, math.inf]
+        self._age_bands: list[AgeBand] = [
+            (bounds[shard], bounds[shard + 1] - 1)
+            for shard in range(shards)]
+        # users of different shards have never been connected,
+        # the boundary pass builds a graph of them every round
+        self._boundary_matchmaker = Matchmaker()
+        self._connections: list[Optional[Connection]] = [None] * shards
+        self._processes: list[Optional[multiprocessing.Process]] = \
+            [None] * shards
+        for shard in range(shards):
+            self._start_shard(shard)
+
+    def run_matchmaking_round(self, incoming_data: MMRoundData) \
+            -> Iterator[Match]:
+        round_metrics = self.metrics.start_round('full')
+        failed_shards: set[int] = set()
+        matches: list[Match] = []
+        boundary_users: dict[str, VertexData] = {}
+        unmatched = 0
+        with round_metrics.phase('shards'):
+            shard_data = self._split_round_data(incoming_data)
+            for shard, connection in enumerate(self._connections):
+                try:
+                    connection.send(('round', shard_data[shard]))
+                except SHARD_ERRORS:
+                    failed_shards.add(shard)
+
+            for shard, connection in enumerate(self._connections):
+                if shard in failed_shards:
+                    continue
+                try:
+                    shard_matches, shard_boundary_users, shard_unmatched, \
+                        times_to_match = connection.recv()
+                except SHARD_ERRORS:
+                    failed_shards.add(shard)
+                    continue
+                matches.extend(shard_matches)
+                unmatched += shard_unmatched
+                self._observe_times_to_match(times_to_match)
+                for vertex_data in shard_boundary_users:
+                    boundary_users[vertex_data.user_id] = vertex_data
+
+        with round_metrics.phase('boundary'):
+            boundary_matches = self._match_boundary_users(
+                boundary_users, failed_shards)
+        matches.extend(boundary_matches)
+
+        for match in matches:
+            self._in_call.update(match)
+        # a shard that died in the middle of a round
+        # sits it out, its users are matched in the next one
+        for shard in failed_shards:
+            self._restart_shard(shard)
+
+        round_metrics.values.update(
+            graph_size=len(self._user_shards),
+            matches=len(matches),
+            unmatched=unmatched - 2 * len(boundary_matches))
+        self.metrics.finish_round()
+        yield from matches
+
+    def stop(self):
+        for connection in self._connections:
+            try:
+                connection.send(('stop', None))
+            except SHARD_ERRORS:
+                pass
+        for process in self._processes:
+            process.join()
+        self._boundary_matchmaker.close()
+
+    def _start_shard(self, shard: int):
+        age_band = self._age_bands[shard]
+        connection, worker_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_run_shard, args=(worker_connection, age_band),
+            name=f'matchmaker-shard-{shard}', daemon=True)
+        process.start()
+        worker_connection.close()
+        logger.info(f"Started shard {shard} for ages {age_band}")
+        self._connections[shard] = connection
+        self._processes[shard] = process
+
+    def _restart_shard(self, shard: int):
+        process = self._processes[shard]
+        logger.error(f"Shard {shard} is gone with {process.exitcode}, "
+                     f"restarting it")
+        self._connections[shard].close()
+        process.kill()
+        process.join()
+        self._start_shard(shard)
+
+        users = {user_id: self._user_data[user_id]
+                 for user_id, user_shard in self._user_shards.items()
+                 if user_shard == shard}
+        self._connections[shard].send(
+            ('seed', (users, self._in_call & users.keys())))
+
+    def _observe_times_to_match(self, times_to_match: list[float]):
+        for time_to_match in times_to_match:
+            self.metrics.observe_time_to_match(time_to_match)
+
+    def _shard(self, age: int) -> int:
+        return bisect.bisect_right(self._age_bounds, age)
+
+    def _split_round_data(self, incoming_data: MMRoundData) \
+            -> list[MMRoundData]:
+        shard_data = [MMRoundData() for _ in self._connections]
+        for user_id, partner_id in incoming_data.returning_users.items():
+            self._in_call.discard(user_id)
+            if (shard := self._user_shards.get(user_id)) is not None:
+                shard_data[shard].returning_users[user_id] = partner_id
+
+        for user_a_id, user_b_id in incoming_data.decline_pairs:
+            self._in_call.difference_update((user_a_id, user_b_id))
+            shard_a = self._user_shards.get(user_a_id)
+            shard_b = self._user_shards.get(user_b_id)
+            if shard_a is None or shard_b is None:
+                continue
+            if shard_a == shard_b:
+                shard_data[shard_a].decline_pairs.append(
+                    (user_a_id, user_b_id))
+                continue
+
+            # there are no edges between shards, so returning
+            # with a disallowed partner is all that's left of a decline
+            blacklisted = settings.MATCHMAKING_BLACKLIST_ENABLED
+            shard_data[shard_a].returning_users[user_a_id] = \
+                user_b_id if blacklisted else None
+            shard_data[shard_b].returning_users[user_b_id] = \
+                user_a_id if blacklisted else None
+
+        for user_id in incoming_data.disconnected_users:
+            # same as in the matchmaker, users who reconnected
+            # during the same round are dropped
+            incoming_data.new_users.pop(user_id, None)
+            self._in_call.discard(user_id)
+            self._user_data.pop(user_id, None)
+            if (shard := self._user_shards.pop(user_id, None)) is not None:
+                shard_data[shard].disconnected_users.add(user_id)
+
+        for user_id, vertex_data in incoming_data.new_users.items():
+            if user_id in self._user_shards:
+                logger.error(f"{user_id} is already in shard "
+                             f"{self._user_shards[user_id]}")
+                continue
+            shard = self._shard(vertex_data.mm_settings.age)
+            self._user_shards[user_id] = shard
+            self._user_data[user_id] = vertex_data
+            shard_data[shard].new_users[user_id] = vertex_data
+        return shard_data
+
+    def _match_boundary_users(self, boundary_users: dict[str, VertexData],
+                              failed_shards: set[int]) -> list[Match]:
+        if len(boundary_users) < 2:
+            return []
+
+        logger.info(f"Matching {len(boundary_users)} users "
+                    f"across shard boundaries")
+        matches = list(self._boundary_matchmaker.run_matchmaking_round(
+            MMRoundData(new_users=boundary_users)))
+        # the shards have the up to date weights and windows
+        # of the users left without a match
+        self._boundary_matchmaker.clear()
+
+        shard_matches: list[list[list[str]]] = [[] for _ in self._connections]
+        for match in matches:
+            # both users are marked at once when they share the shard
+            match_shards: dict[int, list[str]] = {}
+            for user_id in match:
+                match_shards.setdefault(
+                    self._user_shards[user_id], []).append(user_id)
+            for shard, user_ids in match_shards.items():
+                shard_matches[shard].append(user_ids)
+        for shard, connection in enumerate(self._connections):
+            if not shard_matches[shard] or shard in failed_shards:
+                continue
+            try:
+                connection.send(('matched', shard_matches[shard]))
+                self._observe_times_to_match(connection.recv())
+            except SHARD_ERRORS:
+                # restarted with the users in a call marked as matched
+                failed_shards.add(shard)
+
+        logger.info(f"Got {len(matches)} matches across shard boundaries")
+        return matches
@@ -0,0 +1,202 @@
+import asyncio
+import json
+import logging
+import os
+import secrets
+import socket
+from typing import Awaitable, Callable, Optional, Tuple
+
+import aioredis
+
+from swipe.matchmaking.schemas import Match
+from swipe.settings import settings
+from swipe.swipe_server.users.enums import Gender
+from swipe.ws_connection import MMUserData, WSConnectionManager
+
+logger = logging.getLogger(__name__)
+
+# a restarted container keeps its hostname and pid
+INSTANCE_ID = f'{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}'
+
+
+class SharedLobby:
+    """
+    Online users, sent matches and sockets of a lobby served by several
+    matchmaking server instances, kept in redis. An instance holds the
+    sockets of its users, payloads for the users of another instance
+    are published to the channel of that instance.
+    Instances refresh their heartbeat every
+    MATCHMAKING_INSTANCE_HEARTBEAT_SECS, users of an instance that
+    has missed three of them are taken out of the lobby by the others
+    """
+
+    def __init__(self, redis: aioredis.Redis, key: str,
+                 instance_id: str = INSTANCE_ID):
+        self.redis = redis
+        self.instance_id = instance_id
+        self._key = key
+        self._online_key = f'{key}:online'
+        # user_id -> [match user_id, accepted]
+        self._matches_key = f'{key}:matches'
+        # user_id -> instance and the user data
+        self._users_key = f'{key}:users'
+        self._instances_key = f'{key}:instances'
+
+    def _channel(self, instance_id: str) -> str:
+        return f'{self._key}:instance:{instance_id}'
+
+    def _heartbeat_key(self, instance_id: str) -> str:
+        return f'{self._key}:heartbeat:{instance_id}'
+
+    async def register(self, user_id: str, user_data: MMUserData):
+        """
+        The socket of the user is held by this instance
+        """
+        await self.redis.hset(self._users_key, user_id, json.dumps({
+            'instance': self.instance_id,
+            'age': user_data.age,
+            'gender': user_data.gender,
+            'gender_filter': user_data.gender_filter,
+        }))
+
+    async def add_online(self, user_id: str):
+        await self.redis.sadd(self._online_key, user_id)
+
+    async def disconnect(self, user_id: str):
+        await self.redis.srem(self._online_key, user_id)
+        user = await self._user(user_id)
+        # the user might have reconnected to another instance already
+        if user and user['instance'] == self.instance_id:
+            await self.redis.hdel(self._users_key, user_id)
+
+    async def is_connected(self, user_id: str) -> bool:
+        return await self.redis.hexists(self._users_key, user_id)
+
+    async def user_data(self, user_id: str) -> Optional[MMUserData]:
+        if (user := await self._user(user_id)) is None:
+            return None
+        return self._user_data(user)
+
+    async def lobby_state(self) -> Tuple[set[str], set[str]]:
+        """
+        Online users and users with a sent match
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.smembers(self._online_key)
+            pipe.hkeys(self._matches_key)
+            online_users, matched_users = await pipe.execute()
+        return online_users, set(matched_users)
+
+    async def add_match(self, user_a: str, user_b: str):
+        await self.redis.hset(self._matches_key, mapping={
+            user_a: json.dumps([user_b, False]),
+            user_b: json.dumps([user_a, False]),
+        })
+
+    async def get_match(self, user_id: str) -> Optional[Match]:
+        match = await self.redis.hget(self._matches_key, user_id)
+        return Match(*json.loads(match)) if match else None
+
+    async def accept_match(self, user_id: str):
+        if match := await self.get_match(user_id):
+            await self.redis.hset(self._matches_key, user_id,
+                                  json.dumps([match.user_id, True]))
+
+    async def remove_match(self, user_id: str):
+        await self.redis.hdel(self._matches_key, user_id)
+
+    async def send_text(self, user_id: str, text: str):
+        """
+        Publishes an encoded payload to the instance
+        holding the socket of the user
+        """
+        if (user := await self._user(user_id)) is None:
+            logger.info(f"{user_id} is not online, payload won't be sent")
+            return
+        await self.redis.publish(
+            self._channel(user['instance']),
+            json.dumps({'user_id': user_id, 'text': text}))
+
+    async def run(self, connection_manager: WSConnectionManager,
+                  on_users_lost: Callable[[dict[str, MMUserData]], Awaitable]):
+        """
+        Delivers payloads published for the users of this instance
+        and keeps the instance alive, the users of stopped instances
+        are handed to on_users_lost
+        """
+        await asyncio.gather(
+            self._deliver(connection_manager),
+            self._keep_alive(on_users_lost))
+
+    async def _deliver(self, connection_manager: WSConnectionManager):
+        while True:
+            try:
+                # the connection is released before subscribing again
+                async with self.redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self._channel(self.instance_id))
+                    async for message in pubsub.listen():
+                        if message['type'] == 'message':
+                            payload = json.loads(message['data'])
+                            await connection_manager.send_text(
+                                payload['user_id'], payload['text'])
+            except Exception:
+                logger.exception("Lost the channel of the instance, "
+                                 "subscribing again")
+                await asyncio.sleep(
+                    settings.MATCHMAKING_INSTANCE_HEARTBEAT_SECS)
+
+    async def _keep_alive(
+            self,
+            on_users_lost: Callable[[dict[str, MMUserData]], Awaitable]):
+        heartbeat_secs = settings.MATCHMAKING_INSTANCE_HEARTBEAT_SECS
+        while True:
+            try:
+                await self.redis.set(
+                    self._heartbeat_key(self.instance_id), 1,
+                    ex=3 * heartbeat_secs)
+                # added after the heartbeat, so that it's not taken
+                # for a stopped one
+                await self.redis.sadd(self._instances_key, self.instance_id)
+                for instance_id in await self.redis.smembers(
+                        self._instances_key):
+                    if await self.redis.exists(
+                            self._heartbeat_key(instance_id)):
+                        continue
+                    # only one of the instances gets to remove its users
+                    if await self.redis.srem(self._instances_key, instance_id):
+                        logger.warning(f"Instance {instance_id} has stopped")
+                        await on_users_lost(
+                            await self._remove_users_of(instance_id))
+            except Exception:
+                logger.exception("Unable to check the lobby instances")
+            await asyncio.sleep(heartbeat_secs)
+
+    async def _remove_users_of(self, instance_id: str) \
+            -> dict[str, MMUserData]:
+        """
+        Takes the users of the instance out of the lobby,
+        returns them with the data they have joined with
+        """
+        users = {}
+        for user_id, user in \
+                (await self.redis.hgetall(self._users_key)).items():
+            user = json.loads(user)
+            if user['instance'] == instance_id:
+                users[user_id] = self._user_data(user)
+        if users:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.hdel(self._users_key, *users)
+                pipe.srem(self._online_key, *users)
+                await pipe.execute()
+        return users
+
+    async def _user(self, user_id: str) -> Optional[dict]:
+        user = await self.redis.hget(self._users_key, user_id)
+        return json.loads(user) if user else None
+
+    @staticmethod
+    def _user_data(user: dict) -> MMUserData:
+        gender_filter = user['gender_filter']
+        return MMUserData(
+            age=user['age'], gender=Gender(user['gender']),
+            gender_filter=Gender(gender_filter) if gender_filter else None)
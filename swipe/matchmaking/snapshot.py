@@ -0,0 +1,117 @@
+import io
+import json
+import logging
+import os
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+
+from swipe.matchmaking.graph import ConnectionGraph, Vertex
+from swipe.matchmaking.schemas import MMSettings
+
+logger = logging.getLogger('matchmaker')
+
+# bumped whenever the layout of the snapshot changes
+SNAPSHOT_VERSION = 4
+
+
+def write_snapshot(path: str, snapshot: bytes):
+    """
+    Replaces the snapshot file, a crash while it's written
+    leaves the previous snapshot in place
+    """
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as snapshot_file:
+        snapshot_file.write(snapshot)
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path: str, max_age_secs: float) -> Optional[bytes]:
+    """
+    Returns the snapshot unless it's missing or too old to be useful
+    """
+    try:
+        age = time.time() - os.path.getmtime(path)
+        if age > max_age_secs:
+            logger.info(f"Snapshot {path} is {age:.0f}s old, ignoring it")
+            return None
+        with open(path, 'rb') as snapshot_file:
+            return snapshot_file.read()
+    except FileNotFoundError:
+        logger.info(f"No snapshot at {path}")
+        return None
+
+
+def encode_snapshot(graph: ConnectionGraph, empty_candidates: set[str],
+                    unmatched_users: set[str]) -> bytes:
+    """
+    Users with their settings and flags go to a json header,
+    vertex numbers and edges go to int arrays next to it.
+    Nothing in it is unpickled on load
+    """
+    vertices = list(graph.values())
+    header = {
+        'version': SNAPSHOT_VERSION,
+        'users': [vertex.user_id for vertex in vertices],
+        'mm_settings': [vertex.mm_settings.dict() for vertex in vertices],
+        'matched_users': [vertex.user_id for vertex in vertices
+                          if vertex.matched],
+        'disallowed_users': {
+            vertex.user_id: sorted(vertex.disallowed_users)
+            for vertex in vertices if vertex.disallowed_users
+        },
+        'empty_candidates': sorted(empty_candidates),
+        'unmatched_users': sorted(unmatched_users),
+        'size': graph.size,
+        'free_numbers': graph.free_numbers,
+    }
+    edge_sources, edge_targets, edge_bidirectional = [], [], []
+    for vertex in vertices:
+        for partner_number, bidirectional in graph.edges(vertex.number):
+            edge_sources.append(vertex.number)
+            edge_targets.append(partner_number)
+            edge_bidirectional.append(bidirectional)
+
+    snapshot = io.BytesIO()
+    np.savez(
+        snapshot,
+        header=np.frombuffer(json.dumps(header).encode(), dtype=np.uint8),
+        numbers=np.array([vertex.number for vertex in vertices],
+                         dtype=np.int32),
+        edge_sources=np.array(edge_sources, dtype=np.int32),
+        edge_targets=np.array(edge_targets, dtype=np.int32),
+        edge_bidirectional=np.array(edge_bidirectional, dtype=np.bool_))
+    return snapshot.getvalue()
+
+
+def decode_snapshot(snapshot: bytes, graph: ConnectionGraph) \
+        -> Tuple[set[str], set[str]]:
+    """
+    Fills an empty graph with the users and edges of the snapshot,
+    returns the users waiting for candidates and the unmatched ones.
+    Candidates and the other indexes are left to the matchmaker
+    """
+    with np.load(io.BytesIO(snapshot), allow_pickle=False) as arrays:
+        header = json.loads(arrays['header'].tobytes())
+        if header['version'] != SNAPSHOT_VERSION:
+            raise ValueError(
+                f"Snapshot version {header['version']} is not supported")
+
+        disallowed_users = header['disallowed_users']
+        vertices = [
+            Vertex(user_id, MMSettings.parse_obj(mm_settings),
+                   set(disallowed_users.get(user_id, ())))
+            for user_id, mm_settings
+            in zip(header['users'], header['mm_settings'])
+        ]
+        graph.restore(vertices, arrays['numbers'].tolist(),
+                      header['size'], header['free_numbers'])
+        for user_id in header['matched_users']:
+            graph[user_id].matched = True
+        for source, target, bidirectional in zip(
+                arrays['edge_sources'].tolist(),
+                arrays['edge_targets'].tolist(),
+                arrays['edge_bidirectional'].tolist()):
+            graph.connect(source, target, bidirectional)
+    return set(header['empty_candidates']), set(header['unmatched_users'])
@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import heapq
+import logging
+import time
+from typing import Iterator, TYPE_CHECKING
+
+import numpy as np
+
+from swipe.matchmaking.graph import Vertex, unpack_heap_entry
+from swipe.matchmaking.schemas import Match
+from swipe.settings import settings
+
+if TYPE_CHECKING:
+    from swipe.matchmaking.matchmaker import Matchmaker
+
+logger = logging.getLogger('matchmaker')
+
+
+def _can_match(vertex_1: Vertex, vertex_2: Vertex) -> bool:
+    return vertex_1.user_id not in vertex_2.disallowed_users \
+           and vertex_2.user_id not in vertex_1.disallowed_users
+
+
+class MatchingStrategy:
+    """
+    Picks pairs among the users of the current round.
+    Matched pairs are marked with `Matchmaker.mark_matched`,
+    users that got no match with `Matchmaker.mark_unmatched`
+    """
+
+    def generate_matches(self, matchmaker: Matchmaker,
+                         current_round_heap: list[int]) -> Iterator[Match]:
+        raise NotImplementedError()
+
+
+class GreedyMatchingStrategy(MatchingStrategy):
+    """
+    Users are taken from the heap one by one starting with the heaviest,
+    each of them gets the heaviest available candidate
+    """
+
+    def generate_matches(self, matchmaker: Matchmaker,
+                         current_round_heap: list[int]) -> Iterator[Match]:
+        heap_size = len(current_round_heap)
+        debug = logger.isEnabledFor(logging.DEBUG)
+        while heap_size:
+            if debug:
+                logger.debug(f"Current heap {current_round_heap}")
+            heap_size -= 1
+
+            # pick heap top
+            weight, number = \
+                unpack_heap_entry(heapq.heappop(current_round_heap))
+            current_vertex = matchmaker.graph.vertex(number)
+            current_user_id = current_vertex.user_id
+
+            logger.info(f"Got heap head: '{current_user_id}' weight: {weight}")
+
+            # skipping processed vertices
+            if current_vertex.processed:
+                if current_vertex.matched:
+                    logger.info(
+                        f"{current_user_id} already got a match this round")
+                    continue
+                logger.info(f"{current_user_id} was already processed, "
+                            f"but no match was found")
+                continue
+
+            # traverse connection graph
+            logger.info(f"Looking for match for {current_user_id}")
+            match_user_id: str = matchmaker.find_match(current_user_id)
+
+            if match_user_id:
+                logger.info(
+                    f"Found match {match_user_id} for {current_user_id}")
+                matchmaker.mark_matched(
+                    current_vertex, matchmaker.get_vertex(match_user_id))
+                yield current_user_id, match_user_id
+            else:
+                matchmaker.mark_unmatched(current_vertex)
+
+
+class AugmentingPathMatchingStrategy(MatchingStrategy):
+    """
+    Greedy pass followed by a search for augmenting paths of length three:
+    unmatched u - v matched to w - unmatched x turns into u = v and w = x.
+    Everyone matched by the greedy pass stays matched, so the heavy users
+    keep their priority and the round gets one more match per path.
+    The search stops once the time budget is spent,
+    matches are sent only after the search is over
+    """
+
+    def __init__(self, time_budget_secs: float =
+                 settings.MATCHMAKING_ROUND_LENGTH_SECS / 5):
+        self._time_budget_secs = time_budget_secs
+
+    def generate_matches(self, matchmaker: Matchmaker,
+                         current_round_heap: list[int]) -> Iterator[Match]:
+        graph = matchmaker.graph
+        # vertex number -> number of its partner in this round
+        partners: dict[int, int] = {}
+        # heaviest first
+        unmatched: list[Vertex] = []
+        while current_round_heap:
+            _, number = unpack_heap_entry(heapq.heappop(current_round_heap))
+            current_vertex = graph.vertex(number)
+            if current_vertex.processed:
+                continue
+
+            match_user_id = matchmaker.find_match(current_vertex.user_id)
+            if match_user_id:
+                match_vertex = graph[match_user_id]
+                matchmaker.mark_matched(current_vertex, match_vertex)
+                partners[number] = match_vertex.number
+                partners[match_vertex.number] = number
+            else:
+                current_vertex.processed = True
+                unmatched.append(current_vertex)
+
+        logger.info(f"Greedy pass got {len(partners) // 2} matches, "
+                    f"looking for augmenting paths for "
+                    f"{len(unmatched)} users")
+        free = np.zeros(graph.capacity, dtype=bool)
+        for vertex in unmatched:
+            free[vertex.number] = True
+
+        deadline = time.monotonic() + self._time_budget_secs
+        augmented = 0
+        for vertex in unmatched:
+            if time.monotonic() > deadline:
+                logger.info("Out of time, stopping the augmenting path search")
+                break
+            if free[vertex.number] and \
+                    self._augment(matchmaker, vertex, partners, free):
+                augmented += 1
+        logger.info(f"Found {augmented} augmenting paths")
+
+        for vertex in unmatched:
+            if free[vertex.number]:
+                matchmaker.mark_unmatched(vertex)
+
+        for number, partner_number in partners.items():
+            if number < partner_number:
+                yield graph.vertex(number).user_id, \
+                      graph.vertex(partner_number).user_id
+
+    def _augment(self, matchmaker: Matchmaker, vertex: Vertex,
+                 partners: dict[int, int], free: np.ndarray) -> bool:
+        graph = matchmaker.graph
+        for middle_number in matchmaker.partner_numbers(vertex):
+            if (far_number := partners.get(middle_number)) is None:
+                continue
+            middle_vertex = graph.vertex(middle_number)
+            if not _can_match(vertex, middle_vertex):
+                continue
+
+            far_vertex = graph.vertex(far_number)
+            far_partners = matchmaker.partner_numbers(far_vertex)
+            for end_number in far_partners[free[far_partners]]:
+                end_vertex = graph.vertex(end_number)
+                if end_vertex is vertex \
+                        or not _can_match(far_vertex, end_vertex):
+                    continue
+
+                logger.info(f"Rematching {middle_vertex.user_id} "
+                            f"to {vertex.user_id} and {far_vertex.user_id} "
+                            f"to {end_vertex.user_id}")
+                partners[vertex.number] = middle_vertex.number
+                partners[middle_vertex.number] = vertex.number
+                partners[far_vertex.number] = end_vertex.number
+                partners[end_vertex.number] = far_vertex.number
+                free[vertex.number] = False
+                free[end_vertex.number] = False
+                matchmaker.mark_matched(vertex, middle_vertex)
+                matchmaker.mark_matched(far_vertex, end_vertex)
+                return True
+        return False
+
+
+MATCHING_STRATEGIES: dict[str, type[MatchingStrategy]] = {
+    'greedy': GreedyMatchingStrategy,
+    'augmenting': AugmentingPathMatchingStrategy,
+}
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import logging
+from typing import Optional, Iterator, Tuple, Iterable, TYPE_CHECKING
+
+import numpy as np
+
+from swipe.matchmaking.schemas import MMSettings
+from swipe.swipe_server.users.enums import Gender
+
+if TYPE_CHECKING:
+    from swipe.matchmaking.matchmaker import Vertex
+
+logger = logging.getLogger('matchmaker')
+
+GENDER_CODES = {gender: code for code, gender in enumerate(Gender)}
+NO_GENDER_FILTER = -1
+
+# user_id, vertex -> other, other -> vertex
+Connection = Tuple[str, bool, bool]
+
+
+def _gender_code(gender: Optional[Gender]) -> int:
+    return NO_GENDER_FILTER if gender is None else GENDER_CODES[gender]
+
+
+class VertexArrays:
+    """
+    Filtering criteria of the graph vertices stored in contiguous arrays.
+    Compatibility of a vertex with the whole graph is computed
+    as a pair of boolean masks in one call instead of calling
+    `Vertex.can_connect_to` for every vertex pair
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self._age = np.zeros(capacity, dtype=np.int16)
+        self._age_diff = np.zeros(capacity, dtype=np.int16)
+        self._gender = np.zeros(capacity, dtype=np.int8)
+        self._gender_filter = np.zeros(capacity, dtype=np.int8)
+        # removed vertices leave holes which are reused by new ones
+        self._alive = np.zeros(capacity, dtype=bool)
+
+        self._user_ids: list[Optional[str]] = [None] * capacity
+        self._slots: dict[str, int] = {}
+        self._free_slots: list[int] = []
+        # number of slots that have ever been used
+        self._size = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, user_id: str):
+        return user_id in self._slots
+
+    def add(self, user_id: str, mm_settings: MMSettings):
+        if user_id in self._slots:
+            self.update(user_id, mm_settings)
+            return
+
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        else:
+            if self._size == len(self._alive):
+                self._grow()
+            slot = self._size
+            self._size += 1
+
+        self._slots[user_id] = slot
+        self._user_ids[slot] = user_id
+        self._alive[slot] = True
+        self.update(user_id, mm_settings)
+
+    def update(self, user_id: str, mm_settings: MMSettings):
+        slot = self._slots[user_id]
+        self._age[slot] = mm_settings.age
+        self._age_diff[slot] = mm_settings.age_diff
+        self._gender[slot] = _gender_code(mm_settings.gender)
+        self._gender_filter[slot] = _gender_code(mm_settings.gender_filter)
+
+    def remove(self, user_id: str):
+        if (slot := self._slots.pop(user_id, None)) is None:
+            return
+
+        self._alive[slot] = False
+        self._user_ids[slot] = None
+        self._free_slots.append(slot)
+
+    def compatibility(self, mm_settings: MMSettings,
+                      slots: Optional[np.ndarray] = None) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns two boolean masks over the slots (all of them by default):
+        vertex -> other and other -> vertex.
+        Disallowed users are not taken into account here
+        """
+        index = slice(0, self._size) if slots is None else slots
+        age, age_diff = self._age[index], self._age_diff[index]
+        gender, gender_filter = \
+            self._gender[index], self._gender_filter[index]
+
+        age_distance = np.abs(age.astype(np.int32) - mm_settings.age)
+        outgoing = (age_distance <= mm_settings.age_diff) & self._alive[index]
+        if mm_settings.gender_filter is not None:
+            outgoing &= gender == _gender_code(mm_settings.gender_filter)
+
+        incoming = (age_distance <= age_diff) & self._alive[index] \
+                   & ((gender_filter == NO_GENDER_FILTER) |
+                      (gender_filter == _gender_code(mm_settings.gender)))
+        return outgoing, incoming
+
+    def bidirectional(self, mm_settings: MMSettings) -> np.ndarray:
+        outgoing, incoming = self.compatibility(mm_settings)
+        return outgoing & incoming
+
+    def connections(self, vertex: Vertex, graph: dict[str, Vertex],
+                    user_ids: Optional[Iterable[str]] = None) \
+            -> Iterator[Connection]:
+        """
+        Yields every vertex of the graph (or only `user_ids`) the vertex
+        can connect to in at least one direction
+        """
+        if user_ids is None:
+            slots = None
+            outgoing, incoming = self.compatibility(vertex.mm_settings)
+        else:
+            slots = np.fromiter(
+                (self._slots[user_id] for user_id in user_ids
+                 if user_id in self._slots), dtype=np.int64)
+            outgoing, incoming = \
+                self.compatibility(vertex.mm_settings, slots)
+
+        # applying temporary blacklists, they are tiny compared to the graph
+        # so they are checked only for the slots that are still connected
+        for position in np.flatnonzero(outgoing | incoming):
+            slot = position if slots is None else slots[position]
+            user_id = self._user_ids[slot]
+            if user_id == vertex.user_id:
+                continue
+
+            can_connect = bool(outgoing[position]) \
+                          and user_id not in vertex.disallowed_users
+            can_be_connected = bool(incoming[position]) \
+                               and vertex.user_id not in \
+                               graph[user_id].disallowed_users
+            if can_connect or can_be_connected:
+                yield user_id, can_connect, can_be_connected
+
+    def _grow(self):
+        capacity = len(self._alive) * 2
+        logger.info(f"Growing vertex arrays to {capacity}")
+        self._age = np.resize(self._age, capacity)
+        self._age_diff = np.resize(self._age_diff, capacity)
+        self._gender = np.resize(self._gender, capacity)
+        self._gender_filter = np.resize(self._gender_filter, capacity)
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:len(self._alive)] = self._alive
+        self._alive = alive
+        self._user_ids.extend([None] * (capacity - len(self._user_ids)))
@@ -62,7 +62,19 @@ class Settings(BaseSettings):
     MATCHMAKING_TEXT_CHAT_SERVER_PORT: Optional[int]
 
     MATCHMAKING_ROUND_LENGTH_SECS = 5
+    # rounds get shorter or longer to keep the time it takes 95% of users
+    # to get a match under the target, 0 keeps the length of every round
+    # at MATCHMAKING_ROUND_LENGTH_SECS
+    MATCHMAKING_TARGET_P95_TIME_TO_MATCH_SECS: float = 0
+    MATCHMAKING_MIN_ROUND_LENGTH_SECS: float = 0
+    MATCHMAKING_MAX_ROUND_LENGTH_SECS: float = 30
     MATCHMAKING_FETCH_LIMIT = 150
+    # online users of the ages within this difference are read along with
+    # the rest of the data of a connecting user in a single round trip
+    MATCHMAKING_CONNECT_PREFETCH_AGE_DIFF = 5
+    # users sent to a restarted matchmaker again are looked up
+    # this many at a time
+    MATCHMAKING_RECONNECT_BATCH_SIZE = 50
 
     MATCHMAKING_BLACKLIST_ENABLED: Optional[bool] = False
     MATCHMAKING_DEFAULT_AGE_DIFF = 0
@@ -70,6 +82,74 @@ class Settings(BaseSettings):
     MATCHMAKING_MAX_AGE_DIFF = 20
 
     MATCHMAKING_DEBUG_MODE: Optional[bool] = False
+    # sdp and ice payloads are forwarded to the recipient as they came,
+    # only the type, sender and recipient are looked up
+    MATCHMAKING_RELAY_SIGNALING: Optional[bool] = False
+    MATCHMAKING_VECTORIZED_COMPATIBILITY: Optional[bool] = False
+    # users are connected through their (age, gender, gender_filter, age_diff)
+    # classes instead of the edges of every pair
+    MATCHMAKING_CLASS_GRAPH: Optional[bool] = False
+    # bidirectional edges shared by all the users of the lobby,
+    # a user gets at least MATCHMAKING_EDGE_BUDGET_MIN_PER_USER of them.
+    # 0 connects every pair of compatible users
+    MATCHMAKING_EDGE_BUDGET: int = 0
+    MATCHMAKING_EDGE_BUDGET_MIN_PER_USER: int = 30
+    # edges in an N x N bit matrix instead of per-user sets,
+    # only for small lobbies where most of the users are connected
+    MATCHMAKING_DENSE_GRAPH: Optional[bool] = False
+    # greedy | augmenting
+    MATCHMAKING_MATCHING_STRATEGY: str = 'greedy'
+    # number of matchmaker worker processes, split by age bands
+    MATCHMAKING_SHARDS: int = 1
+    # ages up to this one are split into even bands,
+    # older users go to the last one
+    MATCHMAKING_SHARD_MAX_AGE = 50
+    # new data is matched as soon as it's fetched,
+    # full rounds are still run every MATCHMAKING_ROUND_LENGTH_SECS
+    MATCHMAKING_EVENT_DRIVEN: Optional[bool] = False
+    MATCHMAKING_EVENT_POLL_INTERVAL_SECS = 0.25
+    # candidates of users without matches are fetched in batches,
+    # a batch grows while it's fetched faster than the timeout allows
+    MATCHMAKING_REFILL_TIMEOUT_SECS = 1
+    MATCHMAKING_REFILL_INITIAL_BATCH_SIZE = 10
+    MATCHMAKING_REFILL_MAX_BATCH_SIZE = 500
+    # lobby events go to a redis stream instead of /new_round_data
+    MATCHMAKING_EVENT_LOG_ENABLED: Optional[bool] = False
+    MATCHMAKING_EVENT_STREAM = 'matchmaking_round_data'
+    MATCHMAKING_EVENT_STREAM_MAX_LENGTH = 100000
+    # entries of a round that keeps failing are moved to
+    # MATCHMAKING_EVENT_STREAM + '_dead_letter' after this many attempts
+    MATCHMAKING_EVENT_MAX_ATTEMPTS = 3
+    # matchmaker state is saved to this file and restored after a restart,
+    # snapshots are disabled without a path
+    MATCHMAKING_SNAPSHOT_PATH: Optional[str] = None
+    MATCHMAKING_SNAPSHOT_INTERVAL_SECS = 30
+    # older snapshots are ignored, the lobby is rebuilt from scratch
+    MATCHMAKING_SNAPSHOT_MAX_AGE_SECS = 600
+    # phase timings, graph sizes and time to match are written
+    # to this json file after every round
+    MATCHMAKING_METRICS_PATH: Optional[str] = None
+    # matchmaking server appends the round data, candidates and matches
+    # to this file, see bin/matchmaker_benchmark.py replay
+    MATCHMAKING_RECORD_PATH: Optional[str] = None
+    # matchmaker runs in a child process of the matchmaking server
+    # instead of a separate container
+    MATCHMAKING_EMBEDDED: Optional[bool] = False
+    # lobbies hosted by one matchmaking server, ["video", "audio", "text"],
+    # each of them is served under its own prefix, /video/connect/...
+    # Event streams, snapshots, metrics and recordings of a lobby get
+    # the mode appended to their names, matchmaking_round_data_video.
+    # Empty hosts a single lobby at the root
+    MATCHMAKING_MODES: list[str] = []
+    # several instances of the matchmaking server serve the same lobbies,
+    # online users and sent matches are kept in redis under this key
+    # and payloads are sent through the instance holding the socket.
+    # Needs the event log and a standalone matchmaker
+    MATCHMAKING_SHARED_LOBBY: Optional[bool] = False
+    MATCHMAKING_SHARED_LOBBY_KEY = 'matchmaking_lobby'
+    # users of an instance that has missed three heartbeats
+    # are taken out of the lobby
+    MATCHMAKING_INSTANCE_HEARTBEAT_SECS = 5
 
     USER_FETCH_MINIMUM_AGE = 18
     USER_FETCH_DEFAULT_AGE_DIFF = 0
@@ -84,6 +164,9 @@ class Settings(BaseSettings):
     SENTRY_CHAT_SERVER_URL: Optional[str] = None
 
     USER_MODEL_CACHE_TTL_SEC = 60 * 60
+    # previews are updated along with the profile,
+    # the ttl only catches changes made elsewhere
+    MATCHMAKING_PREVIEW_CACHE_TTL_SEC = 7 * 24 * 60 * 60
 
     # TODO change in prod
     SENTRY_SAMPLE_RATE = 1.0
@@ -21,7 +21,8 @@ from swipe.swipe_server.users.services.online_cache import \
 from swipe.swipe_server.users.services.popular_cache import PopularUserService
 from swipe.swipe_server.users.services.redis_services import \
     RedisLocationService, \
-    RedisBlacklistService, RedisUserCacheService
+    RedisBlacklistService, RedisUserCacheService, \
+    RedisMatchmakingPreviewService
 from swipe.swipe_server.users.services.user_service import UserService
 
 IMAGE_CONTENT_TYPE_REGEXP = 'image/(png|jpe?g)'
@@ -80,6 +81,7 @@ async def patch_user(
         redis_location: RedisLocationService = Depends(),
         redis_online: RedisOnlineUserService = Depends(),
         redis_user: RedisUserCacheService = Depends(),
+        redis_preview: RedisMatchmakingPreviewService = Depends(),
         user_id: UUID = Depends(security.auth_user_id)):
     logger.debug(f"Got patch with {user_body.dict()}")
 
@@ -125,6 +127,12 @@ async def patch_user(
         logger.warning(
             f"No location set on user {user_id}, not updating cache")
 
+    # gender and date of birth are set before the location
+    try:
+        await redis_preview.cache_preview(current_user)
+    except:
+        logger.exception("Error updating matchmaking preview cache")
+
     return UserOut.from_orm(current_user)
 
 
@@ -138,6 +146,7 @@ async def delete_user(
         redis_blacklist: RedisBlacklistService = Depends(),
         redis_online: RedisOnlineUserService = Depends(),
         redis_user:RedisUserCacheService = Depends(),
+        redis_preview: RedisMatchmakingPreviewService = Depends(),
         popular_service: PopularUserService = Depends(),
         user_id: UUID = Depends(security.auth_user_id)):
     current_user: User = user_service.get_user(user_id)
@@ -151,6 +160,7 @@ async def delete_user(
         await redis_online.remove_from_online_caches(current_user)
 
     await redis_user.drop_user(str(user_id))
+    await redis_preview.drop_preview(str(user_id))
     await redis_blacklist.drop_blacklist_cache(str(user_id))
 
     logger.info(f"Deleting chats of {user_id}")
@@ -1,7 +1,9 @@
 import logging
 from dataclasses import dataclass
+from typing import Iterable, Tuple
 
 from aioredis import Redis
+from aioredis.client import Pipeline
 from fastapi import Depends
 
 from swipe.settings import settings
@@ -10,7 +12,8 @@ from swipe.swipe_server.users.schemas import OnlineFilterBody
 from swipe.swipe_server.users.services.online_cache import OnlineUserCache
 from swipe.swipe_server.users.services.redis_services import \
     RedisUserFetchService, \
-    RedisPopularService, RedisBlacklistService, UserFetchCacheKey
+    RedisPopularService, RedisBlacklistService, UserFetchCacheKey, \
+    RedisChatCacheService
 
 logger = logging.getLogger(__name__)
 
@@ -29,62 +32,111 @@ class FetchUserService:
         self.redis_popular = RedisPopularService(redis)
         self.redis_online = online_cache
         self.redis_blacklist = RedisBlacklistService(redis)
+        self.redis_chats = RedisChatCacheService(redis)
+        self.redis = redis
 
     async def collect(self, user_id: str, user_age: int,
                       filter_params: OnlineFilterBody,
-                      disallowed_users: set[str] = None) -> set[str]:
-        logger.info(f"Collecting users for {user_id}, params: {filter_params}")
-        disallowed_users = disallowed_users or set()
-        disallowed_users.add(user_id)
-
-        # checking against currently online users
-        allowed_users = await self.redis_online.allowed_users()
-        logger.info(f"Allowed users: {allowed_users or 'ALL'}")
-        logger.info(f"Disallowed users: {disallowed_users}")
+                      disallowed_users: set[str] = None,
+                      prefetch_age_difference: int =
+                      settings.USER_FETCH_AGE_DIFF_STEP) -> set[str]:
+        result, _ = await self._collect(
+            user_id, user_age, filter_params, disallowed_users or set(),
+            prefetch_age_difference, read_disallowed_users=False)
+        return result
 
+    async def collect_on_connect(
+            self, user_id: str, user_age: int,
+            filter_params: OnlineFilterBody,
+            prefetch_age_difference: int = settings.USER_FETCH_AGE_DIFF_STEP) \
+            -> Tuple[set[str], set[str]]:
+        """
+        Collects users for a user connecting to matchmaking with their chat
+        partners and blacklist disallowed, they are read along with
+        everything else. Returns the users and the disallowed ones
+        """
+        return await self._collect(
+            user_id, user_age, filter_params, set(),
+            prefetch_age_difference, read_disallowed_users=True)
+
+    async def _collect(
+            self, user_id: str, user_age: int,
+            filter_params: OnlineFilterBody, disallowed_users: set[str],
+            prefetch_age_difference: int, read_disallowed_users: bool) \
+            -> Tuple[set[str], set[str]]:
+        """
+        The caches of the session and the online users of the ages within
+        prefetch_age_difference are read in one round trip and the caches
+        are updated in another
+        """
+        logger.info(f"Collecting users for {user_id}, params: {filter_params}")
         fetch_cache_params = UserFetchCacheKey(
             session_id=filter_params.session_id,
             user_id=user_id
         )
+        prefetched_ages = self._age_range(user_age, prefetch_age_difference)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            if read_disallowed_users:
+                self.redis_chats.read_chat_partners(pipe, user_id)
+                self.redis_blacklist.read_blacklist(pipe, user_id)
+            self.redis_fetch.read_caches(pipe, fetch_cache_params)
+            for age in prefetched_ages:
+                self._read_online_users(pipe, age, filter_params)
+            replies = iter(await pipe.execute())
+
+        if read_disallowed_users:
+            disallowed_users.update(
+                self.redis_chats.chat_partners_reply(replies))
+            disallowed_users.update(
+                self.redis_blacklist.blacklist_reply(replies))
+        disallowed_users.add(user_id)
+        logger.info(f"Disallowed users: {disallowed_users}")
 
-        await self.redis_fetch.drop_obsolete_caches(fetch_cache_params)
-        cached_user_ids: set[str] = \
-            await self.redis_fetch.get_response_cache(fetch_cache_params)
-
-        age_difference = \
-            await self.redis_fetch.get_cached_age_difference(
-                fetch_cache_params)
+        cached_user_ids, age_difference, obsolete_keys = \
+            self.redis_fetch.caches_reply(fetch_cache_params, replies)
         logger.debug(f"Cached age difference {age_difference}")
-        # age->(index, user_list)
-        online_users_pool = {}
 
+        online_users_pool = self._user_pools(prefetched_ages, replies)
+        result, age_difference = await self._pick_candidates(
+            user_id, user_age, filter_params, age_difference,
+            cached_user_ids, disallowed_users, online_users_pool)
+
+        # got enough users or max age diff reached
+        async with self.redis.pipeline(transaction=False) as pipe:
+            self.redis_fetch.write_caches(
+                pipe, fetch_cache_params, result, age_difference,
+                obsolete_keys)
+            await pipe.execute()
+        return result, disallowed_users
+
+    async def _pick_candidates(
+            self, user_id: str, user_age: int,
+            filter_params: OnlineFilterBody, age_difference: int,
+            cached_user_ids: set[str], disallowed_users: set[str],
+            online_users_pool: dict[int, UserPool]) -> Tuple[set[str], int]:
+        """
+        Picks users one per age pool widening the age range until
+        there's enough of them, the pools missing from online_users_pool
+        are read one pipeline per range. Returns the users
+        and the age difference reached
+        """
         result = set()
         while len(result) < filter_params.limit \
                 and age_difference <= settings.USER_FETCH_MAX_AGE_DIFF:
-            shift = -1
-            # we're going age+0,-1,1,-2,2 etc
-            sorted_age_range = [user_age]
             logger.debug(f"Current age {user_age}, diff {age_difference}")
-            while len(sorted_age_range) < age_difference * 2 + 1:
-                # less than user_age so we're checking it here
-                potential_age = user_age + shift
-                if potential_age >= settings.USER_FETCH_MINIMUM_AGE:
-                    sorted_age_range.append(potential_age)
-
-                sorted_age_range.append(user_age - shift)
-                shift = - (abs(shift) + 1)
+            sorted_age_range = self._age_range(user_age, age_difference)
             logger.debug(f"Checking age range {sorted_age_range}")
 
             # filling current user pool
-            for current_age in sorted_age_range:
-                if current_age not in online_users_pool:
-                    user_cache = \
-                        await self.redis_online.get_online_users(
-                            current_age, filter_params)
-                    user_cache = list(user_cache)
-                    online_users_pool[current_age] = UserPool(user_cache)
-                    logger.debug(f"Got {len(user_cache)} online users "
-                                 f"for age={current_age}")
+            missing_ages = [age for age in sorted_age_range
+                            if age not in online_users_pool]
+            if missing_ages:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for current_age in missing_ages:
+                        self._read_online_users(
+                            pipe, current_age, filter_params)
+                    online_users_pool.update(self._user_pools(
+                        missing_ages, await pipe.execute()))
 
             for current_age in sorted_age_range:
                 current_pool: UserPool = online_users_pool[current_age]
@@ -95,15 +147,13 @@ class FetchUserService:
                     logger.debug(f"Testing candidate {candidate} for {user_id}")
                     if candidate not in cached_user_ids \
                             and candidate not in disallowed_users:
-                        if allowed_users is None or \
-                                allowed_users and candidate in allowed_users:
-                            logger.info(
-                                f"Found {candidate} in user pool "
-                                f"for age={current_age}")
-                            result.add(candidate)
-                        else:
-                            logger.debug(
-                                f"{candidate} is disallowed for {user_id}")
+                        logger.info(
+                            f"Found {candidate} in user pool "
+                            f"for age={current_age}")
+                        result.add(candidate)
+                    else:
+                        logger.debug(
+                            f"{candidate} is disallowed for {user_id}")
 
                 if len(result) == filter_params.limit:
                     # got enough users
@@ -116,10 +166,41 @@ class FetchUserService:
                     f"increasing age_difference to {age_difference}")
                 continue
 
-        # got enough users or max age diff reached
-        await self.redis_fetch.add_to_response_cache(
-            fetch_cache_params, result)
-
-        await self.redis_fetch.save_age_difference_cache(
-            fetch_cache_params, age_difference)
-        return result
+        return result, age_difference
+
+    def _read_online_users(self, pipe: Pipeline, age: int,
+                           filter_params: OnlineFilterBody):
+        online_users_key = \
+            self.redis_online.online_users_key(age, filter_params)
+        allowed_users_key = self.redis_online.allowed_users_key()
+        if allowed_users_key:
+            # checked against currently online users by redis
+            # instead of loading all of them
+            pipe.sinter(online_users_key, allowed_users_key)
+        else:
+            pipe.smembers(online_users_key)
+
+    @staticmethod
+    def _age_range(user_age: int, age_difference: int) -> list[int]:
+        shift = -1
+        # we're going age+0,-1,1,-2,2 etc
+        sorted_age_range = [user_age]
+        while len(sorted_age_range) < age_difference * 2 + 1:
+            # less than user_age so we're checking it here
+            potential_age = user_age + shift
+            if potential_age >= settings.USER_FETCH_MINIMUM_AGE:
+                sorted_age_range.append(potential_age)
+
+            sorted_age_range.append(user_age - shift)
+            shift = - (abs(shift) + 1)
+        return sorted_age_range
+
+    @staticmethod
+    def _user_pools(ages: Iterable[int], online_users: Iterable[set[str]]) \
+            -> dict[int, UserPool]:
+        # age->(index, user_list)
+        online_users_pool = {}
+        for age, user_cache in zip(ages, online_users):
+            online_users_pool[age] = UserPool(list(user_cache))
+            logger.debug(f"Got {len(user_cache)} online users for age={age}")
+        return online_users_pool
@@ -67,9 +67,13 @@ class OnlineUserCache(ABC, Generic[T]):
         pass
 
     @abstractmethod
-    async def allowed_users(self) -> Optional[set[str]]:
+    def online_users_key(
+            self, age: int, filter_params: OnlineFilterBody) -> str:
         pass
 
+    def allowed_users_key(self) -> Optional[str]:
+        return None
+
 
 @dataclass
 class OnlineMatchmakingUserCacheParams:
@@ -103,14 +107,19 @@ class RedisMatchmakingOnlineUserService(
                  redis: Redis = Depends(dependencies.redis)):
         super().__init__(redis)
 
-    async def allowed_users(self) -> Optional[set[str]]:
-        return await self.redis.smembers(f'{self.MATCHMAKING_ALL_USERS_KEY}')
+    def allowed_users_key(self) -> Optional[str]:
+        return f'{self.MATCHMAKING_ALL_USERS_KEY}'
 
     async def get_online_users(
             self, age: int, filter_params: OnlineFilterBody) -> set[str]:
+        return await self.redis.smembers(
+            self.online_users_key(age, filter_params))
+
+    def online_users_key(
+            self, age: int, filter_params: OnlineFilterBody) -> str:
         cache_params = OnlineMatchmakingUserCacheParams(
             age=age, gender=filter_params.gender)
-        return await self.redis.smembers(cache_params.cache_key())
+        return cache_params.cache_key()
 
     async def add_to_online_caches(self, user: User):
         logger.info(f"Adding {user.id} to matchmaking cache sets")
@@ -136,6 +145,18 @@ class RedisMatchmakingOnlineUserService(
             await self.redis.srem(key, user_id)
         await self.redis.srem(f'{self.MATCHMAKING_ALL_USERS_KEY}', user_id)
 
+    async def remove_users_from_online_caches(
+            self, users: dict[str, OnlineMatchmakingUserCacheParams]):
+        if not users:
+            return
+        logger.info(f"Removing {len(users)} users from matchmaking user list")
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id, cache_params in users.items():
+                for key in cache_params.online_keys():
+                    pipe.srem(key, user_id)
+            pipe.srem(f'{self.MATCHMAKING_ALL_USERS_KEY}', *users)
+            await pipe.execute()
+
 
 class RedisOnlineUserService(OnlineUserCache[OnlineUserCacheParams]):
     """
@@ -153,15 +174,17 @@ class RedisOnlineUserService(OnlineUserCache[OnlineUserCacheParams]):
                  redis: Redis = Depends(dependencies.redis)):
         super().__init__(redis)
 
-    async def allowed_users(self) -> Optional[set[str]]:
-        return None
-
     async def get_online_users(
             self, age: int, filter_params: OnlineFilterBody) -> set[str]:
+        return await self.redis.smembers(
+            self.online_users_key(age, filter_params))
+
+    def online_users_key(
+            self, age: int, filter_params: OnlineFilterBody) -> str:
         cache_params = OnlineUserCacheParams(
             age=age, country=filter_params.country,
             city=filter_params.city, gender=filter_params.gender)
-        return await self.redis.smembers(cache_params.cache_key())
+        return cache_params.cache_key()
 
     async def cache_user(self, user: User):
         json_data = UserCardPreviewOut.from_orm(user).json()
@@ -1,11 +1,13 @@
 import logging
 from dataclasses import dataclass
-from datetime import datetime, timedelta
-from typing import Optional, Tuple, AsyncGenerator, Iterable, Union
+from datetime import date, datetime, timedelta
+from typing import Optional, Tuple, AsyncGenerator, Iterable, Iterator, \
+    Union
 from uuid import UUID
 
 import aioredis
 from aioredis import Redis
+from aioredis.client import Pipeline
 from fastapi import Depends
 
 from swipe.settings import settings, constants
@@ -145,6 +147,20 @@ class RedisBlacklistService:
     async def get_blacklist(self, user_id: str) -> set[str]:
         return await self.redis.smembers(f'{self.BLACKLIST_KEY}:{user_id}')
 
+    def read_blacklist(self, pipe: Pipeline, user_id: str):
+        """
+        Queues the read of the blacklist on the pipeline,
+        `blacklist_reply` takes it from the replies
+        """
+        if settings.SWIPE_BLACKLIST_ENABLED:
+            pipe.smembers(f'{self.BLACKLIST_KEY}:{user_id}')
+
+    @staticmethod
+    def blacklist_reply(replies: Iterator) -> set[str]:
+        if not settings.SWIPE_BLACKLIST_ENABLED:
+            return set()
+        return set(next(replies))
+
     @enable_blacklist()
     async def add_to_blacklist_cache(
             self, blocked_user_id: str, blocked_by_id: str):
@@ -200,6 +216,17 @@ class RedisChatCacheService:
     async def get_chat_partners(self, user_id) -> set[str]:
         return await self.redis.smembers(f'{self.CHAT_CACHE_KEY}:{user_id}')
 
+    def read_chat_partners(self, pipe: Pipeline, user_id: str):
+        """
+        Queues the read of the chat partners on the pipeline,
+        `chat_partners_reply` takes them from the replies
+        """
+        pipe.smembers(f'{self.CHAT_CACHE_KEY}:{user_id}')
+
+    @staticmethod
+    def chat_partners_reply(replies: Iterator) -> set[str]:
+        return set(next(replies))
+
     async def remove_chat_partner(self, user_id: str, partner_id: str):
         key = f'{self.CHAT_CACHE_KEY}:{user_id}'
         if await self.redis.exists(key):
@@ -209,6 +236,8 @@ class RedisChatCacheService:
 
 FETCH_REQUEST_KEY = 'fetch_request'
 FETCH_AGE_DIFF_KEY = 'fetch_request_age_diff'
+# sessions of the user that have caches
+FETCH_SESSIONS_KEY = 'fetch_request_sessions'
 
 
 @dataclass
@@ -222,8 +251,18 @@ class UserFetchCacheKey:
     def cache_age_diff_key(self):
         return f'{FETCH_AGE_DIFF_KEY}:{self.user_id}:{self.session_id}'
 
-    def key_user_wildcard(self):
-        return f'{FETCH_REQUEST_KEY}:{self.user_id}:*'
+    def sessions_key(self):
+        return f'{FETCH_SESSIONS_KEY}:{self.user_id}'
+
+    def session_keys(self, session_ids: Iterable[str]) -> list[str]:
+        """
+        Caches of the sessions of the user along with the set of them
+        """
+        keys = [self.sessions_key()]
+        for session_id in session_ids:
+            session = UserFetchCacheKey(self.user_id, session_id)
+            keys.extend([session.cache_key(), session.cache_age_diff_key()])
+        return keys
 
 
 class RedisUserFetchService:
@@ -243,55 +282,64 @@ class RedisUserFetchService:
 
         return set()
 
-    async def get_cached_age_difference(
-            self, cache_settings: UserFetchCacheKey) -> int:
-        cached_age_diff = await self.redis.get(
-            cache_settings.cache_age_diff_key())
-        return int(cached_age_diff) if cached_age_diff else \
-            settings.USER_FETCH_DEFAULT_AGE_DIFF
-
-    async def save_age_difference_cache(
-            self, cache_settings: UserFetchCacheKey, age_difference: int):
-        logger.debug(f"Saving age difference {age_difference} "
-                     f"for {cache_settings.user_id}")
-        await self.redis.set(
-            cache_settings.cache_age_diff_key(), age_difference)
-        # failsafe
-        await self.redis.expire(
-            cache_settings.cache_key(), settings.ONLINE_USER_RESPONSE_CACHE_TTL)
-
-    async def drop_obsolete_caches(
-            self, cache_settings: UserFetchCacheKey):
-        if not await self.redis.exists(cache_settings.cache_key()):
-            # no key with current session
-            # but there is an older one
-            if await self.redis.keys(cache_settings.key_user_wildcard()):
-                logger.info(
-                    f"Removing previous cache for {cache_settings.user_id}")
-                # drop other requests for other session_ids
-                await self.drop_response_cache(cache_settings.user_id)
-
-    async def add_to_response_cache(
-            self, cache_settings: UserFetchCacheKey,
-            current_user_ids: set[str]):
-        if not current_user_ids:
-            return
+    def read_caches(self, pipe: Pipeline, cache_settings: UserFetchCacheKey):
+        """
+        Queues the reads of the caches of the session on the pipeline,
+        `caches_reply` takes them from the replies
+        """
+        pipe.smembers(cache_settings.cache_key())
+        pipe.get(cache_settings.cache_age_diff_key())
+        pipe.smembers(cache_settings.sessions_key())
 
+    @staticmethod
+    def caches_reply(cache_settings: UserFetchCacheKey, replies: Iterator) \
+            -> Tuple[set[str], int, list[str]]:
+        """
+        Users already returned in the session, its age difference
+        and the keys of the caches to drop
+        """
+        cached_user_ids: set[str] = set(next(replies))
+        cached_age_diff = next(replies)
+        session_ids: set[str] = set(next(replies))
+        obsolete_keys = []
+        if not cached_user_ids \
+                and session_ids - {cache_settings.session_id}:
+            # no key with current session but there is an older one,
+            # caches of all the sessions are dropped
+            logger.info(f"Removing previous cache for {cache_settings.user_id}")
+            obsolete_keys = cache_settings.session_keys(
+                session_ids | {cache_settings.session_id})
+            cached_age_diff = None
+        age_difference = int(cached_age_diff) if cached_age_diff \
+            else settings.USER_FETCH_DEFAULT_AGE_DIFF
+        return cached_user_ids, age_difference, obsolete_keys
+
+    def write_caches(self, pipe: Pipeline, cache_settings: UserFetchCacheKey,
+                     user_ids: set[str], age_difference: int,
+                     obsolete_keys: list[str]):
+        """
+        Queues the update of the caches of the session on the pipeline
+        """
         logger.debug(f"Extending response cache for {cache_settings.user_id} "
-                     f"with {current_user_ids}")
-        await self.redis.sadd(cache_settings.cache_key(), *current_user_ids)
+                     f"with {user_ids}, age difference {age_difference}")
+        if obsolete_keys:
+            pipe.delete(*obsolete_keys)
+        if user_ids:
+            pipe.sadd(cache_settings.cache_key(), *user_ids)
+        pipe.set(cache_settings.cache_age_diff_key(), age_difference)
+        pipe.sadd(cache_settings.sessions_key(), cache_settings.session_id)
         # failsafe
-        await self.redis.expire(
-            cache_settings.cache_key(), settings.ONLINE_USER_RESPONSE_CACHE_TTL)
+        for key in (cache_settings.cache_key(),
+                    cache_settings.cache_age_diff_key(),
+                    cache_settings.sessions_key()):
+            pipe.expire(key, settings.ONLINE_USER_RESPONSE_CACHE_TTL)
 
     async def drop_response_cache(self, user_id: str):
-        logger.info(f"Dropping fetch response cache for {user_id}")
-        for key in await self.redis.keys(f'{FETCH_REQUEST_KEY}:{user_id}:*'):
-            await self.redis.delete(key)
-
-        logger.info(f"Dropping fetch response age diff cache for {user_id}")
-        for key in await self.redis.keys(f'{FETCH_AGE_DIFF_KEY}:{user_id}:*'):
-            await self.redis.delete(key)
+        logger.info(f"Dropping fetch response caches for {user_id}")
+        sessions_key = f'{FETCH_SESSIONS_KEY}:{user_id}'
+        session_ids = await self.redis.smembers(sessions_key)
+        cache_settings = UserFetchCacheKey(user_id=user_id, session_id='')
+        await self.redis.delete(*cache_settings.session_keys(session_ids))
 
     async def drop_all_response_caches(self):
         logger.info(f"Dropping all fetch response caches")
@@ -301,6 +349,8 @@ class RedisUserFetchService:
         logger.info(f"Dropping fetch response age diff caches")
         for key in await self.redis.keys(f'{FETCH_AGE_DIFF_KEY}:*'):
             await self.redis.delete(key)
+        for key in await self.redis.keys(f'{FETCH_SESSIONS_KEY}:*'):
+            await self.redis.delete(key)
 
 
 class RedisFirebaseService:
@@ -365,3 +415,48 @@ class RedisUserCacheService:
         logger.info('Dropping user cache')
         for key in await self.redis.keys(f'{self.USER_CACHE_KEY}:*'):
             await self.redis.delete(key)
+
+
+class RedisMatchmakingPreviewService:
+    """
+    Gender and date of birth of the users, all the matchmaking server
+    needs of a connecting user. Kept in sync by the profile updates,
+    so that joining the lobby doesn't touch the database
+    """
+    PREVIEW_KEY = 'matchmaking_preview'
+
+    def __init__(self,
+                 redis: aioredis.Redis = Depends(dependencies.redis)):
+        self.redis = redis
+
+    async def get_preview(self, user_id: str) -> Optional[User]:
+        """
+        User with only the id, gender and date of birth set
+        """
+        preview = await self.redis.hgetall(f'{self.PREVIEW_KEY}:{user_id}')
+        if not preview:
+            return None
+        # age is computed from the date of birth, a cached one
+        # would go stale on the birthday
+        return User(id=UUID(user_id), gender=Gender(preview['gender']),
+                    date_of_birth=date.fromisoformat(
+                        preview['date_of_birth']))
+
+    async def cache_preview(self, user: User):
+        if not user.gender or not user.date_of_birth:
+            # registration is not finished yet
+            await self.drop_preview(str(user.id))
+            return
+
+        logger.debug(f'Saving matchmaking preview of {user.id}')
+        key = f'{self.PREVIEW_KEY}:{user.id}'
+        async with self.redis.pipeline() as pipe:
+            pipe.hset(key, mapping={
+                'gender': Gender(user.gender).value,
+                'date_of_birth': user.date_of_birth.isoformat(),
+            })
+            pipe.expire(key, settings.MATCHMAKING_PREVIEW_CACHE_TTL_SEC)
+            await pipe.execute()
+
+    async def drop_preview(self, user_id: str):
+        await self.redis.delete(f'{self.PREVIEW_KEY}:{user_id}')
@@ -53,7 +53,9 @@ class ConnectedUser:
 
 
 class WSConnectionManager:
-    active_connections: dict[str, ConnectedUser] = {}
+    def __init__(self):
+        # every lobby of the matchmaking server has a manager of its own
+        self.active_connections: dict[str, ConnectedUser] = {}
 
     def get_user_data(self, user_id: str) \
             -> Optional[ChatUserData | MMUserData]:
@@ -92,6 +94,19 @@ class WSConnectionManager:
             if raise_on_disconnect:
                 raise SwipeError(f"{user_id} is not online")
 
+    async def send_text(self, user_id: str, text: str):
+        """
+        Sends a payload that's already encoded, as it is
+        """
+        if user_id not in self.active_connections:
+            logger.info(f"{user_id} is not online, payload won't be sent")
+            return
+
+        try:
+            await self.active_connections[user_id].connection.send_text(text)
+        except:
+            logger.exception(f"Unable to send payload to {user_id}")
+
     async def broadcast(self, sender_id: str, payload: dict):
         # TODO stupid workaround
         if 'payload' in payload:
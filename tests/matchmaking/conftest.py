@@ -0,0 +1,96 @@
+import random
+import secrets
+from typing import Iterable, Iterator
+
+import pytest
+
+from swipe.matchmaking.matchmaker import Matchmaker
+from swipe.matchmaking.schemas import MMRoundData, MMSettings
+from swipe.swipe_server.users.enums import Gender
+
+MATCH_ACTIONS = ('decline', 'return', 'disconnect')
+
+
+@pytest.fixture
+def random_round_data():
+    def random_round_data(number_of_users: int, seed: int = 0) \
+            -> MMRoundData:
+        rng = random.Random(seed)
+        round_data = MMRoundData()
+        for user_number in range(number_of_users):
+            user_id = f'user_{user_number}'
+            mm_settings = MMSettings(
+                age=rng.randint(18, 40),
+                age_diff=rng.choice([0, 5, 10]),
+                gender=rng.choice(list(Gender)),
+                gender_filter=rng.choice([None, *Gender]),
+                session_id=secrets.token_urlsafe(16))
+            disallowed_users = {
+                f'user_{rng.randrange(number_of_users)}' for _ in range(2)}
+            round_data.connect(user_id, mm_settings, set(), disallowed_users)
+        return round_data
+
+    return random_round_data
+
+
+@pytest.fixture
+def lobby():
+    """
+    Round data with a male user of every age, user_0, user_1...
+    """
+    def lobby(*ages: int) -> MMRoundData:
+        round_data = MMRoundData()
+        for user_number, age in enumerate(ages):
+            round_data.connect(f'user_{user_number}', MMSettings(
+                age=age, gender=Gender.MALE, session_id='session'),
+                set(), set())
+        return round_data
+
+    return lobby
+
+
+@pytest.fixture
+def stub_candidate_fetch(mocker):
+    """
+    Every refill of the matchmaker gets no candidates
+    """
+    response = mocker.MagicMock()
+    response.json.return_value = {'connections': {}}
+    return mocker.patch('swipe.matchmaking.matchmaker.requests.post',
+                        return_value=response)
+
+
+@pytest.fixture
+def play_rounds():
+    """
+    Runs full rounds starting with the round data and yields the matches
+    of every round, nobody is matched twice in one round.
+    Every matched pair either declines each other, comes back after
+    the call or one of them leaves, picked from the actions at random
+    """
+    def play_rounds(matchmaker: Matchmaker, round_data: MMRoundData,
+                    rounds: int, seed: int = 0,
+                    actions: Iterable[str] = MATCH_ACTIONS) \
+            -> Iterator[list[tuple[str, str]]]:
+        rng = random.Random(seed)
+        actions = list(actions)
+        for _ in range(rounds):
+            matches = list(matchmaker.run_matchmaking_round(round_data))
+            matched_users = [user_id for match in matches
+                             for user_id in match]
+            assert len(matched_users) == len(set(matched_users))
+            yield matches
+
+            round_data = MMRoundData()
+            for user_a, user_b in matches:
+                action = rng.choice(actions)
+                if action == 'decline':
+                    round_data.reconnect_decline(user_a, user_b)
+                elif action == 'return':
+                    round_data.reconnect_after_call(user_a, user_b)
+                else:
+                    round_data.online_users.update({user_a, user_b})
+                    round_data.disconnect(user_a)
+                    round_data.reconnect(user_b)
+
+    return play_rounds
@@ -0,0 +1,66 @@
+import random
+
+from benchmarks.common import compare_to_baseline
+from benchmarks.lobby import LobbySimulator
+from benchmarks.replay import replay_recording
+from swipe.matchmaking.event_log import ROUND_DATA_EXCLUDE
+from swipe.matchmaking.matchmaker import Matchmaker
+from swipe.matchmaking.recording import RoundRecorder
+from swipe.matchmaking.schemas import MMRoundData
+
+
+def test_lobby_simulator_keeps_the_lobby_consistent(stub_candidate_fetch):
+    simulator = LobbySimulator(200, random.Random(0))
+    matches = []
+    matchmaker = Matchmaker()
+    for _ in range(15):
+        round_data = simulator.next_round(matches)
+        matchmaker.apply_round_data(round_data)
+        assert len(matchmaker.graph) == 200
+        assert {user_id for user_id, vertex in matchmaker.graph.items()
+                if vertex.matched} == simulator._in_call
+        matches = list(matchmaker.run_matchmaking_round(MMRoundData()))
+
+
+def test_compare_to_baseline():
+    rows = compare_to_baseline(
+        [{'users': 10, 'p50_ms': 1.5}, {'users': 20, 'p50_ms': 3.0}],
+        [{'users': 10, 'p50_ms': 2.0}])
+    assert rows == [
+        {'users': 10, 'p50_ms': 1.5, 'p50_ms_change': '-25.0%'},
+        {'users': 20, 'p50_ms': 3.0, 'p50_ms_change': ''},
+    ]
+
+
+def test_replay_recording(stub_candidate_fetch, tmp_path):
+    path = str(tmp_path / 'recording.jsonl')
+    recorder = RoundRecorder(path)
+    simulator = LobbySimulator(50, random.Random(1))
+    matches = []
+    matchmaker = Matchmaker()
+    for _ in range(5):
+        round_data = simulator.next_round(matches)
+        recorder.record_round(round_data.json(exclude=ROUND_DATA_EXCLUDE))
+        matches = list(matchmaker.run_matchmaking_round(round_data))
+        recorder.record_matches(matches)
+    recorder.close()
+    with open(path, 'a') as recording:
+        recording.write('{"broken')
+
+    results = replay_recording(path)
+    assert len(results) == 5
+    assert [row['matches'] for row in results] == \
+           [row['recorded_matches'] for row in results]
+
+
+def test_replay_uses_recorded_candidates(lobby, tmp_path):
+    path = str(tmp_path / 'recording.jsonl')
+    recorder = RoundRecorder(path)
+    recorder.record_round(lobby(20, 25).json(exclude=ROUND_DATA_EXCLUDE))
+    recorder.record_round(MMRoundData().json(exclude=ROUND_DATA_EXCLUDE))
+    recorder.record_candidates({'user_1': ['user_0']})
+    recorder.close()
+
+    # both windows are widened after the first round,
+    # the refill connects them during the second one
+    assert [row['matches'] for row in replay_recording(path)] == [0, 1]
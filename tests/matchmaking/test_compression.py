@@ -0,0 +1,90 @@
+from swipe.matchmaking.matchmaker import Matchmaker
+from swipe.matchmaking.schemas import MMRoundData, MMSettings
+from swipe.settings import settings
+from swipe.swipe_server.users.enums import Gender
+
+
+def _partner_ids(matchmaker: Matchmaker, user_id: str) -> set[str]:
+    vertex = matchmaker.get_vertex(user_id)
+    return {
+        partner.user_id for number in matchmaker.partner_numbers(vertex)
+        if (partner := matchmaker.graph.vertex(number)).user_id
+        not in vertex.disallowed_users
+        and user_id not in partner.disallowed_users
+    }
+
+
+def test_class_partners_match_the_edges(random_round_data):
+    round_data = random_round_data(300, seed=4)
+    matchmaker = Matchmaker(class_graph=False)
+    matchmaker.prepare_round(round_data.copy(deep=True))
+    class_matchmaker = Matchmaker(class_graph=True)
+    class_matchmaker.prepare_round(round_data.copy(deep=True))
+
+    assert class_matchmaker.graph.edge_count == 0
+    for user_id in round_data.new_users:
+        assert _partner_ids(class_matchmaker, user_id) == {
+            partner_id for partner_id, bidirectional
+            in matchmaker.get_vertex(user_id).edges.items() if bidirectional}
+
+
+def test_class_graph_makes_the_same_matches(mocker, random_round_data):
+    # a widened age_diff moves the user to another class right away,
+    # while the edges of the graph stay the same until the refill
+    mocker.patch.object(settings, 'MATCHMAKING_AGE_DIFF_STEP', 0)
+    round_data = random_round_data(300, seed=5)
+    for strategy in ('greedy', 'augmenting'):
+        matches = list(Matchmaker(
+            matching_strategy=strategy, class_graph=False)
+            .run_matchmaking_round(round_data.copy(deep=True)))
+        class_matches = list(Matchmaker(
+            matching_strategy=strategy, class_graph=True)
+            .run_matchmaking_round(round_data.copy(deep=True)))
+        assert class_matches == matches
+
+
+class CheckedClassMatchmaker(Matchmaker):
+    def find_match(self, user_id: str):
+        weights = [
+            self.get_vertex(partner_id).mm_settings.current_weight
+            for partner_id in _partner_ids(self, user_id)
+            if not self.get_vertex(partner_id).matched]
+        match_user_id = super().find_match(user_id)
+        if not weights:
+            assert match_user_id is None
+        else:
+            assert self.get_vertex(match_user_id) \
+                       .mm_settings.current_weight == max(weights)
+        return match_user_id
+
+
+def test_class_graph_over_several_rounds(stub_candidate_fetch,
+                                        random_round_data, play_rounds):
+    # every find_match is checked against the heaviest class partner
+    matchmaker = CheckedClassMatchmaker(class_graph=True)
+    for _ in play_rounds(matchmaker, random_round_data(200, seed=6),
+                         rounds=10, seed=6):
+        pass
+    # widened windows don't need candidates from the database
+    stub_candidate_fetch.assert_not_called()
+
+
+def test_widened_age_diff_moves_user_to_another_class():
+    round_data = MMRoundData()
+    for user_id, age in (('user_0', 20), ('user_1', 25)):
+        round_data.connect(user_id, MMSettings(
+            age=age, age_diff=5, gender=Gender.MALE, session_id='session'),
+            set(), set())
+    round_data.connect('user_2', MMSettings(
+        age=40, gender=Gender.MALE, session_id='session'), set(), set())
+    matchmaker = Matchmaker(class_graph=True)
+    matchmaker.prepare_round(round_data)
+
+    # the one at 40 is too far for both of them
+    assert matchmaker.find_match('user_2') is None
+    for _ in range(3):
+        matchmaker.mark_unmatched(matchmaker.get_vertex('user_2'))
+    assert matchmaker.find_match('user_2') is None
+    for _ in range(3):
+        matchmaker.mark_unmatched(matchmaker.get_vertex('user_1'))
+    assert matchmaker.find_match('user_2') == 'user_1'
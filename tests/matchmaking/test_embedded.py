@@ -0,0 +1,95 @@
+import asyncio
+import os
+import signal
+from typing import Optional, Tuple
+
+from swipe.matchmaking.embedded import EmbeddedMatchmaker, EmbeddedLobby
+from swipe.matchmaking.matchmaker import MatchmakerConfig
+from swipe.matchmaking.schemas import MMRoundData, MMSettings
+from swipe.swipe_server.users.enums import Gender
+
+
+def _lobby(loop: asyncio.AbstractEventLoop, *user_ids: str,
+           restarted: Optional[asyncio.Future] = None) \
+        -> Tuple[EmbeddedLobby, asyncio.Future]:
+    lobby = MMRoundData()
+    for user_id in user_ids:
+        lobby.connect(user_id, MMSettings(
+            age=20, gender=Gender.MALE, session_id='session'), set(), set())
+    round_data = [lobby]
+    got_matches = loop.create_future()
+
+    async def fetch_round_data(_):
+        return round_data.pop() if round_data else MMRoundData()
+
+    async def send_matches(matches):
+        if not got_matches.done():
+            got_matches.set_result(matches)
+
+    async def fetch_candidates(queries):
+        return {}
+
+    async def on_restart():
+        if restarted:
+            restarted.set_result(True)
+
+    return EmbeddedLobby(
+        {
+            'round_data': fetch_round_data,
+            'matches': send_matches,
+            'candidates': fetch_candidates,
+        },
+        on_restart=on_restart,
+        matchmaker_config=MatchmakerConfig(round_length_secs=0.1)), \
+        got_matches
+
+
+def test_embedded_matchmaker_round_trip():
+    loop = asyncio.new_event_loop()
+    lobby, got_matches = _lobby(loop, 'user_0', 'user_1')
+    embedded_matchmaker = EmbeddedMatchmaker({'': lobby})
+    embedded_matchmaker.start(loop)
+    try:
+        matches = loop.run_until_complete(asyncio.wait_for(got_matches, 60))
+    finally:
+        embedded_matchmaker.stop()
+        loop.close()
+    assert sorted(map(sorted, matches)) == [['user_0', 'user_1']]
+
+
+def test_lobbies_are_matched_in_separate_processes():
+    loop = asyncio.new_event_loop()
+    video, video_matches = _lobby(loop, 'user_0', 'user_1')
+    # user_0 is in both lobbies at once
+    audio, audio_matches = _lobby(loop, 'user_0', 'user_2')
+    embedded_matchmaker = EmbeddedMatchmaker({'video': video, 'audio': audio})
+    embedded_matchmaker.start(loop)
+    assert len(set(embedded_matchmaker.pids)) == 2
+    try:
+        matches = loop.run_until_complete(asyncio.wait_for(
+            asyncio.gather(video_matches, audio_matches), 60))
+    finally:
+        embedded_matchmaker.stop()
+        loop.close()
+    assert [sorted(map(sorted, lobby_matches)) for lobby_matches in matches] \
+           == [[['user_0', 'user_1']], [['user_0', 'user_2']]]
+
+
+def test_only_the_lobby_of_a_dead_matchmaker_is_restarted():
+    loop = asyncio.new_event_loop()
+    restarted = loop.create_future()
+    video, _ = _lobby(loop, restarted=restarted)
+    audio, _ = _lobby(loop)
+    embedded_matchmaker = EmbeddedMatchmaker({'video': video, 'audio': audio})
+    embedded_matchmaker.start(loop)
+    video_pid, audio_pid = embedded_matchmaker.pids
+    try:
+        os.kill(video_pid, signal.SIGKILL)
+        loop.run_until_complete(asyncio.wait_for(restarted, 60))
+        pids = embedded_matchmaker.pids
+    finally:
+        embedded_matchmaker.stop()
+        loop.close()
+    assert audio_pid in pids
+    assert video_pid not in pids
+    assert len(pids) == 2
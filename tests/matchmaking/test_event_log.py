@@ -0,0 +1,139 @@
+from unittest.mock import MagicMock
+
+import pytest
+import redis
+
+from swipe.matchmaking.event_log import RoundDataStream, ROUND_DATA_FIELD, \
+    ROUND_DATA_EXCLUDE
+from swipe.matchmaking.matchmaker import Matchmaker, MatchmakerConfig, \
+    start_matchmaker
+from swipe.matchmaking.schemas import MMRoundData, MMSettings, VertexData
+from swipe.swipe_server.users.enums import Gender
+
+
+def _entry(entry_id: str, round_data: MMRoundData):
+    return entry_id, {
+        ROUND_DATA_FIELD: round_data.json(exclude=ROUND_DATA_EXCLUDE)}
+
+
+def test_pending_entries_are_read_before_new_ones():
+    redis_client = MagicMock()
+    new_user = VertexData(user_id='user_1', mm_settings=MMSettings(
+        age=20, gender=Gender.MALE, session_id='session'))
+    redis_client.xreadgroup.side_effect = [
+        # left unacknowledged by the previous run
+        [['stream', [_entry('1-0', MMRoundData(
+            new_users={'user_1': new_user}))]]],
+        [['stream', []]],
+        [['stream', [
+            _entry('2-0', MMRoundData(decline_pairs=[('user_1', 'user_2')])),
+            ('3-0', {}),
+            _entry('4-0', MMRoundData(disconnected_users={'user_1'}))]]],
+    ]
+    stream = RoundDataStream(redis_client, 'stream')
+
+    round_data, entry_ids = stream.read()
+    assert entry_ids == ['1-0']
+    assert list(round_data.new_users) == ['user_1']
+
+    round_data, entry_ids = stream.read(block_secs=0.5)
+    assert entry_ids == ['2-0', '3-0', '4-0']
+    assert round_data.decline_pairs == [('user_1', 'user_2')]
+    assert round_data.disconnected_users == {'user_1'}
+    assert [call.args[2] for call in redis_client.xreadgroup.call_args_list] \
+           == [{'stream': '0'}, {'stream': '0'}, {'stream': '>'}]
+    assert redis_client.xreadgroup.call_args.kwargs['block'] == 500
+
+    stream.ack(entry_ids)
+    redis_client.xack.assert_called_once_with(
+        'stream', 'matchmaker', '2-0', '3-0', '4-0')
+
+
+class _StopMatchmaker(Exception):
+    pass
+
+
+@pytest.mark.parametrize('round_fails', [False, True])
+def test_entries_are_acked_after_a_successful_round(mocker, round_fails):
+    redis_client = MagicMock()
+    redis_client.xreadgroup.return_value = [['stream', [
+        _entry('1-0', MMRoundData())]]]
+    mocker.patch.object(redis.Redis, 'from_url', return_value=redis_client)
+    mocker.patch.object(
+        Matchmaker, 'run_matchmaking_round',
+        side_effect=RuntimeError if round_fails else None, return_value=[])
+    mocker.patch('time.sleep', side_effect=_StopMatchmaker)
+
+    with pytest.raises(_StopMatchmaker):
+        start_matchmaker(
+            MatchmakerConfig(event_log=True, event_stream='stream'),
+            server=MagicMock())
+
+    if round_fails:
+        redis_client.xack.assert_not_called()
+    else:
+        redis_client.xack.assert_called_once_with(
+            'stream', 'matchmaker', '1-0')
+
+
+def test_entries_of_a_failed_round_are_moved_to_the_dead_letter_stream():
+    redis_client = MagicMock()
+    redis_client.xreadgroup.return_value = [['stream', [
+        _entry('1-0', MMRoundData(decline_pairs=[('user_1', 'user_2')]))]]]
+    stream = RoundDataStream(redis_client, 'stream', max_attempts=3)
+
+    for _ in range(3):
+        round_data, entry_ids = stream.read()
+        assert entry_ids == ['1-0']
+        assert round_data.decline_pairs == [('user_1', 'user_2')]
+        stream.fail(entry_ids)
+    # read again without going to redis
+    assert redis_client.xreadgroup.call_count == 1
+
+    pipe = redis_client.pipeline.return_value
+    assert pipe.xadd.call_args.args[0] == 'stream_dead_letter'
+    assert pipe.xadd.call_args.args[1]['entry_id'] == '1-0'
+    pipe.xack.assert_called_once_with('stream', 'matchmaker', '1-0')
+
+
+def test_entry_failing_after_a_restart_does_not_block_the_stream(mocker):
+    redis_client = MagicMock()
+    pending = [_entry('1-0', MMRoundData(
+        decline_pairs=[('user_1', 'gone_user')]))]
+    new_user = VertexData(user_id='user_2', mm_settings=MMSettings(
+        age=20, gender=Gender.MALE, session_id='session'))
+
+    def xreadgroup(group, consumer, streams, block=None):
+        if streams['stream'] == '0':
+            return [['stream', pending]]
+        return [['stream', [
+            _entry('2-0', MMRoundData(new_users={'user_2': new_user}))]]]
+
+    def dead_letter(*_):
+        pending.clear()
+
+    redis_client.xreadgroup.side_effect = xreadgroup
+    redis_client.pipeline.return_value.execute.side_effect = dead_letter
+    mocker.patch.object(redis.Redis, 'from_url', return_value=redis_client)
+    processed = []
+
+    def run_matchmaking_round(round_data: MMRoundData):
+        if round_data.decline_pairs:
+            raise KeyError('gone_user')
+        processed.append(set(round_data.new_users))
+        return []
+
+    mocker.patch.object(Matchmaker, 'run_matchmaking_round',
+                        side_effect=run_matchmaking_round)
+    mocker.patch('time.sleep', side_effect=[None] * 4 + [_StopMatchmaker])
+
+    with pytest.raises(_StopMatchmaker):
+        start_matchmaker(
+            MatchmakerConfig(event_log=True, event_stream='stream'),
+            server=MagicMock())
+
+    pipe = redis_client.pipeline.return_value
+    assert pipe.xadd.call_args.args[0] == 'stream_dead_letter'
+    pipe.xack.assert_called_once_with('stream', 'matchmaker', '1-0')
+    assert processed == [{'user_2'}, {'user_2'}]
+    redis_client.xack.assert_called_with('stream', 'matchmaker', '2-0')
@@ -0,0 +1,117 @@
+import random
+
+import pytest
+
+from swipe.matchmaking.graph import ConnectionGraph, Vertex, CandidateHeap, \
+    DenseConnectionGraph
+from swipe.matchmaking.matchmaker import Matchmaker
+from swipe.matchmaking.schemas import MMSettings
+from swipe.swipe_server.users.enums import Gender
+
+
+def _vertex(user_id: str) -> Vertex:
+    return Vertex(user_id, MMSettings(
+        age=20, gender=Gender.MALE, session_id='session'), set())
+
+
+@pytest.mark.parametrize('graph_class',
+                         [ConnectionGraph, DenseConnectionGraph])
+def test_edges_are_dropped_when_a_number_is_reused(graph_class):
+    graph = graph_class(capacity=4)
+    vertices = [_vertex(f'user_{user_number}') for user_number in range(10)]
+    for vertex in vertices:
+        graph.add(vertex)
+    # growing the graph keeps the edges
+    vertices[0].connect('user_9', True)
+    vertices[9].connect('user_0', True)
+    vertices[1].connect('user_5')
+
+    assert vertices[0].edges == {'user_9': True}
+    assert vertices[9].bi_connects_to('user_0') is True
+    assert vertices[1].bi_connects_to('user_5') is False
+    assert vertices[5].bi_connects_to('user_1') is None
+    vertices[5].connect('user_0')
+    vertices[1].connect('user_5', True)
+    assert graph.edge_count == 4
+
+    graph.remove('user_5')
+    assert graph.edge_count == 2
+    new_vertex = _vertex('new_user')
+    graph.add(new_vertex)
+
+    assert new_vertex.number == vertices[5].number
+    assert vertices[1].edges == {}
+    assert new_vertex.edges == {}
+    assert [partner.user_id for partner
+            in graph.bidirectional_partners(vertices[0].number)] == ['user_9']
+
+
+def test_candidate_heap_drops_outdated_entries():
+    heap = CandidateHeap()
+    heap.push(1, 3)
+    heap.push(2, 5)
+    heap.push(3, 4)
+    heap.push(2, 0)
+    heap.discard(3)
+
+    assert heap.pop() == (1, 3)
+    assert heap.pop() == (2, 0)
+    assert heap.pop() is None
+
+
+def test_round_flags_are_cleared_by_the_next_round():
+    graph = ConnectionGraph()
+    processed, waiting, idle = vertices = \
+        [_vertex(f'user_{user_number}') for user_number in range(3)]
+    for vertex in vertices:
+        graph.add(vertex)
+    processed.processed = True
+    waiting.waiting = True
+
+    assert [vertex.processed for vertex in vertices] == [True, False, False]
+    assert [vertex.waiting for vertex in vertices] == [False, True, False]
+    graph.next_round()
+    assert not any(vertex.processed or vertex.waiting for vertex in vertices)
+
+
+def test_dense_graph_matches_the_default_one():
+    rng = random.Random(0)
+    graphs = [DenseConnectionGraph(capacity=4), ConnectionGraph(capacity=4)]
+    user_ids = [f'user_{user_number}' for user_number in range(30)]
+    for graph in graphs:
+        for user_id in user_ids:
+            graph.add(_vertex(user_id))
+
+    for _ in range(500):
+        action = rng.choice(
+            ['connect', 'connect', 'connect_pair', 'disconnect', 'replace'])
+        user_a, user_b = rng.sample(user_ids, 2)
+        bidirectional = rng.random() < 0.5
+        for graph in graphs:
+            if action == 'connect':
+                graph[user_a].connect(user_b, bidirectional)
+            elif action == 'connect_pair':
+                graph.connect_pair(graph[user_a].number, graph[user_b].number)
+            elif action == 'disconnect':
+                graph[user_a].disconnect(user_b)
+            else:
+                graph.remove(user_a)
+                graph.add(_vertex(user_a))
+
+    matrix_graph, sparse_graph = graphs
+    assert sparse_graph.edge_count == matrix_graph.edge_count
+    for user_id in user_ids:
+        number = matrix_graph[user_id].number
+        assert sparse_graph[user_id].number == number
+        assert sparse_graph[user_id].edges == matrix_graph[user_id].edges
+        assert sparse_graph.degree(number) == matrix_graph.degree(number)
+        assert list(sparse_graph.bidirectional_numbers(number)) == \
+               list(matrix_graph.bidirectional_numbers(number))
+
+
+def test_matrix_is_only_used_when_asked_for():
+    assert type(Matchmaker().graph) is ConnectionGraph
+    assert type(Matchmaker(dense_graph=True).graph) is DenseConnectionGraph
+    # the budget and the classes keep few edges per vertex
+    assert type(Matchmaker(dense_graph=True, edge_budget=100).graph) \
+           is ConnectionGraph
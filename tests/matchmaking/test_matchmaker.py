@@ -0,0 +1,324 @@
+import json
+
+import pytest
+
+from swipe.matchmaking.matchmaker import Matchmaker, MatchmakerConfig, \
+    Vertex
+from swipe.matchmaking.metrics import write_metrics
+from swipe.matchmaking.schemas import MMRoundData, MMSettings
+from swipe.settings import settings
+from swipe.swipe_server.users.enums import Gender
+
+
+def _all_pairs_edges(round_data: MMRoundData) -> dict[str, dict[str, bool]]:
+    matchmaker = Matchmaker()
+    graph = matchmaker._connection_graph
+    for user_id, vertex_data in round_data.new_users.items():
+        vertex = Vertex(user_id, vertex_data.mm_settings.copy(),
+                        set(vertex_data.disallowed_users))
+        graph_vertices = list(graph.values())
+        graph.add(vertex)
+        for graph_vertex in graph_vertices:
+            matchmaker._connect_vertices(vertex, graph_vertex)
+    return {user_id: vertex.edges for user_id, vertex in graph.items()}
+
+
+def test_merge_graphs_matches_all_pairs_scan(random_round_data):
+    round_data = random_round_data(300)
+    expected_edges = _all_pairs_edges(round_data)
+
+    matchmaker = Matchmaker()
+    matchmaker.prepare_round(round_data.copy(deep=True))
+
+    for user_id, edges in expected_edges.items():
+        assert matchmaker.get_vertex(user_id).edges == edges
+
+
+def test_merge_graphs_with_widened_age_diff(random_round_data):
+    round_data = random_round_data(100, seed=1)
+    matchmaker = Matchmaker()
+    matchmaker.prepare_round(round_data.copy(deep=True))
+
+    # a vertex already in the graph widens its window
+    # and a new user falls into it
+    old_vertex = matchmaker.get_vertex('user_0')
+    old_vertex.mm_settings.age_diff = old_vertex.mm_settings.max_age_diff
+    old_vertex.mm_settings.gender_filter = None
+    matchmaker._compatibility_index.update(old_vertex)
+    new_round = MMRoundData()
+    new_round.connect('new_user', MMSettings(
+        age=old_vertex.mm_settings.age + old_vertex.mm_settings.max_age_diff,
+        gender=Gender.FEMALE, session_id='session'), set(), set())
+    matchmaker.prepare_round(new_round)
+
+    assert old_vertex.bi_connects_to('new_user') is not None
+
+
+def _best_candidate_weight(matchmaker: Matchmaker, user_id: str):
+    vertex = matchmaker.get_vertex(user_id)
+    weights = [
+        matchmaker._connection_graph[partner_id].mm_settings.current_weight
+        for partner_id, bidirectional in vertex.edges.items()
+        if bidirectional and partner_id in matchmaker._connection_graph
+        and partner_id not in vertex.disallowed_users
+        and not matchmaker._connection_graph[partner_id].matched
+    ]
+    return max(weights, default=None)
+
+
+class CheckedMatchmaker(Matchmaker):
+    def find_match(self, user_id: str):
+        expected_weight = _best_candidate_weight(self, user_id)
+        match_user_id = super().find_match(user_id)
+        if expected_weight is None:
+            assert match_user_id is None
+        else:
+            assert self.get_vertex(match_user_id) \
+                       .mm_settings.current_weight == expected_weight
+        return match_user_id
+
+
+def test_find_match_picks_heaviest_available_candidate(lobby):
+    matchmaker = Matchmaker()
+    matchmaker.prepare_round(lobby(20, 20, 20, 20, 20))
+    for user_number, weight in enumerate([0, 3, 5, 4, 1]):
+        matchmaker.get_vertex(f'user_{user_number}') \
+            .mm_settings.current_weight = weight
+    # weights have been changed from the outside
+    for user_number in range(5):
+        matchmaker._update_candidate_weight(
+            matchmaker.get_vertex(f'user_{user_number}'))
+
+    matchmaker.get_vertex('user_2').matched = True
+    matchmaker.get_vertex('user_0').disallow('user_3')
+    assert matchmaker.find_match('user_0') == 'user_1'
+
+    # matched candidates are not dropped
+    matchmaker.get_vertex('user_2').matched = False
+    assert matchmaker.find_match('user_0') == 'user_2'
+
+    # reset weights are picked up lazily
+    matchmaker.get_vertex('user_2').mm_settings.reset_weight()
+    matchmaker.get_vertex('user_1').mm_settings.reset_weight()
+    assert matchmaker.find_match('user_0') == 'user_4'
+
+
+def test_find_match_drops_candidates_that_have_left(lobby):
+    matchmaker = Matchmaker()
+    matchmaker.prepare_round(lobby(20, 20, 40))
+    matchmaker.prepare_round(MMRoundData(disconnected_users={'user_1'}))
+    # the number of the user who has left goes to a user
+    # user_0 can't connect to
+    new_round = MMRoundData()
+    new_round.connect('user_3', MMSettings(
+        age=40, gender=Gender.MALE, session_id='session'), set(), set())
+    matchmaker.prepare_round(new_round)
+    assert matchmaker.get_vertex('user_3').number == 1
+    assert matchmaker.find_match('user_0') is None
+    assert len(matchmaker.get_vertex('user_0').candidates) == 0
+
+
+def test_find_match_over_several_rounds(stub_candidate_fetch,
+                                        random_round_data, play_rounds):
+    # every find_match is checked against the heaviest candidate
+    matchmaker = CheckedMatchmaker()
+    matched_rounds = sum(1 for matches in play_rounds(
+        matchmaker, random_round_data(200, seed=3), rounds=10, seed=3)
+        if matches)
+    assert matched_rounds == 10
+
+
+def _path_lobby() -> MMRoundData:
+    # user_0 - user_1 - user_2 - user_3, the middle pair is the heaviest
+    round_data = MMRoundData()
+    disallowed = {0: {2, 3}, 1: {3}, 2: {0}, 3: {0, 1}}
+    for user_number, weight in enumerate([0, 5, 4, 0]):
+        round_data.connect(f'user_{user_number}', MMSettings(
+            age=20, gender=Gender.MALE, current_weight=weight,
+            session_id='session'), set(),
+            {f'user_{other}' for other in disallowed[user_number]})
+    return round_data
+
+
+def test_augmenting_strategy_rematches_greedy_pairs(stub_candidate_fetch):
+    greedy_matchmaker = Matchmaker(matching_strategy='greedy')
+    assert list(greedy_matchmaker.run_matchmaking_round(_path_lobby())) == \
+           [('user_1', 'user_2')]
+
+    matchmaker = Matchmaker(matching_strategy='augmenting')
+    matches = list(matchmaker.run_matchmaking_round(_path_lobby()))
+    assert sorted(map(sorted, matches)) == \
+           [['user_0', 'user_1'], ['user_2', 'user_3']]
+    assert all(matchmaker.get_vertex(f'user_{user_number}').matched
+               for user_number in range(4))
+
+
+def test_augmenting_strategy_matches_more_than_greedy(stub_candidate_fetch,
+                                                     random_round_data):
+    round_data = random_round_data(200, seed=4)
+    greedy_matches = list(Matchmaker(matching_strategy='greedy')
+                          .run_matchmaking_round(round_data.copy(deep=True)))
+    matchmaker = Matchmaker(matching_strategy='augmenting')
+    matches = list(matchmaker.run_matchmaking_round(round_data))
+
+    assert len(matches) > len(greedy_matches)
+    matched_users = [user_id for match in matches for user_id in match]
+    assert len(matched_users) == len(set(matched_users))
+    for user_a, user_b in matches:
+        assert matchmaker.get_vertex(user_a).bi_connects_to(user_b)
+
+
+def test_incremental_round_matches_only_affected_users(stub_candidate_fetch,
+                                                       lobby):
+    matchmaker = Matchmaker()
+    # a lonely user waiting in the lobby
+    assert list(matchmaker.run_matchmaking_round(lobby(20))) == []
+    assert matchmaker.get_vertex('user_0').mm_settings.current_weight == 1
+
+    new_round = MMRoundData()
+    new_round.connect('user_1', MMSettings(
+        age=20, gender=Gender.MALE, session_id='session'), set(), set())
+    new_round.connect('user_2', MMSettings(
+        age=40, gender=Gender.MALE, session_id='session'), set(), set())
+    assert list(matchmaker.run_incremental_round(new_round)) == \
+           [('user_1', 'user_0')]
+
+    # unmatched users are left for the full round
+    lonely_vertex = matchmaker.get_vertex('user_2')
+    assert lonely_vertex.mm_settings.current_weight == 0
+    assert not lonely_vertex.processed
+    assert not matchmaker.get_vertex('user_0').processed
+
+
+def test_candidates_are_refilled_in_batches(mocker, lobby):
+    matchmaker = Matchmaker()
+    matchmaker.prepare_round(lobby(20, 30, 34))
+    # nobody can connect to anyone
+    assert list(matchmaker.run_matchmaking_round(MMRoundData())) == []
+
+    response = mocker.MagicMock()
+    response.json.return_value = {'connections': {
+        'user_0': [], 'user_1': ['user_2'], 'user_2': ['user_1'],
+    }}
+    post = mocker.patch('swipe.matchmaking.matchmaker.requests.post',
+                        return_value=response)
+    session_id = matchmaker.get_vertex('user_0').mm_settings.session_id
+    matchmaker._refill_batch_size = 3
+    matchmaker.prepare_round(MMRoundData())
+
+    assert post.call_count == 1
+    assert len(post.call_args.kwargs['json']) == 3
+    # a quick fetch makes the next batch bigger
+    assert matchmaker._refill_batch_size == 6
+    # windows of user_1 and user_2 have been widened
+    assert matchmaker.get_vertex('user_1').bi_connects_to('user_2')
+    assert matchmaker.get_vertex('user_0').mm_settings.session_id \
+           != session_id
+
+
+def test_edge_budget_picks_closest_users_and_refreshes_dry_ones(
+        mocker, stub_candidate_fetch):
+    mocker.patch.object(settings, 'MATCHMAKING_EDGE_BUDGET_MIN_PER_USER', 2)
+    round_data = MMRoundData()
+    for user_number, age in enumerate([30, 25, 29, 31, 35, 30]):
+        round_data.connect(f'user_{user_number}', MMSettings(
+            age=age, age_diff=5, gender=Gender.MALE, session_id='session'),
+            set(), set())
+    matchmaker = Matchmaker(edge_budget=1)
+    matchmaker.prepare_round(round_data)
+
+    assert matchmaker.vertex_edge_budget() == 2
+    # user_0 has got twice the budget by the time user_5 joins
+    assert matchmaker.get_vertex('user_5').edges == \
+           {'user_2': True, 'user_3': True}
+    assert max(matchmaker.graph.degree(vertex.number)
+               for vertex in matchmaker.graph.values()) == 4
+
+    matchmaker.mark_matched(matchmaker.get_vertex('user_0'),
+                            matchmaker.get_vertex('user_2'))
+    assert matchmaker.find_match('user_1') is None
+    matchmaker.mark_unmatched(matchmaker.get_vertex('user_1'))
+    matchmaker.prepare_round(MMRoundData())
+
+    # edges to the users in a call are evicted, user_1 is too young
+    # for user_4 and user_3 is full
+    assert matchmaker.get_vertex('user_1').edges == {'user_5': True}
+    assert matchmaker.find_match('user_1') == 'user_5'
+    stub_candidate_fetch.assert_not_called()
+
+
+def test_restored_snapshot_matches_like_the_original(stub_candidate_fetch,
+                                                     random_round_data):
+    matchmaker = Matchmaker()
+    round_data = random_round_data(200, seed=5)
+    matches = []
+    for _ in range(3):
+        matches.extend(matchmaker.run_matchmaking_round(round_data))
+        round_data = MMRoundData()
+    user_a, user_b = matches[0]
+    still_in_call = [user_id for match in matches[1:] for user_id in match]
+
+    restored = Matchmaker()
+    online_users = set(matchmaker.graph) - {user_a} | {'new_user'}
+    missing_users = restored.restore_snapshot(
+        matchmaker.dump_snapshot(), online_users, set(still_in_call))
+
+    assert missing_users == {'new_user'}
+    assert user_a not in restored.graph
+    # nothing is known about his call, so he's back in the lobby
+    assert not restored.get_vertex(user_b).matched
+    assert all(restored.get_vertex(user_id).matched
+               for user_id in still_in_call)
+
+    round_data = MMRoundData(disconnected_users={user_a},
+                             returning_users={user_b: None})
+    for user_id, vertex in restored.graph.items():
+        original_vertex = matchmaker.get_vertex(user_id)
+        assert vertex.edges == {
+            partner_id: bidirectional for partner_id, bidirectional
+            in original_vertex.edges.items() if partner_id != user_a}
+        assert vertex.mm_settings == original_vertex.mm_settings
+    assert list(restored.run_matchmaking_round(round_data.copy(deep=True))) \
+           == list(matchmaker.run_matchmaking_round(round_data))
+
+
+def test_round_metrics(stub_candidate_fetch, lobby, tmp_path):
+    matchmaker = Matchmaker()
+    assert list(matchmaker.run_matchmaking_round(lobby(20, 20, 40))) == \
+           [('user_0', 'user_1')]
+
+    metrics_path = tmp_path / 'metrics.json'
+    write_metrics(str(metrics_path), matchmaker.metrics)
+    metrics = json.loads(metrics_path.read_text())
+    full_round = metrics['last_rounds']['full']
+    assert set(full_round['phases']) == {
+        'empty_candidates', 'returning', 'declines', 'disconnects', 'merge',
+        'heap', 'generate_matches', 'reset'}
+    assert (full_round['graph_size'], full_round['edge_count'],
+            full_round['heap_size'], full_round['matches']) == (3, 2, 3, 1)
+    assert metrics['time_to_match']['count'] == 2
+    assert metrics['time_to_match']['buckets']['1'] == 2
+
+
+@pytest.mark.parametrize('mode', [
+    {'shards': 2, 'event_driven': True},
+    {'shards': 2, 'snapshot_path': 'snapshot.npz'},
+    {'shards': 2, 'target_p95_secs': 10},
+    {'event_driven': True, 'target_p95_secs': 10},
+])
+def test_unsupported_modes_are_rejected(mode):
+    with pytest.raises(ValueError):
+        MatchmakerConfig(**mode)
+
+
+def test_config_overrides_the_settings(mocker):
+    mocker.patch.object(settings, 'MATCHMAKING_SHARDS', 2)
+    mocker.patch.object(settings, 'MATCHMAKING_TARGET_P95_TIME_TO_MATCH_SECS',
+                        10)
+    with pytest.raises(ValueError):
+        MatchmakerConfig.from_settings()
+
+    config = MatchmakerConfig.from_settings(shards=1, event_stream='stream')
+    assert config.shards == 1
+    assert config.target_p95_secs == 10
+    assert config.event_stream == 'stream'
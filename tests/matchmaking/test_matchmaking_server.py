@@ -0,0 +1,124 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from swipe.matchmaking.event_log import ROUND_DATA_FIELD
+from swipe.matchmaking.matchmaking_server import Lobby
+from swipe.matchmaking.schemas import Match, MMResponseAction, MMRoundData
+from swipe.settings import settings
+from swipe.swipe_server.users.enums import Gender
+from swipe.swipe_server.users.services.online_cache import \
+    OnlineMatchmakingUserCacheParams
+from swipe.ws_connection import ConnectedUser, MMUserData
+
+
+@pytest.mark.anyio
+async def test_users_in_a_call_are_not_reconnected(mocker):
+    lobby = Lobby()
+    for user_id in ['waiting', 'in_call', 'partner']:
+        lobby.matchmaking_data.online_users.add(user_id)
+        lobby.connection_manager.active_connections[user_id] = ConnectedUser(
+            user_id, MagicMock(), MMUserData(age=20, gender=Gender.MALE))
+    lobby.matchmaking_data.add_match('in_call', 'partner')
+    connect_to_lobby = mocker.patch.object(lobby, 'connect_to_lobby')
+    mocker.patch.object(lobby, 'publish_round_data', AsyncMock())
+
+    await lobby.reconnect_users(['waiting', 'in_call', 'offline'])
+
+    connect_to_lobby.assert_called_once_with(
+        'waiting', MMUserData(age=20, gender=Gender.MALE))
+
+
+@pytest.mark.anyio
+async def test_users_are_reconnected_in_batches(mocker):
+    mocker.patch.object(settings, 'MATCHMAKING_RECONNECT_BATCH_SIZE', 2)
+    lobby = Lobby()
+    user_ids = [f'user_{number}' for number in range(5)]
+    for user_id in user_ids:
+        lobby.matchmaking_data.online_users.add(user_id)
+        lobby.connection_manager.active_connections[user_id] = ConnectedUser(
+            user_id, MagicMock(), MMUserData(age=20, gender=Gender.MALE))
+    connected_users = []
+    running, most_running = 0, 0
+
+    async def connect_to_lobby(user_id: str, user_data: MMUserData):
+        nonlocal running, most_running
+        running += 1
+        most_running = max(most_running, running)
+        await asyncio.sleep(0)
+        running -= 1
+        connected_users.append(user_id)
+
+    mocker.patch.object(lobby, 'connect_to_lobby', connect_to_lobby)
+    mocker.patch.object(lobby, 'publish_round_data', AsyncMock())
+
+    await lobby.reconnect_users(user_ids)
+
+    assert sorted(connected_users) == user_ids
+    assert most_running == 2
+
+
+@pytest.mark.anyio
+async def test_lobby_events_are_kept_when_the_event_log_fails(mocker):
+    mocker.patch.object(settings, 'MATCHMAKING_EVENT_LOG_ENABLED', True)
+    redis_client = mocker.patch(
+        'swipe.matchmaking.matchmaking_server.redis_client')
+    lobby = Lobby()
+    lobby.matchmaking_data.decline_pairs.append(('user_1', 'user_2'))
+
+    async def failing_xadd(*args, **kwargs):
+        # the lobby changes while the entry is being written
+        lobby.matchmaking_data.decline_pairs.append(('user_3', 'user_4'))
+        raise ConnectionError
+
+    redis_client.xadd = failing_xadd
+    with pytest.raises(ConnectionError):
+        await lobby.publish_round_data()
+    assert lobby.matchmaking_data.decline_pairs \
+           == [('user_1', 'user_2'), ('user_3', 'user_4')]
+
+    redis_client.xadd = AsyncMock()
+    await lobby.publish_round_data()
+    round_data = MMRoundData.parse_raw(
+        redis_client.xadd.call_args.args[1][ROUND_DATA_FIELD])
+    assert round_data.decline_pairs \
+           == [('user_1', 'user_2'), ('user_3', 'user_4')]
+    assert not lobby.matchmaking_data.decline_pairs
+
+
+@pytest.mark.anyio
+async def test_match_cancelled_by_another_instance_is_declined(mocker):
+    lobby = Lobby()
+    lobby.shared_lobby = MagicMock()
+    # the partner's match has been removed by another instance
+    lobby.shared_lobby.get_match = AsyncMock(
+        side_effect=[Match('partner', True), None])
+    lobby.shared_lobby.remove_match = AsyncMock()
+    send = mocker.patch.object(lobby, 'send', AsyncMock())
+
+    await lobby.cancel_match('user')
+
+    assert send.call_args.args[1]['payload']['action'] \
+           == MMResponseAction.DECLINE
+    assert lobby.matchmaking_data.returning_users == {'partner': None}
+
+
+@pytest.mark.anyio
+async def test_users_of_a_stopped_instance_leave_the_lobby(mocker):
+    redis_online = mocker.patch(
+        'swipe.matchmaking.matchmaking_server.redis_online')
+    redis_online.remove_users_from_online_caches = AsyncMock()
+    lobby = Lobby()
+    cancel_match = mocker.patch.object(lobby, 'cancel_match', AsyncMock())
+    publish_round_data = mocker.patch.object(
+        lobby, 'publish_round_data', AsyncMock())
+
+    await lobby.process_lost_users(
+        {'user': MMUserData(age=20, gender=Gender.MALE)})
+
+    redis_online.remove_users_from_online_caches.assert_called_once_with(
+        {'user': OnlineMatchmakingUserCacheParams(age=20, gender=Gender.MALE)})
+    assert lobby.matchmaking_data.disconnected_users == {'user'}
+    cancel_match.assert_called_once_with('user')
+    publish_round_data.assert_called_once()
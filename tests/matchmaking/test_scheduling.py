@@ -0,0 +1,61 @@
+import pytest
+
+from swipe.matchmaking.scheduling import RoundScheduler
+
+
+def test_rounds_get_shorter_while_over_the_target():
+    scheduler = RoundScheduler(10, max_round_length_secs=30)
+    assert scheduler.round_length_secs == 10
+
+    round_length_secs = scheduler.observe_round(
+        10, 1, arrivals=100, unmatched_users=20,
+        times_to_match=[5] * 90 + [15] * 10)
+    # shortened by at most 30% at once
+    assert round_length_secs == pytest.approx(0.7 * 9)
+
+    # users keep waiting longer than the target
+    for _ in range(20):
+        round_length_secs = scheduler.observe_round(
+            round_length_secs, 1, arrivals=100, unmatched_users=20,
+            times_to_match=[30] * 100)
+    assert round_length_secs == pytest.approx(RoundScheduler.MIN_SCALE * 9)
+
+    # and back once they're matched faster
+    for _ in range(20):
+        round_length_secs = scheduler.observe_round(
+            round_length_secs, 1, arrivals=100, unmatched_users=20,
+            times_to_match=[1] * 1000)
+    assert round_length_secs == pytest.approx(9, rel=0.01)
+
+
+def test_rounds_back_off_in_an_idle_lobby():
+    scheduler = RoundScheduler(10, max_round_length_secs=120)
+    # nobody has come and nobody is waiting
+    assert scheduler.observe_round(
+        10, 0.5, arrivals=0, unmatched_users=0, times_to_match=[2, 2]) == 10
+    # the average arrival rate is 0.01 users per second,
+    # a new user still gets a round within the target
+    assert scheduler.observe_round(
+        30, 0.5, arrivals=1, unmatched_users=0, times_to_match=[]) \
+           == pytest.approx(10)
+
+
+def test_waiting_users_shorten_the_rounds():
+    scheduler = RoundScheduler(10, max_round_length_secs=30)
+    # users wait longer than the target
+    for _ in range(20):
+        scheduler.observe_round(1, 1, arrivals=1, unmatched_users=0,
+                                times_to_match=[30] * 100)
+    # one user a second, nobody waiting, the next one is needed for a match
+    assert scheduler.observe_round(
+        1, 1, arrivals=1, unmatched_users=0, times_to_match=[]) \
+           == pytest.approx(1)
+    # two waiting users spend about 2s in the lobby,
+    # there's time to wait for the next one
+    assert scheduler.observe_round(
+        1, 1, arrivals=1, unmatched_users=2, times_to_match=[]) \
+           == pytest.approx(1)
+    # twenty waiting users take up the whole target
+    assert scheduler.observe_round(
+        1, 1, arrivals=1, unmatched_users=20, times_to_match=[]) \
+           == pytest.approx(RoundScheduler.MIN_SCALE * 9)
@@ -0,0 +1,22 @@
+from swipe.matchmaking.schemas import relay_target
+
+
+def test_only_signaling_payloads_are_relayed():
+    sdp = {'sender_id': 'user_0', 'recipient_id': 'user_1',
+           'request_id': 'request',
+           'payload': {'type': 'sdp', 'sdp': {'type': 'offer'}}}
+    assert relay_target(sdp) == ('user_0', 'user_1', 'request')
+    ice = {'sender_id': 'user_0', 'recipient_id': 'user_1',
+           'payload': {'type': 'ice', 'ice': {}}}
+    assert relay_target(ice) == ('user_0', 'user_1', None)
+
+    # the lobby has to see these
+    assert relay_target({'sender_id': 'user_0', 'recipient_id': 'user_1',
+                         'payload': {'type': 'match', 'action': 'accept'}}) \
+           is None
+    # nobody to relay to, validated and rejected as usual
+    assert relay_target({'sender_id': 'user_0',
+                         'payload': {'type': 'sdp', 'sdp': {}}}) is None
+    assert relay_target({'sender_id': 'user_0', 'recipient_id': 'user_1',
+                         'payload': 'sdp'}) is None
+    assert relay_target(['sdp']) is None
@@ -0,0 +1,69 @@
+from swipe.matchmaking.schemas import MMRoundData, MMSettings
+from swipe.matchmaking.sharding import ShardedMatchmaker
+from swipe.swipe_server.users.enums import Gender
+
+
+def test_users_are_matched_across_shard_boundaries(stub_candidate_fetch):
+    matchmaker = ShardedMatchmaker(2, age_bounds=[30])
+    try:
+        round_data = MMRoundData()
+        for user_id, age in [('young', 28), ('old', 31)]:
+            round_data.connect(user_id, MMSettings(
+                age=age, age_diff=5, gender=Gender.MALE,
+                session_id='session'), set(), set())
+
+        assert list(matchmaker.run_matchmaking_round(round_data)) == \
+               [('young', 'old')]
+        # the shards have marked them with mark_matched
+        assert matchmaker.metrics.time_to_match.to_dict()['count'] == 2
+        # built anew every round
+        assert len(matchmaker._boundary_matchmaker.graph) == 0
+        # both of them are in a call now
+        assert list(matchmaker.run_matchmaking_round(MMRoundData())) == []
+
+        round_data = MMRoundData()
+        round_data.reconnect_decline('young', 'old')
+        assert list(matchmaker.run_matchmaking_round(round_data)) == \
+               [('young', 'old')]
+    finally:
+        matchmaker.stop()
+
+
+def test_nobody_is_matched_twice(stub_candidate_fetch, random_round_data,
+                                play_rounds):
+    matchmaker = ShardedMatchmaker(3, age_bounds=[24, 32])
+    try:
+        for matches in play_rounds(matchmaker,
+                                   random_round_data(300, seed=5),
+                                   rounds=5, seed=5):
+            assert matches
+    finally:
+        matchmaker.stop()
+
+
+def _connect(round_data: MMRoundData, *user_ids: str):
+    for user_id in user_ids:
+        round_data.connect(user_id, MMSettings(
+            age=20, gender=Gender.MALE, session_id='session'), set(), set())
+
+
+def test_dead_shard_is_restarted_with_its_users(stub_candidate_fetch):
+    matchmaker = ShardedMatchmaker(2, age_bounds=[30])
+    try:
+        round_data = MMRoundData()
+        _connect(round_data, 'user_a', 'user_b', 'user_c')
+        in_call = set(*matchmaker.run_matchmaking_round(round_data))
+        waiting_user, = {'user_a', 'user_b', 'user_c'} - in_call
+
+        matchmaker._processes[0].kill()
+        matchmaker._processes[0].join()
+        round_data = MMRoundData()
+        _connect(round_data, 'user_d')
+        # the shard sits the round out
+        assert list(matchmaker.run_matchmaking_round(round_data)) == []
+
+        # users in a call are not matched again
+        assert sorted(*matchmaker.run_matchmaking_round(MMRoundData())) == \
+               sorted([waiting_user, 'user_d'])
+    finally:
+        matchmaker.stop()
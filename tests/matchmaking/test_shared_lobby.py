@@ -0,0 +1,59 @@
+import asyncio
+import json
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from swipe.matchmaking.shared_lobby import SharedLobby
+from swipe.settings import settings
+from swipe.swipe_server.users.enums import Gender
+from swipe.ws_connection import MMUserData, WSConnectionManager
+
+
+@pytest.mark.anyio
+async def test_channel_is_released_and_delivery_can_be_cancelled(mocker):
+    mocker.patch.object(settings, 'MATCHMAKING_INSTANCE_HEARTBEAT_SECS', 0)
+    pubsubs = [MagicMock(), MagicMock()]
+    for pubsub in pubsubs:
+        pubsub.__aenter__.return_value = pubsub
+    pubsubs[0].subscribe = AsyncMock(side_effect=ConnectionError)
+    pubsubs[1].subscribe = AsyncMock()
+    listening = asyncio.Event()
+
+    async def listen():
+        listening.set()
+        await asyncio.Event().wait()
+        yield
+
+    pubsubs[1].listen = listen
+    redis = MagicMock()
+    redis.pubsub.side_effect = pubsubs
+    shared_lobby = SharedLobby(redis, 'lobby', 'instance')
+
+    delivery = asyncio.create_task(
+        shared_lobby._deliver(WSConnectionManager()))
+    await asyncio.wait_for(listening.wait(), 5)
+    delivery.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(delivery, 5)
+    for pubsub in pubsubs:
+        pubsub.__aexit__.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_users_of_a_stopped_instance_are_removed():
+    redis = MagicMock()
+    redis.hgetall = AsyncMock(return_value={
+        'lost': json.dumps({'instance': 'stopped', 'age': 20,
+                            'gender': Gender.MALE, 'gender_filter': None}),
+        'kept': json.dumps({'instance': 'running', 'age': 30,
+                            'gender': Gender.FEMALE, 'gender_filter': None}),
+    })
+    pipe = redis.pipeline.return_value.__aenter__.return_value
+    pipe.execute = AsyncMock()
+    shared_lobby = SharedLobby(redis, 'lobby', 'running')
+
+    assert await shared_lobby._remove_users_of('stopped') \
+           == {'lost': MMUserData(age=20, gender=Gender.MALE)}
+    pipe.hdel.assert_called_once_with('lobby:users', 'lost')
+    pipe.srem.assert_called_once_with('lobby:online', 'lost')
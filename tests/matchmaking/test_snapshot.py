@@ -0,0 +1,67 @@
+import io
+import json
+
+import numpy as np
+import pytest
+
+from swipe.matchmaking.graph import ConnectionGraph, DenseConnectionGraph, \
+    Vertex
+from swipe.matchmaking.schemas import MMSettings
+from swipe.matchmaking.snapshot import decode_snapshot, encode_snapshot
+from swipe.swipe_server.users.enums import Gender
+
+
+def _graph(graph_class) -> ConnectionGraph:
+    graph = graph_class()
+    for number in range(4):
+        graph.add(Vertex(f'user_{number}', MMSettings(
+            age=20 + number, gender=Gender.MALE, current_weight=number,
+            session_id='session'), set()))
+    graph['user_0'].connect('user_1', True)
+    graph['user_1'].connect('user_0', True)
+    graph['user_2'].connect('user_3', False)
+    graph['user_3'].disallow('user_0')
+    graph['user_3'].matched = True
+    # a free number in the middle
+    graph.remove('user_1')
+    graph['user_0'].connect('user_2', False)
+    return graph
+
+
+@pytest.mark.parametrize('graph_class',
+                         [ConnectionGraph, DenseConnectionGraph])
+def test_snapshot_keeps_users_numbers_and_edges(graph_class):
+    graph = _graph(graph_class)
+    snapshot = encode_snapshot(graph, {'user_2'}, {'user_0'})
+
+    restored = graph_class()
+    assert decode_snapshot(snapshot, restored) == ({'user_2'}, {'user_0'})
+    assert list(restored) == list(graph)
+    for user_id, vertex in restored.items():
+        original_vertex = graph[user_id]
+        assert vertex.number == original_vertex.number
+        assert vertex.mm_settings == original_vertex.mm_settings
+        assert vertex.edges == original_vertex.edges
+        assert vertex.matched == original_vertex.matched
+        assert vertex.disallowed_users == original_vertex.disallowed_users
+    assert restored.edge_count == graph.edge_count
+    assert restored.free_numbers == graph.free_numbers
+    # the free number is given to the next user
+    restored.add(Vertex('user_4', MMSettings(
+        age=20, gender=Gender.MALE, session_id='session'), set()))
+    assert restored['user_4'].number == 1
+
+
+def test_snapshot_of_another_version_is_rejected():
+    snapshot = encode_snapshot(_graph(ConnectionGraph), set(), set())
+    with np.load(io.BytesIO(snapshot)) as arrays:
+        arrays = dict(arrays)
+    header = json.loads(arrays['header'].tobytes())
+    header['version'] = 3
+    arrays['header'] = np.frombuffer(json.dumps(header).encode(),
+                                     dtype=np.uint8)
+    old_snapshot = io.BytesIO()
+    np.savez(old_snapshot, **arrays)
+
+    with pytest.raises(ValueError):
+        decode_snapshot(old_snapshot.getvalue(), ConnectionGraph())
@@ -0,0 +1,50 @@
+import random
+
+from benchmarks.common import random_vertices
+from swipe.matchmaking.matchmaker import Matchmaker
+from swipe.matchmaking.vectorized import VertexArrays
+
+
+def test_compatibility_masks_match_scalar_check():
+    rng = random.Random(0)
+    vertices = random_vertices(500, rng)
+    graph = {vertex.user_id: vertex for vertex in vertices}
+    for vertex in vertices:
+        vertex.disallowed_users = {
+            rng.choice(vertices).user_id for _ in range(3)}
+
+    arrays = VertexArrays(capacity=16)
+    for vertex in vertices:
+        arrays.add(vertex.user_id, vertex.mm_settings)
+    # leaving a hole in the arrays
+    arrays.remove(vertices[0].user_id)
+    del graph[vertices[0].user_id]
+
+    for new_vertex in random_vertices(50, rng):
+        new_vertex.disallowed_users = {
+            rng.choice(vertices).user_id for _ in range(3)}
+        vertices[1].disallow(new_vertex.user_id)
+
+        expected = {}
+        for user_id, vertex in graph.items():
+            forward = new_vertex.can_connect_to(vertex)
+            backward = vertex.can_connect_to(new_vertex)
+            if forward or backward:
+                expected[user_id] = (forward, backward)
+
+        actual = {user_id: (forward, backward)
+                  for user_id, forward, backward
+                  in arrays.connections(new_vertex, graph)}
+        assert actual == expected
+
+
+def test_vectorized_matchmaker_builds_the_same_graph(random_round_data):
+    round_data = random_round_data(300, seed=2)
+    matchmaker = Matchmaker(vectorized=False)
+    matchmaker.prepare_round(round_data.copy(deep=True))
+    vectorized_matchmaker = Matchmaker(vectorized=True)
+    vectorized_matchmaker.prepare_round(round_data.copy(deep=True))
+
+    for user_id in round_data.new_users:
+        assert vectorized_matchmaker.get_vertex(user_id).edges == \
+               matchmaker.get_vertex(user_id).edges
@@ -0,0 +1,53 @@
+import aioredis
+import pytest
+
+from swipe.swipe_server.users.schemas import OnlineFilterBody
+from swipe.swipe_server.users.services.fetch_service import FetchUserService
+from swipe.swipe_server.users.services.online_cache import \
+    RedisMatchmakingOnlineUserService
+from swipe.swipe_server.users.services.redis_services import \
+    RedisChatCacheService, UserFetchCacheKey
+
+
+@pytest.mark.anyio
+async def test_collect_on_connect(fake_redis: aioredis.Redis):
+    fetch_service = FetchUserService(
+        RedisMatchmakingOnlineUserService(fake_redis), fake_redis)
+    # 30 is outside of the prefetched ages
+    for user_id, age in [('user_20', 20), ('user_22', 22), ('user_25', 25),
+                         ('user_30', 30), ('partner', 20), ('offline', 21)]:
+        await fake_redis.sadd(f'matchmaking:{age}:ALL', user_id)
+        if user_id != 'offline':
+            await fake_redis.sadd('matchmaking_all', user_id)
+    await fake_redis.sadd('matchmaking:20:ALL', 'me')
+    await fake_redis.sadd('matchmaking_all', 'me')
+    await RedisChatCacheService(fake_redis).add_chat_partner('partner', 'me')
+    # left from the previous session
+    previous_session = UserFetchCacheKey(user_id='me', session_id='previous')
+    assert await fetch_service.collect(
+        'me', 20, OnlineFilterBody(session_id='previous', limit=100),
+        disallowed_users={'partner'})
+    assert await fake_redis.smembers(previous_session.sessions_key()) \
+           == {'previous'}
+
+    connections, disallowed_users = await fetch_service.collect_on_connect(
+        'me', 20, OnlineFilterBody(session_id='current', limit=100),
+        prefetch_age_difference=5)
+
+    assert connections == {'user_20', 'user_22', 'user_25', 'user_30'}
+    assert disallowed_users == {'me', 'partner'}
+    assert not await fake_redis.exists(previous_session.cache_key())
+    assert not await fake_redis.exists(previous_session.cache_age_diff_key())
+    current_session = UserFetchCacheKey(user_id='me', session_id='current')
+    assert await fake_redis.smembers(current_session.cache_key()) \
+           == connections
+    assert await fake_redis.get(current_session.cache_age_diff_key()) == '25'
+    assert await fake_redis.smembers(current_session.sessions_key()) \
+           == {'current'}
+
+    # the same as collecting them one by one
+    await fake_redis.delete(current_session.cache_key(),
+                            current_session.cache_age_diff_key())
+    assert await fetch_service.collect(
+        'me', 20, OnlineFilterBody(session_id='current', limit=100),
+        disallowed_users={'partner'}) == connections
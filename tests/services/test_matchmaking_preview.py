@@ -0,0 +1,40 @@
+import datetime
+import uuid
+
+import aioredis
+import pytest
+
+from swipe.swipe_server.users.enums import Gender
+from swipe.swipe_server.users.models import User
+from swipe.swipe_server.users.services.redis_services import \
+    RedisMatchmakingPreviewService
+
+
+@pytest.mark.anyio
+async def test_preview_round_trip(fake_redis: aioredis.Redis):
+    redis_preview = RedisMatchmakingPreviewService(fake_redis)
+    default_user = User(id=uuid.uuid4(), gender=Gender.FEMALE,
+                        date_of_birth=datetime.date(2000, 2, 29))
+    await redis_preview.cache_preview(default_user)
+
+    preview = await redis_preview.get_preview(str(default_user.id))
+    assert preview.id == default_user.id
+    assert preview.gender == Gender.FEMALE
+    assert preview.date_of_birth == datetime.date(2000, 2, 29)
+    assert preview.age == default_user.age
+
+    await redis_preview.drop_preview(str(default_user.id))
+    assert await redis_preview.get_preview(str(default_user.id)) is None
+
+
+@pytest.mark.anyio
+async def test_unfinished_registration_is_not_cached(
+        fake_redis: aioredis.Redis):
+    redis_preview = RedisMatchmakingPreviewService(fake_redis)
+    default_user = User(id=uuid.uuid4(), gender=Gender.MALE,
+                        date_of_birth=datetime.date(2000, 1, 1))
+    await redis_preview.cache_preview(default_user)
+
+    default_user.date_of_birth = None
+    await redis_preview.cache_preview(default_user)
+    assert await redis_preview.get_preview(str(default_user.id)) is None
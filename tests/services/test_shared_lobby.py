@@ -0,0 +1,41 @@
+import aioredis
+import pytest
+
+from swipe.matchmaking.shared_lobby import SharedLobby
+from swipe.swipe_server.users.enums import Gender
+from swipe.ws_connection import MMUserData
+
+
+@pytest.mark.anyio
+async def test_instances_share_the_lobby(fake_redis: aioredis.Redis):
+    instance_a = SharedLobby(fake_redis, 'matchmaking_lobby', 'a')
+    instance_b = SharedLobby(fake_redis, 'matchmaking_lobby', 'b')
+    await instance_a.register('user_a', MMUserData(
+        age=20, gender=Gender.MALE))
+    await instance_b.register('user_b', MMUserData(
+        age=30, gender=Gender.FEMALE, gender_filter=Gender.MALE))
+    await instance_a.add_online('user_a')
+    await instance_b.add_online('user_b')
+
+    # the match is sent by one instance and accepted through the other
+    await instance_a.add_match('user_a', 'user_b')
+    await instance_b.accept_match('user_b')
+    assert (await instance_a.get_match('user_b')).accepted
+    assert not (await instance_b.get_match('user_a')).accepted
+    assert await instance_a.lobby_state() \
+           == ({'user_a', 'user_b'}, {'user_a', 'user_b'})
+    assert await instance_a.user_data('user_b') == MMUserData(
+        age=30, gender=Gender.FEMALE, gender_filter=Gender.MALE)
+
+    # instance b has stopped
+    assert await instance_a._remove_users_of('b') == {'user_b'}
+    assert not await instance_a.is_connected('user_b')
+    assert await instance_a.lobby_state() \
+           == ({'user_a'}, {'user_a', 'user_b'})
+
+    # user_a has reconnected to instance b before instance a
+    # got the disconnect of the previous socket
+    await instance_b.register('user_a', MMUserData(
+        age=20, gender=Gender.MALE))
+    await instance_a.disconnect('user_a')
+    assert await instance_b.is_connected('user_a')